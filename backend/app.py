@@ -1,22 +1,188 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, make_response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from datetime import datetime
+from werkzeug.exceptions import HTTPException
+from werkzeug.middleware.proxy_fix import ProxyFix
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+import hashlib
+import hmac
+import json
 import os
+import random
+import tempfile
+import threading
+import time
 from dotenv import load_dotenv
 import uuid
+import zlib
+from sqlalchemy.exc import IntegrityError
+from partitions import history_window_start
+from approx_stats import ALL_PURPOSES, approximate_stats, hll_register
+from rollups import GRANULARITIES, aggregate as aggregate_rollups, bucket_start
+from ratelimit import EXEMPT_ENDPOINTS, ConcurrencyLimiter, RateLimiter, client_identity, load_api_keys
+from coalesce import CoalesceTimeout, Coalescer
+from consent_token import DEFAULT_LIFETIME_SECONDS, RevocationList, encode_token
+from consent_index import IndexReader
+from sequencer import sequence_changes
+from scheduler import PeriodicJob
+import sqlite_edge
+from profiling import RequestProfiler
+from tracing import TracedJSONProvider, Tracer, instrument_engine, make_exporter, traceparent
+from bulk_stream import BulkPayloadError, iter_json, iter_ndjson
+from wire_format import (
+    MSGPACK_MIMETYPE, NDJSON_MIMETYPE, columns, msgpack_available, msgpack_response, request_payload,
+    sent_msgpack, unix_seconds, wants_msgpack, wants_ndjson
+)
 
 # Load environment variables
 load_dotenv()
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['X-Consent-Token'])
+# Reverse proxies in front of the app (load balancer, nginx); their
+# X-Forwarded-For entries give request.remote_addr the real client address
+TRUSTED_PROXY_HOPS = int(os.getenv('TRUSTED_PROXY_HOPS', '0'))
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS)
 
 # Database configuration - use pg8000 instead of psycopg2
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', '').replace('postgresql://', 'postgresql+pg8000://')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# The pool is per process. Under gunicorn size it for one worker's threads;
+# workers x (pool size + overflow) has to fit the database's connection limit.
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+if sqlite_edge.enabled(app.config['SQLALCHEMY_DATABASE_URI']):
+    # Embedded single-node mode: WAL, pragmas tuned once per pooled connection
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = sqlite_edge.engine_options(DB_POOL_SIZE, DB_MAX_OVERFLOW)
+elif not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': DB_POOL_SIZE, 'max_overflow': DB_MAX_OVERFLOW}
 db = SQLAlchemy(app)
 
+# Time series responses are capped so a single request can't pull years of hourly buckets
+TIMESERIES_DEFAULT_BUCKETS = 30
+TIMESERIES_MAX_BUCKETS = int(os.getenv('TIMESERIES_MAX_BUCKETS', '2000'))
+# Rollups are folded in from the change feed by a background job (see
+# scheduler.py) this often; 0 leaves it to `python rollups.py --aggregate`
+ROLLUP_AGGREGATE_SECONDS = float(os.getenv('ROLLUP_AGGREGATE_SECONDS', '60'))
+
+# Change feed: pages consent_history by its commit-ordered seq (see sequencer.py).
+# Writers number their history rows right after committing; a background
+# sweep numbers any a writer left behind, so reads never take the cursor lock.
+CHANGE_SEQUENCE_SWEEP_SECONDS = float(os.getenv('CHANGE_SEQUENCE_SWEEP_SECONDS', '5'))
+CHANGE_FEED_MAX_LIMIT = 1000
+CHANGE_FEED_POLL_SECONDS = float(os.getenv('CHANGE_FEED_POLL_SECONDS', '1'))
+CHANGE_FEED_STREAM_SECONDS = float(os.getenv('CHANGE_FEED_STREAM_SECONDS', '300'))
+CHANGE_FEED_KEEPALIVE_SECONDS = 15
+
+# Incremental sync: a snapshot of consents by id, then the change feed from
+# the seq pinned when the snapshot started
+SYNC_DEFAULT_LIMIT = 1000
+SYNC_MAX_LIMIT = 10000
+
+# Admission control. The concurrency limit defaults to SQLAlchemy's pool
+# size plus overflow so excess requests are shed before they wait on the pool.
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', '1').lower() in ('1', 'true', 'yes')
+rate_limiter = RateLimiter.from_env()
+RATE_LIMIT_API_KEYS = load_api_keys()
+concurrency_limiter = ConcurrencyLimiter(int(os.getenv('MAX_CONCURRENT_REQUESTS', str(DB_POOL_SIZE + DB_MAX_OVERFLOW))))
+# Long-lived streams release their DB connection between polls
+CONCURRENCY_EXEMPT_ENDPOINTS = EXEMPT_ENDPOINTS | {'stream_consent_changes'}
+
+# Reads that answer If-None-Match with 304 when the body hasn't changed
+ETAG_ENDPOINTS = {'get_purposes', 'get_purpose', 'get_consent', 'get_consent_by_id'}
+
+# Identical concurrent GETs of expensive routes share one computation, and
+# the result is reused for COALESCE_TTL_MS afterwards (0 disables the cache).
+# Followers give up after COALESCE_WAIT_SECONDS and get a 503 instead.
+coalescer = Coalescer(ttl_seconds=float(os.getenv('COALESCE_TTL_MS', '250')) / 1000,
+                      wait_seconds=float(os.getenv('COALESCE_WAIT_SECONDS', '10')))
+
+# Admin endpoints need an X-Admin-Token header matching ADMIN_TOKEN; unset disables them
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
+# Cohort analytics snapshots and reports are rebuilt at most this often
+ANALYTICS_CACHE_SECONDS = float(os.getenv('ANALYTICS_CACHE_SECONDS', '600'))
+analytics_cache = Coalescer(ttl_seconds=ANALYTICS_CACHE_SECONDS, max_entries=64,
+                            wait_seconds=float(os.getenv('ANALYTICS_WAIT_SECONDS', '20')))
+
+# Batch consent checks: users per request, purposes per request (each purpose
+# is one bit of a JSON-safe integer mask) and users per IN (...) query.
+BATCH_CHECK_MAX_USERS = int(os.getenv('BATCH_CHECK_MAX_USERS', '10000'))
+BATCH_CHECK_MAX_PURPOSES = 52
+BATCH_CHECK_CHUNK = 500
+
+# Streamed bulk updates: items applied and committed per transaction
+BULK_STREAM_CHUNK = int(os.getenv('BULK_STREAM_CHUNK', '500'))
+
+# Consent expiry: purposes without their own lifetime fall back to this (unset = never expire)
+CONSENT_DEFAULT_LIFETIME_DAYS = os.getenv('CONSENT_DEFAULT_LIFETIME_DAYS')
+
+# Signed consent tokens are only issued when a signing secret is configured
+CONSENT_TOKEN_SECRET = os.getenv('CONSENT_TOKEN_SECRET')
+CONSENT_TOKEN_LIFETIME_SECONDS = int(os.getenv('CONSENT_TOKEN_LIFETIME_SECONDS', str(DEFAULT_LIFETIME_SECONDS)))
+CATALOG_VERSION_CACHE_SECONDS = 30
+_catalog_version = {'value': None, 'loaded_at': None}
+_purpose_names = {'value': None, 'loaded_at': None}
+_purpose_catalog = {'value': None, 'loaded_at': None}
+
+# Startup priming (see warmup.py): warm the connection pool, purpose catalog
+# and hot statements when the app is imported, within a time budget
+WARMUP_ON_START = os.getenv('WARMUP_ON_START', '').lower() in ('1', 'true', 'yes')
+
+# Optional memory-mapped consent index (see consent_index.py) answering the
+# check endpoints; changes since its build are replayed from the change feed.
+CONSENT_INDEX_PATH = os.getenv('CONSENT_INDEX_PATH')
+CONSENT_INDEX_OVERLAY_SECONDS = float(os.getenv('CONSENT_INDEX_OVERLAY_SECONDS', '1'))
+CONSENT_INDEX_RELOAD_SECONDS = float(os.getenv('CONSENT_INDEX_RELOAD_SECONDS', '30'))
+CONSENT_INDEX_OVERLAY_MAX_ENTRIES = int(os.getenv('CONSENT_INDEX_OVERLAY_MAX_ENTRIES', '100000'))
+
+# Tracing (see tracing.py) is off unless an exporter is configured: 'file'
+# appends OTLP/JSON lines to TRACE_FILE, 'memory' keeps spans in process.
+TRACE_EXPORTER = os.getenv('TRACE_EXPORTER', '')
+TRACE_FILE = os.getenv('TRACE_FILE', 'traces.jsonl')
+TRACE_SAMPLER = os.getenv('TRACE_SAMPLER', 'ratio')
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0.01'))
+TRACE_SLOW_MS = float(os.getenv('TRACE_SLOW_MS', '500'))
+tracer = Tracer(
+    make_exporter(TRACE_EXPORTER, TRACE_FILE),
+    service_name=os.getenv('TRACE_SERVICE_NAME', 'consent-api'),
+    sampler=TRACE_SAMPLER,
+    sample_rate=TRACE_SAMPLE_RATE,
+    slow_ms=TRACE_SLOW_MS
+) if TRACE_EXPORTER else None
+if tracer is not None:
+    app.json = TracedJSONProvider(app)
+    with app.app_context():
+        instrument_engine(db.engine)
+
+# On-demand profiling (see profiling.py): admins ask for it per request with
+# `X-Profile: 1` or `?profile=1`; PROFILE_SAMPLE_RATE profiles a random share
+# of all requests. Output goes to PROFILE_DIR/<route>/, newest
+# PROFILE_MAX_FILES per route; the default directory is always writable.
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'consent-profiles'))
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+request_profiler = RequestProfiler(
+    PROFILE_DIR,
+    mode=os.getenv('PROFILE_MODE', 'sample'),
+    interval=float(os.getenv('PROFILE_INTERVAL_MS', '5')) / 1000,
+    max_concurrent=int(os.getenv('PROFILE_MAX_CONCURRENT', '2')),
+    max_files=int(os.getenv('PROFILE_MAX_FILES', '100'))
+)
+
+# Idempotency keys: stored responses are replayed for this long, and a key
+# whose first request is still running is waited on for up to WAIT seconds.
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv('IDEMPOTENCY_TTL_SECONDS', '86400'))
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv('IDEMPOTENCY_WAIT_SECONDS', '10'))
+IDEMPOTENCY_LOCK_SECONDS = 60
+_idempotency_inflight = {}
+_idempotency_lock = threading.Lock()
+
+# Active webhook endpoints are cached briefly so consent writes don't query them every time
+WEBHOOK_ENDPOINT_CACHE_SECONDS = float(os.getenv('WEBHOOK_ENDPOINT_CACHE_SECONDS', '30'))
+_webhook_endpoints = {'ids': [], 'loaded_at': None}
+
 # Models
 class Purpose(db.Model):
     __tablename__ = 'purposes'
@@ -24,6 +190,8 @@ class Purpose(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text, nullable=False)
+    # Consent for this purpose must be re-collected after this many days
+    consent_lifetime_days = db.Column(db.Integer)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     def to_dict(self):
@@ -31,11 +199,21 @@ class Purpose(db.Model):
             'id': self.id,
             'name': self.name,
             'description': self.description,
+            'consent_lifetime_days': self.consent_lifetime_days,
             'created_at': self.created_at.isoformat()
         }
 
 class Consent(db.Model):
     __tablename__ = 'consents'
+    __table_args__ = (
+        # Partial: only consents with an expiry policy that haven't been swept yet
+        db.Index('ix_consents_expiry_pending', 'expires_at',
+                 postgresql_where=db.text('expires_at IS NOT NULL AND expired_at IS NULL'),
+                 sqlite_where=db.text('expires_at IS NOT NULL AND expired_at IS NULL')),
+        # Per-user reads; on PostgreSQL the INCLUDE columns make checks index-only
+        db.Index('ix_consents_user_purpose', 'user_id', 'purpose_id',
+                 postgresql_include=['status', 'updated_at', 'expires_at']),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.String(36), nullable=False)
@@ -44,9 +222,17 @@ class Consent(db.Model):
     ip_address = db.Column(db.String(45))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    expires_at = db.Column(db.DateTime)
+    # Set when the expiry sweeper recorded the 'expire' event; the row is kept
+    expired_at = db.Column(db.DateTime)
     
     purpose = db.relationship('Purpose', backref=db.backref('consents', lazy=True))
     
+    @staticmethod
+    def unexpired(now=None):
+        """Filter for consents that are still in force; expired rows read as absent"""
+        return db.or_(Consent.expires_at.is_(None), Consent.expires_at > (now or datetime.utcnow()))
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -56,9 +242,625 @@ class Consent(db.Model):
             'status': self.status,
             'ip_address': self.ip_address,
             'created_at': self.created_at.isoformat(),
-            'updated_at': self.updated_at.isoformat()
+            'updated_at': self.updated_at.isoformat(),
+            'expires_at': self.expires_at.isoformat() if self.expires_at else None
+        }
+
+# Compact (MessagePack) consent rows: integer timestamps, no purpose names
+COMPACT_CONSENT_FIELDS = {
+    'id': lambda c: c.id,
+    'user_id': lambda c: c.user_id,
+    'purpose_id': lambda c: c.purpose_id,
+    'status': lambda c: c.status,
+    'ip_address': lambda c: c.ip_address,
+    'created_at': lambda c: unix_seconds(c.created_at),
+    'updated_at': lambda c: unix_seconds(c.updated_at),
+    'expires_at': lambda c: unix_seconds(c.expires_at),
+}
+
+# Incremental sync records, keyed on (user_id, purpose_id); the last one wins
+def sync_record(user_id, purpose_id, status, ip_address, updated_at, deleted):
+    return {
+        'user_id': user_id,
+        'purpose_id': purpose_id,
+        'status': status,
+        'ip_address': ip_address,
+        'updated_at': updated_at,
+        'deleted': deleted
+    }
+
+COMPACT_SYNC_FIELDS = {
+    'user_id': lambda r: r['user_id'],
+    'purpose_id': lambda r: r['purpose_id'],
+    'status': lambda r: r['status'],
+    'ip_address': lambda r: r['ip_address'],
+    'updated_at': lambda r: unix_seconds(r['updated_at']),
+    'deleted': lambda r: r['deleted'],
+}
+
+class ConsentHistory(db.Model):
+    __tablename__ = 'consent_history'
+    __table_args__ = (
+        db.Index('ix_consent_history_user_created', 'user_id', 'created_at'),
+        # Change feed order, and the rows still waiting for a number
+        db.Index('ix_consent_history_seq', 'seq'),
+        db.Index('ix_consent_history_unsequenced', 'id',
+                 postgresql_where=db.text('seq IS NULL'),
+                 sqlite_where=db.text('seq IS NULL')),
+    )
+    
+    # On PostgreSQL this table can be range partitioned by month on created_at
+    # (see partitions.py); elsewhere it is a single plain table.
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    # Commit-ordered change feed position, set by sequencer.py after commit
+    seq = db.Column(db.BigInteger)
+    user_id = db.Column(db.String(36), nullable=False)
+    purpose_id = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.Boolean, nullable=False)
+    ip_address = db.Column(db.String(45))
+    event = db.Column(db.String(20), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'purpose_id': self.purpose_id,
+            'status': self.status,
+            'ip_address': self.ip_address,
+            'event': self.event,
+            'created_at': self.created_at.isoformat()
+        }
+
+class ChangeCursor(db.Model):
+    __tablename__ = 'change_cursors'
+    
+    # Position of each consumer of the history sequence (see sequencer.py)
+    name = db.Column(db.String(32), primary_key=True)
+    position = db.Column(db.BigInteger, nullable=False)
+
+class WebhookEndpoint(db.Model):
+    __tablename__ = 'webhook_endpoints'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    url = db.Column(db.String(500), nullable=False)
+    secret = db.Column(db.String(128), nullable=False)
+    max_concurrency = db.Column(db.Integer, nullable=False, default=2)
+    batch_size = db.Column(db.Integer, nullable=False, default=100)
+    active = db.Column(db.Boolean, nullable=False, default=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'url': self.url,
+            'max_concurrency': self.max_concurrency,
+            'batch_size': self.batch_size,
+            'active': self.active,
+            'created_at': self.created_at.isoformat()
         }
 
+class WebhookOutbox(db.Model):
+    __tablename__ = 'webhook_outbox'
+    __table_args__ = (
+        db.Index('ix_webhook_outbox_due', 'next_attempt_at', 'id'),
+    )
+    
+    # Rows are deleted once delivered; next_attempt_at is NULL for dead letters
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    endpoint_id = db.Column(db.Integer, db.ForeignKey('webhook_endpoints.id'), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+    
+    # key is a hash of the route and the client's Idempotency-Key header;
+    # status_code stays NULL while the first request is still running.
+    key = db.Column(db.String(64), primary_key=True)
+    request_hash = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer)
+    content_type = db.Column(db.String(100))
+    response_body = db.Column(db.LargeBinary)
+    # JSON list of [name, value] pairs the view set, e.g. X-Consent-Token
+    response_headers = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+class TokenRevocation(db.Model):
+    __tablename__ = 'token_revocations'
+    
+    # Consent tokens issued before revoked_at (unix seconds) are no longer valid
+    user_id = db.Column(db.String(36), primary_key=True)
+    revoked_at = db.Column(db.Integer, nullable=False, index=True)
+
+class HllRegister(db.Model):
+    __tablename__ = 'hll_registers'
+    
+    # Sparse HyperLogLog registers per purpose (purpose_id 0 = all purposes)
+    purpose_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    register = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    rank = db.Column(db.SmallInteger, nullable=False)
+
+class ConsentRollup(db.Model):
+    __tablename__ = 'consent_rollups'
+    
+    granularity = db.Column(db.String(8), primary_key=True)
+    purpose_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    bucket_start = db.Column(db.DateTime, primary_key=True)
+    opt_ins = db.Column(db.Integer, nullable=False, default=0)
+    opt_outs = db.Column(db.Integer, nullable=False, default=0)
+    
+    def to_dict(self):
+        return {
+            'bucket_start': self.bucket_start.isoformat(),
+            'opt_ins': self.opt_ins,
+            'opt_outs': self.opt_outs
+        }
+
+def dialect_insert(model):
+    """INSERT construct supporting ON CONFLICT for the active backend"""
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(model.__table__)
+
+def register_distinct_user(consent):
+    """Add the consent's user to the HyperLogLog sketches of its purpose"""
+    index, rank = hll_register(consent.user_id)
+    table = HllRegister.__table__
+    for purpose_id in (consent.purpose_id, ALL_PURPOSES):
+        stmt = dialect_insert(HllRegister).values(purpose_id=purpose_id, register=index, rank=rank)
+        # Registers only ever grow, so concurrent writers can't lose updates
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=[table.c.purpose_id, table.c.register],
+            set_={'rank': stmt.excluded.rank},
+            where=table.c.rank < stmt.excluded.rank
+        ))
+
+def upsert_rollup(executor, granularity, start, purpose_id, opt_ins, opt_outs):
+    """Add opt-in/opt-out counts to a rollup bucket, creating it if needed"""
+    table = ConsentRollup.__table__
+    stmt = dialect_insert(ConsentRollup).values(
+        granularity=granularity, bucket_start=start, purpose_id=purpose_id,
+        opt_ins=opt_ins, opt_outs=opt_outs
+    )
+    executor.execute(stmt.on_conflict_do_update(
+        index_elements=[table.c.granularity, table.c.purpose_id, table.c.bucket_start],
+        set_={
+            'opt_ins': table.c.opt_ins + stmt.excluded.opt_ins,
+            'opt_outs': table.c.opt_outs + stmt.excluded.opt_outs
+        }
+    ))
+
+def sequence_changes_job():
+    with app.app_context():
+        sequence_changes(db.engine)
+
+sequence_job = PeriodicJob('sequencer', sequence_changes_job, CHANGE_SEQUENCE_SWEEP_SECONDS)
+
+def aggregate_rollups_job():
+    with app.app_context():
+        aggregate_rollups(db.engine, upsert_rollup)
+
+rollup_job = PeriodicJob('rollups', aggregate_rollups_job, ROLLUP_AGGREGATE_SECONDS)
+
+def consent_expiry(purpose, now=None):
+    """When a consent given now for this purpose must be re-collected"""
+    days = purpose.consent_lifetime_days
+    if days is None and CONSENT_DEFAULT_LIFETIME_DAYS:
+        days = int(CONSENT_DEFAULT_LIFETIME_DAYS)
+    if days is None:
+        return None
+    return (now or datetime.utcnow()) + timedelta(days=days)
+
+def parse_timestamp(value):
+    """ISO 8601 string to the naive UTC datetime the tables store; ValueError if malformed"""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def revoke_consent_tokens(user_id):
+    """Invalidate the user's outstanding consent tokens"""
+    # Rounded up so every token issued during this second is covered
+    revoked_at = int(time.time()) + 1
+    table = TokenRevocation.__table__
+    stmt = dialect_insert(TokenRevocation).values(user_id=user_id, revoked_at=revoked_at)
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=[table.c.user_id],
+        set_={'revoked_at': stmt.excluded.revoked_at},
+        where=table.c.revoked_at < stmt.excluded.revoked_at
+    ))
+
+def catalog_version():
+    """Checksum of the purpose catalog, cached for a few seconds"""
+    loaded_at = _catalog_version['loaded_at']
+    if loaded_at is None or time.monotonic() - loaded_at > CATALOG_VERSION_CACHE_SECONDS:
+        purposes = db.session.query(Purpose.id, Purpose.name).order_by(Purpose.id).all()
+        _catalog_version['value'] = zlib.crc32(json.dumps([list(p) for p in purposes]).encode('utf-8'))
+        _catalog_version['loaded_at'] = time.monotonic()
+    return _catalog_version['value']
+
+def purpose_names():
+    """{purpose_id: name}, cached like the catalog version"""
+    loaded_at = _purpose_names['loaded_at']
+    if loaded_at is None or time.monotonic() - loaded_at > CATALOG_VERSION_CACHE_SECONDS:
+        _purpose_names['value'] = dict(db.session.query(Purpose.id, Purpose.name))
+        _purpose_names['loaded_at'] = time.monotonic()
+    return _purpose_names['value']
+
+def purpose_catalog():
+    """Serialized GET /api/purposes body, cached like the catalog version"""
+    loaded_at = _purpose_catalog['loaded_at']
+    if loaded_at is None or time.monotonic() - loaded_at > CATALOG_VERSION_CACHE_SECONDS:
+        purposes = Purpose.query.order_by(Purpose.id).all()
+        _purpose_catalog['value'] = json.dumps([purpose.to_dict() for purpose in purposes]).encode('utf-8')
+        _purpose_catalog['loaded_at'] = time.monotonic()
+    return _purpose_catalog['value']
+
+def issue_consent_token(user_id):
+    """Signed token with the user's current purpose-status vector"""
+    statuses = dict(db.session.query(Consent.purpose_id, Consent.status).filter(
+        Consent.user_id == user_id, Consent.unexpired()
+    ))
+    revocation = db.session.get(TokenRevocation, user_id)
+    issued_at = int(time.time())
+    if revocation is not None:
+        issued_at = max(issued_at, revocation.revoked_at)
+    return encode_token(CONSENT_TOKEN_SECRET, user_id, statuses, catalog_version(),
+                        issued_at=issued_at, lifetime=CONSENT_TOKEN_LIFETIME_SECONDS)
+
+def consent_token_header(user_id):
+    """X-Consent-Token for the user, or None if tokens are off or can't encode the catalog"""
+    if not CONSENT_TOKEN_SECRET:
+        return None
+    try:
+        return issue_consent_token(user_id)
+    except ValueError as e:
+        # The write itself must not fail because the catalog outgrew the token format
+        app.logger.warning('No consent token for %s: %s', user_id, e)
+        return None
+
+def attach_consent_token(response, token):
+    if token:
+        response.headers['X-Consent-Token'] = token
+    return response
+
+def commit_changes():
+    """Commit consent writes, then give their history rows change feed numbers"""
+    db.session.commit()
+    try:
+        sequence_changes(db.engine)
+    except Exception as e:
+        # The write stands; the background sweep numbers its rows
+        app.logger.warning('Change sequencing deferred to the sweep: %s', e)
+
+def fetch_changes(since, limit):
+    """Return history rows with a sequence number above `since`"""
+    # Read-only. Rows are numbered in commit order after they are visible,
+    # so every seq up to the highest one visible is visible too, and `since`
+    # can't skip a change.
+    rows = ConsentHistory.query.filter(ConsentHistory.seq > since).order_by(
+        ConsentHistory.seq
+    ).limit(limit).all()
+    return rows, len(rows) == limit
+
+consent_index = IndexReader(
+    CONSENT_INDEX_PATH, fetch_changes,
+    refresh_seconds=CONSENT_INDEX_OVERLAY_SECONDS, reload_seconds=CONSENT_INDEX_RELOAD_SECONDS,
+    max_overlay_entries=CONSENT_INDEX_OVERLAY_MAX_ENTRIES
+) if CONSENT_INDEX_PATH else None
+
+def change_to_dict(row):
+    return {
+        'seq': row.seq,
+        'user_id': row.user_id,
+        'purpose_id': row.purpose_id,
+        'status': row.status,
+        'event': row.event,
+        'changed_at': row.created_at.isoformat()
+    }
+
+def active_webhook_endpoint_ids():
+    """Ids of active webhook endpoints, cached for a few seconds"""
+    loaded_at = _webhook_endpoints['loaded_at']
+    if loaded_at is None or time.monotonic() - loaded_at > WEBHOOK_ENDPOINT_CACHE_SECONDS:
+        _webhook_endpoints['ids'] = [row.id for row in db.session.query(WebhookEndpoint.id).filter_by(active=True)]
+        _webhook_endpoints['loaded_at'] = time.monotonic()
+    return _webhook_endpoints['ids']
+
+def enqueue_webhooks(consent, status, event, changed_at):
+    """Write the change to the webhook outbox in the current transaction"""
+    endpoint_ids = active_webhook_endpoint_ids()
+    if not endpoint_ids:
+        return
+    payload = json.dumps({
+        'id': str(uuid.uuid4()),
+        'type': f'consent.{event}',
+        'user_id': consent.user_id,
+        'purpose_id': consent.purpose_id,
+        'status': status,
+        'changed_at': changed_at.isoformat()
+    })
+    for endpoint_id in endpoint_ids:
+        db.session.add(WebhookOutbox(endpoint_id=endpoint_id, payload=payload, next_attempt_at=changed_at))
+
+def record_consent_change(consent, event):
+    """Append a consent write to the history table in the current transaction"""
+    # A deleted or expired consent no longer grants anything, so it is recorded as a denial
+    status = consent.status if event in ('create', 'update') else False
+    now = datetime.utcnow()
+    db.session.add(ConsentHistory(
+        user_id=consent.user_id,
+        purpose_id=consent.purpose_id,
+        status=status,
+        ip_address=consent.ip_address,
+        event=event,
+        created_at=now
+    ))
+    if event == 'create':
+        register_distinct_user(consent)
+    elif not status:
+        revoke_consent_tokens(consent.user_id)
+    enqueue_webhooks(consent, status, event, now)
+
+def _claim_idempotency_key(key, request_hash):
+    """Claim a key for this request, or return the existing record for it"""
+    now = datetime.utcnow()
+    record = IdempotencyKey(key=key, request_hash=request_hash, created_at=now,
+                            expires_at=now + timedelta(seconds=IDEMPOTENCY_TTL_SECONDS))
+    db.session.add(record)
+    try:
+        db.session.commit()
+        return None
+    except IntegrityError:
+        db.session.rollback()
+    
+    existing = db.session.get(IdempotencyKey, key)
+    abandoned = existing is not None and existing.status_code is None and \
+        existing.created_at < now - timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)
+    if existing is not None and (existing.expires_at <= now or abandoned):
+        # Expired or left behind by a crashed request: take it over
+        existing.request_hash = request_hash
+        existing.status_code = existing.content_type = existing.response_body = existing.response_headers = None
+        existing.created_at = now
+        existing.expires_at = record.expires_at
+        db.session.commit()
+        return None
+    return existing
+
+def _replay(record, request_hash):
+    if record.request_hash != request_hash:
+        return jsonify({'error': 'Idempotency-Key was already used with a different request'}), 422
+    response = Response(record.response_body, status=record.status_code, content_type=record.content_type)
+    for name, value in json.loads(record.response_headers or '[]'):
+        response.headers.add(name, value)
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def _request_hash():
+    """What makes two requests the same: the body, how it is encoded and the format asked for"""
+    digest = hashlib.sha256()
+    for part in (request.headers.get('Content-Type', ''), request.headers.get('Accept', '')):
+        digest.update(part.encode('utf-8') + b'\0')
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+def idempotent(view):
+    """Replay stored responses for requests repeating an Idempotency-Key header"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        client_key = request.headers.get('Idempotency-Key')
+        if not client_key:
+            return view(*args, **kwargs)
+        if len(client_key) > 255:
+            return jsonify({'error': 'Idempotency-Key must be at most 255 characters'}), 400
+        
+        key = hashlib.sha256(f"{request.path}\0{client_key}".encode('utf-8')).hexdigest()
+        request_hash = _request_hash()
+        
+        # Single-flight within this process: followers wait for the leader
+        # instead of polling the database.
+        with _idempotency_lock:
+            leader = _idempotency_inflight.get(key)
+            if leader is None:
+                _idempotency_inflight[key] = threading.Event()
+        if leader is not None:
+            leader.wait(IDEMPOTENCY_WAIT_SECONDS)
+        
+        try:
+            record = _claim_idempotency_key(key, request_hash)
+            # Another process (or a leader that just failed) holds the key:
+            # keep trying until it completes or is released.
+            deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+            while record is not None and record.status_code is None and time.monotonic() < deadline:
+                time.sleep(0.05)
+                record = _claim_idempotency_key(key, request_hash)
+            if record is not None:
+                if record.status_code is None:
+                    response = jsonify({'error': 'A request with this Idempotency-Key is still in progress'})
+                    response.headers['Retry-After'] = '1'
+                    return response, 409
+                return _replay(record, request_hash)
+            
+            try:
+                response = make_response(view(*args, **kwargs))
+            except Exception:
+                db.session.rollback()
+                IdempotencyKey.query.filter_by(key=key).delete()
+                db.session.commit()
+                raise
+            stored = db.session.get(IdempotencyKey, key)
+            if response.status_code >= 500 or response.is_streamed:
+                # Release the key so the client can retry failures for real
+                if stored is not None:
+                    db.session.delete(stored)
+            elif stored is not None:
+                stored.status_code = response.status_code
+                stored.content_type = response.content_type
+                stored.response_body = response.get_data()
+                # Only headers set by the view; after_request hooks run again on replay
+                stored.response_headers = json.dumps([
+                    [name, value] for name, value in response.headers.items()
+                    if name not in ('Content-Type', 'Content-Length')
+                ])
+            db.session.commit()
+            return response
+        finally:
+            if leader is None:
+                with _idempotency_lock:
+                    _idempotency_inflight.pop(key).set()
+    return wrapper
+
+def busy_response():
+    response = jsonify({'error': 'Server busy, please retry'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+def coalesced(view):
+    """Share one execution of a GET between identical concurrent requests"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        def compute():
+            response = make_response(view(*args, **kwargs))
+            return response.get_data(), response.status_code, response.headers.get('Content-Type')
+        
+        try:
+            (body, status, content_type), source = coalescer.run(
+                request.endpoint, request.full_path, compute,
+                cacheable=lambda value: value[1] == 200
+            )
+        except CoalesceTimeout:
+            return busy_response()
+        response = Response(body, status=status, content_type=content_type)
+        response.headers['X-Coalesced'] = source
+        return response
+    return wrapper
+
+def admin_required(view):
+    """Only serve requests carrying the admin token"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            return jsonify({'error': 'Admin endpoints are not enabled'}), 404
+        if not admin_token_valid():
+            return jsonify({'error': 'Invalid admin token'}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+def admin_token_valid():
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN)
+
+# Tracing; registered first so the server span covers the other hooks
+@app.before_request
+def start_trace():
+    if tracer is None:
+        return None
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.trace = tracer.start_request(f"{request.method} {route}", request.headers, {
+        'http.method': request.method,
+        'http.route': route,
+        'http.request_content_length': request.content_length
+    })
+    return None
+
+@app.after_request
+def tag_trace(response):
+    started = g.get('trace')
+    if started is not None:
+        span = started[0]
+        span.attributes['http.status_code'] = response.status_code
+        if response.status_code >= 500:
+            span.set_error(f'HTTP {response.status_code}')
+        response.headers['X-Trace-Id'] = span.trace.trace_id
+        response.headers['traceparent'] = traceparent(span)
+    return response
+
+@app.teardown_request
+def end_trace(error=None):
+    started = g.pop('trace', None)
+    if started is not None:
+        tracer.end_request(started, error)
+
+# Profiling
+@app.before_request
+def start_profile():
+    requested = request.headers.get('X-Profile') == '1' or request.args.get('profile') == '1'
+    # Profiling flags from anyone but an admin are ignored
+    if not (requested and admin_token_valid()) and not (PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE):
+        return None
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.profile = request_profiler.start(f"{request.method} {route}")
+    return None
+
+@app.after_request
+def tag_profile(response):
+    profile = g.get('profile')
+    # Randomly sampled requests don't tell the caller where the profile went
+    if profile is not None and admin_token_valid():
+        response.headers['X-Profile-File'] = profile.path
+    return response
+
+@app.teardown_request
+def end_profile(error=None):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        request_profiler.stop(profile)
+
+# Background maintenance, started by the first request each process serves
+@app.before_request
+def start_background_jobs():
+    sequence_job.start()
+    rollup_job.start()
+    return None
+
+# Admission control
+@app.before_request
+def admit_request():
+    """Reject requests over their rate budget and shed load when saturated"""
+    if not RATE_LIMIT_ENABLED or request.endpoint is None or request.endpoint in EXEMPT_ENDPOINTS:
+        return None
+    # CORS preflights are answered by flask-cors without touching the database
+    if request.method == 'OPTIONS':
+        return None
+    
+    allowed, retry_after = rate_limiter.check(client_identity(request, RATE_LIMIT_API_KEYS), request.endpoint)
+    if not allowed:
+        response = jsonify({'error': 'Too many requests'})
+        response.headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
+        return response, 429
+    
+    if request.endpoint not in CONCURRENCY_EXEMPT_ENDPOINTS:
+        if not concurrency_limiter.try_acquire():
+            return busy_response()
+        g.concurrency_slot = True
+    return None
+
+@app.before_request
+def check_content_type():
+    if sent_msgpack(request) and not msgpack_available():
+        return jsonify({'error': f'{MSGPACK_MIMETYPE} requires the msgpack package on the server'}), 415
+    return None
+
+@app.teardown_request
+def release_request(error=None):
+    if g.pop('concurrency_slot', False):
+        concurrency_limiter.release()
+
+@app.after_request
+def conditional_get(response):
+    """Tag cacheable reads so clients can revalidate them cheaply"""
+    if request.method == 'GET' and request.endpoint in ETAG_ENDPOINTS and response.status_code == 200:
+        response.add_etag()
+        response.vary.add('Accept')
+        response = response.make_conditional(request)
+    return response
+
 # Error handlers
 @app.errorhandler(400)
 def bad_request(error):
@@ -79,14 +881,23 @@ def health_check():
     return jsonify({'status': 'healthy', 'timestamp': datetime.utcnow().isoformat()})
 
 @app.route('/api/purposes', methods=['GET'])
+@coalesced
 def get_purposes():
     """Get all purposes"""
     try:
-        purposes = Purpose.query.all()
-        return jsonify([purpose.to_dict() for purpose in purposes])
+        return Response(purpose_catalog(), mimetype='application/json')
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/admin/metrics/coalescing', methods=['GET'])
+@admin_required
+def get_coalescing_metrics():
+    """Get request coalescing counters per route"""
+    return jsonify({
+        'ttl_ms': coalescer.ttl_seconds * 1000,
+        'routes': coalescer.snapshot()
+    })
+
 @app.route('/api/purposes/<int:purpose_id>', methods=['GET'])
 def get_purpose(purpose_id):
     """Get a specific purpose by ID"""
@@ -106,12 +917,14 @@ def get_consent():
         if not user_id:
             return jsonify({'error': 'user_id is required'}), 400
             
-        query = Consent.query.filter_by(user_id=user_id)
+        query = Consent.query.filter(Consent.user_id == user_id, Consent.unexpired())
         
         if purpose_id:
             query = query.filter_by(purpose_id=purpose_id)
             
         consents = query.all()
+        if wants_msgpack(request):
+            return msgpack_response(columns(consents, COMPACT_CONSENT_FIELDS))
         return jsonify([consent.to_dict() for consent in consents])
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -126,16 +939,20 @@ def get_consent_by_id(consent_id):
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/consent', methods=['POST'])
+@idempotent
 def update_consent():
     """Update or create a consent record"""
     try:
-        data = request.get_json()
+        data = request_payload(request)
         user_id = data.get('user_id')
         purpose_id = data.get('purpose_id')
         status = data.get('status')
         
         if not all([user_id, purpose_id, status is not None]):
             return jsonify({'error': 'user_id, purpose_id, and status are required'}), 400
+        error = _consent_fields_error(user_id, purpose_id, status)
+        if error:
+            return jsonify({'error': error}), 400
             
         # Check if purpose exists
         purpose = Purpose.query.get(purpose_id)
@@ -151,6 +968,7 @@ def update_consent():
         if consent:
             consent.status = status
             consent.ip_address = request.remote_addr
+            event = 'update'
         else:
             consent = Consent(
                 user_id=user_id,
@@ -159,32 +977,203 @@ def update_consent():
                 ip_address=request.remote_addr
             )
             db.session.add(consent)
-            
-        db.session.commit()
-        return jsonify(consent.to_dict())
+            event = 'create'
+        consent.expires_at = consent_expiry(purpose)
+        consent.expired_at = None
+        
+        record_consent_change(consent, event)
+        # Issued inside the transaction (reads see its writes), so the commit is the last thing that can fail
+        token = consent_token_header(user_id)
+        commit_changes()
+        if wants_msgpack(request):
+            response = msgpack_response({name: get(consent) for name, get in COMPACT_CONSENT_FIELDS.items()})
+        else:
+            response = jsonify(consent.to_dict())
+        return attach_consent_token(response, token)
+    except HTTPException as e:
+        return jsonify({'error': e.description}), e.code
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+def _consent_fields_error(user_id, purpose_id, status):
+    """Why a consent write's fields are malformed, or None"""
+    if not isinstance(user_id, str) or not user_id:
+        return 'user_id is required'
+    if len(user_id) > 36:
+        return 'user_id must be at most 36 characters'
+    if purpose_id is None or status is None:
+        return 'purpose_id and status are required'
+    if not isinstance(status, bool):
+        return 'status must be true or false'
+    if isinstance(purpose_id, bool) or not isinstance(purpose_id, int):
+        return 'purpose_id must be an integer'
+    return None
+
+def _bulk_item_error(item, user_id, purposes):
+    if not isinstance(item, dict):
+        return 'Item must be an object'
+    user_id = item.get('user_id', user_id)
+    purpose_id = item.get('purpose_id')
+    error = _consent_fields_error(user_id, purpose_id, item.get('status'))
+    if error is None and purpose_id not in purposes:
+        error = f'Purpose {purpose_id!r} not found'
+    return error
+
+def apply_bulk_chunk(entries, ip_address):
+    """Apply [(index, item, default user_id, parse error)] in one transaction; returns result lines"""
+    purposes = {purpose.id: purpose for purpose in Purpose.query.all()}
+    results = {}
+    valid = []
+    for index, item, user_id, error in entries:
+        error = error or _bulk_item_error(item, user_id, purposes)
+        if error:
+            results[index] = {'index': index, 'ok': False, 'error': error}
+        else:
+            valid.append((index, item.get('user_id', user_id), item['purpose_id'], item['status']))
+    
+    # One query for the chunk's existing rows instead of one per item
+    existing = {}
+    if valid:
+        rows = Consent.query.filter(
+            Consent.user_id.in_({user_id for _, user_id, _, _ in valid}),
+            Consent.purpose_id.in_({purpose_id for _, _, purpose_id, _ in valid})
+        )
+        existing = {(consent.user_id, consent.purpose_id): consent for consent in rows}
+    
+    applied = []
+    touched = set()
+    
+    def serialize_applied():
+        # After the flush (defaults populated) but before the commit expires
+        # every attribute
+        db.session.flush()
+        for index, consent in applied:
+            results[index] = {'index': index, 'ok': True, 'consent': consent.to_dict()}
+        applied.clear()
+        touched.clear()
+    
+    for index, user_id, purpose_id, status in valid:
+        if (user_id, purpose_id) in touched:
+            # A later item for the same consent: earlier items report their own state
+            serialize_applied()
+        touched.add((user_id, purpose_id))
+        consent = existing.get((user_id, purpose_id))
+        if consent:
+            consent.status = status
+            consent.ip_address = ip_address
+            event = 'update'
+        else:
+            consent = Consent(user_id=user_id, purpose_id=purpose_id, status=status, ip_address=ip_address)
+            db.session.add(consent)
+            existing[(user_id, purpose_id)] = consent
+            event = 'create'
+        consent.expires_at = consent_expiry(purposes[purpose_id])
+        consent.expired_at = None
+        record_consent_change(consent, event)
+        applied.append((index, consent))
+    
+    serialize_applied()
+    commit_changes()
+    return [results[index] for index, _, _, _ in entries]
+
+def stream_bulk_update():
+    """NDJSON per-item results for a bulk body parsed as it is read"""
+    if request.mimetype == NDJSON_MIMETYPE:
+        events = iter_ndjson(request.stream)
+    elif request.mimetype == 'application/json':
+        events = iter_json(request.stream)
+    else:
+        return jsonify({'error': f'Streamed bulk updates take application/json or {NDJSON_MIMETYPE} bodies'}), 415
+    ip_address = request.remote_addr
+    
+    def run(chunk, totals):
+        if not chunk:
+            return
+        try:
+            lines = apply_bulk_chunk(chunk, ip_address)
+        except Exception:
+            db.session.rollback()
+            # Retry item by item so one bad item only fails itself
+            lines = []
+            for entry in chunk:
+                try:
+                    lines.extend(apply_bulk_chunk([entry], ip_address))
+                except Exception as e:
+                    db.session.rollback()
+                    lines.append({'index': entry[0], 'ok': False, 'error': str(e)})
+        totals['chunks'] += 1
+        for line in lines:
+            totals['succeeded' if line['ok'] else 'failed'] += 1
+            yield json.dumps(line) + '\n'
+    
+    def generate():
+        totals = {'succeeded': 0, 'failed': 0, 'chunks': 0}
+        user_id = None
+        chunk = []
+        index = 0
+        try:
+            for event in events:
+                if event[0] == 'field':
+                    if event[1] == 'user_id':
+                        user_id = event[2]
+                    continue
+                item, error = (event[1], None) if event[0] == 'item' else (None, event[1])
+                chunk.append((index, item, user_id, error))
+                index += 1
+                if len(chunk) >= BULK_STREAM_CHUNK:
+                    yield from run(chunk, totals)
+                    chunk = []
+            yield from run(chunk, totals)
+            yield json.dumps({'done': True, **totals}) + '\n'
+        except BulkPayloadError as e:
+            # Items before the error are applied; the rest of the body is unreadable
+            yield from run(chunk, totals)
+            yield json.dumps({'done': False, 'error': str(e), **totals}) + '\n'
+        except Exception as e:
+            db.session.rollback()
+            yield json.dumps({'done': False, 'error': str(e), **totals}) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE, headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 @app.route('/api/consent/bulk', methods=['POST'])
 def bulk_update_consent():
     """Update multiple consent records at once"""
+    if request.mimetype == NDJSON_MIMETYPE or wants_ndjson(request):
+        # Replaying would mean buffering the whole body and response, which
+        # streaming exists to avoid; each item line reports its own outcome
+        if request.headers.get('Idempotency-Key'):
+            return jsonify({'error': 'Idempotency-Key is not supported for streamed bulk updates'}), 400
+        return stream_bulk_update()
+    return buffered_bulk_update()
+
+@idempotent
+def buffered_bulk_update():
     try:
-        data = request.get_json()
+        data = request_payload(request)
         user_id = data.get('user_id')
         consents = data.get('consents', [])
         
         if not user_id or not consents:
             return jsonify({'error': 'user_id and consents array are required'}), 400
+        if not isinstance(consents, list) or not all(isinstance(item, dict) for item in consents):
+            return jsonify({'error': 'consents must be an array of objects'}), 400
         
         results = []
         
-        for consent_data in consents:
+        for index, consent_data in enumerate(consents):
             purpose_id = consent_data.get('purpose_id')
             status = consent_data.get('status')
             
             if purpose_id is None or status is None:
                 continue
+            error = _consent_fields_error(user_id, purpose_id, status)
+            if error:
+                db.session.rollback()
+                return jsonify({'error': f'consents[{index}]: {error}'}), 400
                 
             # Check if purpose exists
             purpose = Purpose.query.get(purpose_id)
@@ -200,6 +1189,7 @@ def bulk_update_consent():
             if consent:
                 consent.status = status
                 consent.ip_address = request.remote_addr
+                event = 'update'
             else:
                 consent = Consent(
                     user_id=user_id,
@@ -208,11 +1198,26 @@ def bulk_update_consent():
                     ip_address=request.remote_addr
                 )
                 db.session.add(consent)
+                event = 'create'
+            consent.expires_at = consent_expiry(purpose)
+            consent.expired_at = None
             
-            results.append(consent.to_dict())
+            record_consent_change(consent, event)
+            results.append(consent)
         
-        db.session.commit()
-        return jsonify({'message': 'Bulk update successful', 'consents': results})
+        token = consent_token_header(user_id)
+        commit_changes()
+        # Serialize after the commit so new rows have their defaults populated
+        if wants_msgpack(request):
+            response = msgpack_response({
+                'message': 'Bulk update successful',
+                'consents': columns(results, COMPACT_CONSENT_FIELDS)
+            })
+        else:
+            response = jsonify({'message': 'Bulk update successful', 'consents': [consent.to_dict() for consent in results]})
+        return attach_consent_token(response, token)
+    except HTTPException as e:
+        return jsonify({'error': e.description}), e.code
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
@@ -222,8 +1227,9 @@ def delete_consent(consent_id):
     """Delete a consent record"""
     try:
         consent = Consent.query.get_or_404(consent_id)
+        record_consent_change(consent, 'delete')
         db.session.delete(consent)
-        db.session.commit()
+        commit_changes()
         return jsonify({'message': 'Consent record deleted successfully'})
     except Exception as e:
         db.session.rollback()
@@ -235,27 +1241,38 @@ def delete_user_consents(user_id):
     try:
         consents = Consent.query.filter_by(user_id=user_id).all()
         for consent in consents:
+            record_consent_change(consent, 'delete')
             db.session.delete(consent)
-        db.session.commit()
+        commit_changes()
         return jsonify({'message': f'All consent records for user {user_id} deleted successfully'})
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/consent/stats', methods=['GET'])
+@coalesced
 def get_consent_stats():
     """Get consent statistics"""
     try:
-        total_consents = Consent.query.count()
-        active_consents = Consent.query.filter_by(status=True).count()
-        inactive_consents = Consent.query.filter_by(status=False).count()
+        mode = request.args.get('mode', 'exact')
+        if mode not in ('exact', 'approx'):
+            return jsonify({'error': "mode must be 'exact' or 'approx'"}), 400
+        
+        if mode == 'approx':
+            return jsonify(approximate_stats(db.session.connection(), purpose_names()))
+        
+        # Expired consents stay in the table but no longer count
+        in_force = Consent.query.filter(Consent.unexpired())
+        total_consents = in_force.count()
+        active_consents = in_force.filter_by(status=True).count()
+        inactive_consents = in_force.filter_by(status=False).count()
         
         # Get stats by purpose
         purpose_stats = db.session.query(
             Purpose.name,
             db.func.count(Consent.id).label('total'),
             db.func.sum(db.case([(Consent.status == True, 1)], else_=0)).label('active')
-        ).join(Consent).group_by(Purpose.id, Purpose.name).all()
+        ).join(Consent).filter(Consent.unexpired()).group_by(Purpose.id, Purpose.name).all()
         
         stats = {
             'total_consents': total_consents,
@@ -277,23 +1294,203 @@ def get_consent_stats():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/consent/stats/timeseries', methods=['GET'])
+@coalesced
+def get_consent_timeseries():
+    """Get pre-aggregated opt-in/opt-out trends per purpose"""
+    try:
+        granularity = request.args.get('granularity', 'day')
+        if granularity not in GRANULARITIES:
+            return jsonify({'error': "granularity must be 'hour' or 'day'"}), 400
+        
+        try:
+            end = request.args.get('to')
+            end = parse_timestamp(end) if end else datetime.utcnow()
+            start = request.args.get('from')
+            start = parse_timestamp(start) if start else end - GRANULARITIES[granularity] * TIMESERIES_DEFAULT_BUCKETS
+        except ValueError:
+            return jsonify({'error': 'from and to must be ISO 8601 timestamps'}), 400
+        
+        if (end - start) / GRANULARITIES[granularity] > TIMESERIES_MAX_BUCKETS:
+            return jsonify({'error': f'Requested range exceeds {TIMESERIES_MAX_BUCKETS} {granularity} buckets'}), 400
+        
+        # Read-only: the rollup job keeps the buckets up to date
+        query = ConsentRollup.query.filter(
+            ConsentRollup.granularity == granularity,
+            ConsentRollup.bucket_start >= bucket_start(start, granularity),
+            ConsentRollup.bucket_start < end
+        )
+        purpose_id = request.args.get('purpose_id', type=int)
+        if purpose_id is not None:
+            query = query.filter(ConsentRollup.purpose_id == purpose_id)
+        
+        names = purpose_names()
+        series = {}
+        for rollup in query.order_by(ConsentRollup.purpose_id, ConsentRollup.bucket_start):
+            if rollup.purpose_id not in series:
+                series[rollup.purpose_id] = {
+                    'purpose_id': rollup.purpose_id,
+                    'purpose_name': names.get(rollup.purpose_id, f"Purpose {rollup.purpose_id}"),
+                    'buckets': []
+                }
+            series[rollup.purpose_id]['buckets'].append(rollup.to_dict())
+        
+        return jsonify({
+            'granularity': granularity,
+            'from': start.isoformat(),
+            'to': end.isoformat(),
+            'series': list(series.values())
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/consent/changes', methods=['GET'])
+def get_consent_changes():
+    """Get consent changes after a sequence number"""
+    try:
+        since = request.args.get('since', 0, type=int)
+        limit = min(request.args.get('limit', 100, type=int), CHANGE_FEED_MAX_LIMIT)
+        if since < 0 or limit < 1:
+            return jsonify({'error': 'since must be >= 0 and limit must be >= 1'}), 400
+        
+        rows, has_more = fetch_changes(since, limit)
+        return jsonify({
+            'changes': [change_to_dict(row) for row in rows],
+            'next_since': rows[-1].seq if rows else since,
+            'has_more': has_more
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/consent/sync', methods=['GET'])
+def sync_consents():
+    """Get consent state changed after a {seq, id} watermark"""
+    try:
+        since = request.args.get('seq', type=int)
+        after_id = request.args.get('id', type=int)
+        limit = min(request.args.get('limit', SYNC_DEFAULT_LIMIT, type=int), SYNC_MAX_LIMIT)
+        if limit < 1 or (since is not None and since < 0):
+            return jsonify({'error': 'seq must be >= 0 and limit must be >= 1'}), 400
+        
+        if since is None:
+            # A new export: pin the change feed position, then snapshot the
+            # table. Anything numbered after the pin is replayed afterwards.
+            since = db.session.query(db.func.coalesce(db.func.max(ConsentHistory.seq), 0)).scalar()
+            after_id = 0
+        
+        if after_id is not None:
+            consents = Consent.query.filter(Consent.id > after_id, Consent.unexpired()).order_by(
+                Consent.id
+            ).limit(limit).all()
+            records = [sync_record(consent.user_id, consent.purpose_id, consent.status,
+                                   consent.ip_address, consent.updated_at, False) for consent in consents]
+            # Once the snapshot is done, the next page starts on the change feed
+            watermark = {'seq': since, 'id': consents[-1].id if len(consents) == limit else None}
+            has_more = True
+        else:
+            rows, has_more = fetch_changes(since, limit)
+            # Deletes and expiries come through as tombstones
+            records = [sync_record(row.user_id, row.purpose_id, row.status, row.ip_address,
+                                   row.created_at, row.event in ('delete', 'expire')) for row in rows]
+            watermark = {'seq': rows[-1].seq if rows else since, 'id': None}
+        
+        if wants_msgpack(request):
+            return msgpack_response({
+                'consents': columns(records, COMPACT_SYNC_FIELDS),
+                'watermark': watermark,
+                'has_more': has_more
+            })
+        for record in records:
+            record['updated_at'] = record['updated_at'].isoformat()
+        return jsonify({
+            'consents': records,
+            'watermark': watermark,
+            'has_more': has_more
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/consent/changes/stream', methods=['GET'])
+def stream_consent_changes():
+    """Stream consent changes as Server-Sent Events"""
+    # Reconnecting EventSource clients resume from the last event id they saw
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', 0, type=int)
+    
+    def generate(since):
+        started = last_sent = time.monotonic()
+        yield f"retry: {int(CHANGE_FEED_POLL_SECONDS * 1000)}\n\n"
+        while time.monotonic() - started < CHANGE_FEED_STREAM_SECONDS:
+            rows, has_more = fetch_changes(since, CHANGE_FEED_MAX_LIMIT)
+            # Don't hold a pooled connection while idle between polls
+            db.session.close()
+            for row in rows:
+                yield f"id: {row.seq}\nevent: consent\ndata: {json.dumps(change_to_dict(row))}\n\n"
+                since = row.seq
+            if rows:
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent >= CHANGE_FEED_KEEPALIVE_SECONDS:
+                yield ": keepalive\n\n"
+                last_sent = time.monotonic()
+            if not has_more:
+                time.sleep(CHANGE_FEED_POLL_SECONDS)
+    
+    return Response(stream_with_context(generate(since)), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 @app.route('/api/consent/user/<user_id>/history', methods=['GET'])
 def get_user_consent_history(user_id):
     """Get consent history for a specific user"""
     try:
-        consents = Consent.query.filter_by(user_id=user_id).order_by(Consent.updated_at.desc()).all()
+        # Always bound the scan on created_at so PostgreSQL can prune
+        # history partitions outside the requested window.
+        try:
+            start = request.args.get('from')
+            start = parse_timestamp(start) if start else history_window_start()
+            end = request.args.get('to')
+            end = parse_timestamp(end) if end else None
+        except ValueError:
+            return jsonify({'error': 'from and to must be ISO 8601 timestamps'}), 400
+        
+        query = db.session.query(ConsentHistory, Purpose.name).outerjoin(
+            Purpose, Purpose.id == ConsentHistory.purpose_id
+        ).filter(
+            ConsentHistory.user_id == user_id,
+            ConsentHistory.created_at >= start
+        )
+        if end:
+            query = query.filter(ConsentHistory.created_at < end)
+        
+        entries = query.order_by(ConsentHistory.created_at.desc(), ConsentHistory.id.desc()).all()
+        
+        if wants_msgpack(request):
+            # Newest first, one column per field instead of grouping by purpose name
+            return msgpack_response({
+                'user_id': user_id,
+                'consent_history': columns([entry for entry, _ in entries], {
+                    'purpose_id': lambda h: h.purpose_id,
+                    'status': lambda h: h.status,
+                    'ip_address': lambda h: h.ip_address,
+                    'event': lambda h: h.event,
+                    'updated_at': lambda h: unix_seconds(h.created_at),
+                })
+            })
         
         # Group by purpose and show history
         history = {}
-        for consent in consents:
-            purpose_name = consent.purpose.name if consent.purpose else f"Purpose {consent.purpose_id}"
+        for entry, name in entries:
+            purpose_name = name or f"Purpose {entry.purpose_id}"
             if purpose_name not in history:
                 history[purpose_name] = []
             
             history[purpose_name].append({
-                'status': consent.status,
-                'ip_address': consent.ip_address,
-                'updated_at': consent.updated_at.isoformat()
+                'status': entry.status,
+                'ip_address': entry.ip_address,
+                'event': entry.event,
+                'updated_at': entry.created_at.isoformat()
             })
         
         return jsonify({
@@ -307,7 +1504,7 @@ def get_user_consent_history(user_id):
 def check_consent_status():
     """Check if a user has given consent for specific purposes"""
     try:
-        data = request.get_json()
+        data = request_payload(request)
         user_id = data.get('user_id')
         purpose_ids = data.get('purpose_ids', [])
         
@@ -316,16 +1513,63 @@ def check_consent_status():
         
         if not purpose_ids:
             return jsonify({'error': 'purpose_ids array is required'}), 400
+        if not isinstance(user_id, str):
+            return jsonify({'error': 'user_id must be a string'}), 400
+        if not isinstance(purpose_ids, list) or not all(
+            isinstance(purpose_id, int) and not isinstance(purpose_id, bool) for purpose_id in purpose_ids
+        ):
+            return jsonify({'error': 'purpose_ids must be an array of integers'}), 400
+        
+        # The index has no per-purpose timestamps, so last_updated is null on this path
+        statuses = consent_index.statuses(user_id, purpose_ids) if consent_index else None
+        if statuses is not None:
+            if wants_msgpack(request):
+                response = msgpack_response({
+                    'user_id': user_id,
+                    'purpose_id': purpose_ids,
+                    'status': [statuses[purpose_id] for purpose_id in purpose_ids],
+                    'last_updated': [None] * len(purpose_ids)
+                })
+            else:
+                names = purpose_names()
+                response = jsonify({
+                    'user_id': user_id,
+                    'consent_status': {
+                        names.get(purpose_id, f"Purpose {purpose_id}"): {
+                            'has_consent': statuses[purpose_id] is not None,
+                            'status': statuses[purpose_id],
+                            'last_updated': None
+                        } for purpose_id in purpose_ids
+                    }
+                })
+            response.headers['X-Consent-Source'] = 'index'
+            return response
+        
+        if wants_msgpack(request):
+            # Aligned with purpose_ids; no purpose name lookups needed
+            consents = {c.purpose_id: c for c in Consent.query.filter(
+                Consent.user_id == user_id,
+                Consent.purpose_id.in_(purpose_ids),
+                Consent.unexpired()
+            )}
+            found = [consents.get(purpose_id) for purpose_id in purpose_ids]
+            return msgpack_response({
+                'user_id': user_id,
+                'purpose_id': purpose_ids,
+                'status': [c.status if c else None for c in found],
+                'last_updated': [unix_seconds(c.updated_at) if c else None for c in found]
+            })
         
+        names = purpose_names()
         results = {}
         for purpose_id in purpose_ids:
-            consent = Consent.query.filter_by(
-                user_id=user_id,
-                purpose_id=purpose_id
+            consent = Consent.query.filter(
+                Consent.user_id == user_id,
+                Consent.purpose_id == purpose_id,
+                Consent.unexpired()
             ).first()
             
-            purpose = Purpose.query.get(purpose_id)
-            purpose_name = purpose.name if purpose else f"Purpose {purpose_id}"
+            purpose_name = names.get(purpose_id, f"Purpose {purpose_id}")
             
             results[purpose_name] = {
                 'has_consent': consent is not None,
@@ -337,10 +1581,176 @@ def check_consent_status():
             'user_id': user_id,
             'consent_status': results
         })
+    except HTTPException as e:
+        return jsonify({'error': e.description}), e.code
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/consent/token', methods=['GET'])
+def get_consent_token():
+    """Issue a fresh signed consent token for a user"""
+    try:
+        if not CONSENT_TOKEN_SECRET:
+            return jsonify({'error': 'Consent tokens are not enabled'}), 404
+        user_id = request.args.get('user_id')
+        if not user_id:
+            return jsonify({'error': 'user_id is required'}), 400
+        try:
+            token = issue_consent_token(user_id)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 422
+        return jsonify({'user_id': user_id, 'token': token, 'expires_in': CONSENT_TOKEN_LIFETIME_SECONDS})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/analytics/cohorts', methods=['GET'])
+@admin_required
+def get_cohort_analytics():
+    """Get co-consent, conditional rate and segment analytics from a cached snapshot"""
+    try:
+        try:
+            import cohort_analytics
+        except ImportError:
+            return jsonify({'error': 'Cohort analytics requires numpy on the server'}), 501
+        
+        segment = request.args.get('segment', 'cohort')
+        if segment != 'cohort' and not segment.isdigit():
+            return jsonify({'error': "segment must be 'cohort' or a purpose id"}), 400
+        
+        snapshot, _ = analytics_cache.run('snapshot', 'snapshot', lambda: cohort_analytics.load_snapshot(db.engine))
+        if segment != 'cohort' and int(segment) not in snapshot.purpose_ids:
+            return jsonify({'error': 'Unknown purpose id'}), 400
+        # Reports are keyed by their snapshot so they never mix generations
+        report, source = analytics_cache.run(
+            'report', (snapshot.generated_at, segment), lambda: cohort_analytics.report(snapshot, segment)
+        )
+        response = jsonify(report)
+        response.headers['X-Cache'] = 'hit' if source == 'cache' else 'miss'
+        return response
+    except CoalesceTimeout:
+        return busy_response()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/consent/token/revocations', methods=['GET'])
+def get_token_revocations():
+    """Get the compact list of recent consent token revocations"""
+    try:
+        # Older revocations only affect tokens that have expired anyway
+        now = int(time.time())
+        revocations = RevocationList()
+        for user_id, revoked_at in db.session.query(TokenRevocation.user_id, TokenRevocation.revoked_at).filter(
+            TokenRevocation.revoked_at > now - CONSENT_TOKEN_LIFETIME_SECONDS
+        ):
+            revocations.add(user_id, revoked_at)
+        return jsonify({
+            'generated_at': now,
+            'token_lifetime': CONSENT_TOKEN_LIFETIME_SECONDS,
+            'count': len(revocations.entries),
+            'revocations': revocations.to_string()
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/consent/check/batch', methods=['POST'])
+def check_consent_batch():
+    """Check consent for many users and purposes in one request"""
+    try:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Request body must be a JSON object'}), 400
+        user_ids = data.get('user_ids')
+        purpose_ids = data.get('purpose_ids')
+        output = data.get('format', 'bitmask')
+        
+        if not isinstance(user_ids, list) or not all(isinstance(user_id, str) for user_id in user_ids):
+            return jsonify({'error': 'user_ids must be an array of strings'}), 400
+        if not isinstance(purpose_ids, list) or not all(
+            isinstance(purpose_id, int) and not isinstance(purpose_id, bool) for purpose_id in purpose_ids
+        ):
+            return jsonify({'error': 'purpose_ids must be an array of integers'}), 400
+        user_ids = list(dict.fromkeys(user_ids))
+        purpose_ids = list(dict.fromkeys(purpose_ids))
+        if not user_ids or not purpose_ids:
+            return jsonify({'error': 'user_ids and purpose_ids arrays are required'}), 400
+        if len(user_ids) > BATCH_CHECK_MAX_USERS:
+            return jsonify({'error': f'At most {BATCH_CHECK_MAX_USERS} user_ids per request'}), 400
+        if len(purpose_ids) > BATCH_CHECK_MAX_PURPOSES:
+            return jsonify({'error': f'At most {BATCH_CHECK_MAX_PURPOSES} purpose_ids per request'}), 400
+        if output not in ('bitmask', 'columnar'):
+            return jsonify({'error': "format must be 'bitmask' or 'columnar'"}), 400
+        
+        user_index = {user_id: i for i, user_id in enumerate(user_ids)}
+        purpose_bit = {purpose_id: i for i, purpose_id in enumerate(purpose_ids)}
+        granted = [0] * len(user_ids)
+        recorded = [0] * len(user_ids)
+        
+        # Users the index can answer skip the database entirely
+        pending = user_ids
+        if consent_index:
+            pending = []
+            for user_id in user_ids:
+                statuses = consent_index.statuses(user_id, purpose_ids)
+                if statuses is None:
+                    pending.append(user_id)
+                    continue
+                index = user_index[user_id]
+                for purpose_id, status in statuses.items():
+                    if status is not None:
+                        bit = 1 << purpose_bit[purpose_id]
+                        recorded[index] |= bit
+                        if status:
+                            granted[index] |= bit
+        
+        # One set-based query per chunk of users instead of one per (user, purpose)
+        for start in range(0, len(pending), BATCH_CHECK_CHUNK):
+            rows = db.session.query(Consent.user_id, Consent.purpose_id, Consent.status).filter(
+                Consent.user_id.in_(pending[start:start + BATCH_CHECK_CHUNK]),
+                Consent.purpose_id.in_(purpose_ids),
+                Consent.unexpired()
+            )
+            for user_id, purpose_id, status in rows:
+                bit = 1 << purpose_bit[purpose_id]
+                index = user_index[user_id]
+                recorded[index] |= bit
+                if status:
+                    granted[index] |= bit
+        
+        if output == 'bitmask':
+            # Bit i of each mask refers to purpose_ids[i]
+            return jsonify({
+                'purpose_ids': purpose_ids,
+                'user_ids': user_ids,
+                'granted': granted,
+                'recorded': recorded
+            })
+        
+        status = {}
+        for purpose_id, bit in purpose_bit.items():
+            mask = 1 << bit
+            status[str(purpose_id)] = [
+                bool(granted[i] & mask) if recorded[i] & mask else None
+                for i in range(len(user_ids))
+            ]
+        return jsonify({
+            'purpose_ids': purpose_ids,
+            'user_ids': user_ids,
+            'status': status
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+if WARMUP_ON_START:
+    from warmup import prime
+    warmup_report = prime(app)
+    # A failed or timed-out warm-up only costs latency, so it is logged, not raised
+    if warmup_report['ok']:
+        app.logger.info('Warm-up: %s', json.dumps(warmup_report))
+    else:
+        app.logger.warning('Warm-up incomplete: %s', json.dumps(warmup_report))
+
 if __name__ == '__main__':
+    from migrations import migrate
     with app.app_context():
-        db.create_all()
+        migrate(db)
     app.run(debug=True, host='0.0.0.0', port=5000) 
\ No newline at end of file
@@ -0,0 +1,241 @@
+"""
+Approximate consent statistics.
+
+Answers the dashboard statistics from a fixed-size random sample of the
+consents table instead of a full scan, so the cost stays roughly constant as
+the table grows:
+
+- PostgreSQL samples whole pages with TABLESAMPLE SYSTEM and estimates the
+  table size from the planner statistics (pg_class.reltuples).
+- Other backends probe random primary keys between MIN(id) and MAX(id), which
+  are both index lookups.
+
+Like the exact statistics, only consents still in force are counted;
+expired rows stay in the table (see expiry_sweeper.py) but not in the stats.
+
+Rates come with Wilson score confidence intervals. Distinct users per purpose
+are estimated with HyperLogLog sketches whose registers are maintained on
+write (see register_distinct_user in app.py). backfill_sketches() registers
+consents that were written before the sketches existed; schema migration 6
+runs it once.
+"""
+
+import hashlib
+import math
+import os
+import random
+from datetime import datetime
+
+from sqlalchemy import DateTime, bindparam, text
+
+SAMPLE_ROWS = int(os.getenv('APPROX_STATS_SAMPLE_ROWS', '10000'))
+CONFIDENCE_Z = 1.96  # 95% two-sided
+
+# HyperLogLog precision: 2**12 registers gives a standard error of ~1.6%.
+HLL_PRECISION = 12
+HLL_REGISTERS = 1 << HLL_PRECISION
+
+# Sketch key used for "any purpose"
+ALL_PURPOSES = 0
+
+PROBE_CHUNK = 500
+IN_FORCE = "(expires_at IS NULL OR expires_at > :now)"
+SKETCH_BACKFILL_BATCH = 50000
+
+
+def hll_register(value):
+    """Map a value to its (register index, rank) pair"""
+    digest = int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+    index = digest >> (64 - HLL_PRECISION)
+    remaining = digest & ((1 << (64 - HLL_PRECISION)) - 1)
+    rank = (64 - HLL_PRECISION) - remaining.bit_length() + 1
+    return index, rank
+
+
+def backfill_sketches(engine, batch_size=SKETCH_BACKFILL_BATCH):
+    """Register the user of every existing consent; returns the number of consents read.
+
+    Registers only ever grow, so this can run alongside live writes and be
+    repeated safely.
+    """
+    upsert = text(
+        "INSERT INTO hll_registers (purpose_id, register, rank) VALUES (:purpose_id, :register, :rank) "
+        "ON CONFLICT (purpose_id, register) DO UPDATE SET rank = excluded.rank "
+        "WHERE hll_registers.rank < excluded.rank"
+    )
+    last_id = 0
+    read = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(text(
+                "SELECT id, user_id, purpose_id FROM consents WHERE id > :last_id ORDER BY id LIMIT :limit"
+            ), {'last_id': last_id, 'limit': batch_size}).fetchall()
+            if not rows:
+                return read
+            ranks = {}
+            for _, user_id, purpose_id in rows:
+                index, rank = hll_register(user_id)
+                for key in ((purpose_id, index), (ALL_PURPOSES, index)):
+                    if ranks.get(key, 0) < rank:
+                        ranks[key] = rank
+            # Sorted, so concurrent writers lock registers in the same order
+            conn.execute(upsert, [
+                {'purpose_id': purpose_id, 'register': index, 'rank': rank}
+                for (purpose_id, index), rank in sorted(ranks.items())
+            ])
+        last_id = rows[-1][0]
+        read += len(rows)
+        if len(rows) < batch_size:
+            return read
+
+
+def hll_estimate(registers):
+    """Estimate cardinality from a sparse {index: rank} register map"""
+    m = HLL_REGISTERS
+    alpha = 0.7213 / (1 + 1.079 / m)
+    zeros = m - len(registers)
+    harmonic = zeros + sum(2.0 ** -rank for rank in registers.values())
+    estimate = alpha * m * m / harmonic
+    if estimate <= 2.5 * m and zeros:
+        # Small range correction: linear counting
+        estimate = m * math.log(m / zeros)
+    return int(round(estimate))
+
+
+def hll_standard_error():
+    return 1.04 / math.sqrt(HLL_REGISTERS)
+
+
+def wilson_interval(successes, n, z=CONFIDENCE_Z):
+    """Wilson score interval for a binomial proportion, as (low, high) in [0, 1]"""
+    if n == 0:
+        return 0.0, 1.0
+    p = successes / n
+    denominator = 1 + z * z / n
+    centre = (p + z * z / (2 * n)) / denominator
+    margin = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denominator
+    return max(0.0, centre - margin), min(1.0, centre + margin)
+
+
+def _exact_counts(conn, now):
+    rows = conn.execute(text(
+        "SELECT purpose_id, COUNT(*), SUM(CASE WHEN status THEN 1 ELSE 0 END) "
+        f"FROM consents WHERE {IN_FORCE} GROUP BY purpose_id"
+    ).bindparams(bindparam('now', type_=DateTime)), {'now': now}).fetchall()
+    return rows, sum(row[1] for row in rows), True
+
+
+def _sample_postgresql(conn, sample_rows, now):
+    """Aggregate a TABLESAMPLE SYSTEM sample sized from the planner estimate"""
+    estimated_rows = conn.execute(text(
+        "SELECT GREATEST(reltuples, 0)::bigint FROM pg_class WHERE oid = 'consents'::regclass"
+    )).scalar() or 0
+    if estimated_rows <= sample_rows:
+        # Small (or never analyzed) table: the exact answer is just as cheap.
+        return _exact_counts(conn, now)
+    percent = min(100.0, 100.0 * sample_rows / estimated_rows)
+    # One sample, split by whether the consent is in force, to scale the row estimate by
+    groups = conn.execute(text(
+        f"SELECT purpose_id, {IN_FORCE}, COUNT(*), SUM(CASE WHEN status THEN 1 ELSE 0 END) "
+        "FROM consents TABLESAMPLE SYSTEM (:percent) GROUP BY 1, 2"
+    ).bindparams(bindparam('now', type_=DateTime)), {'percent': percent, 'now': now}).fetchall()
+    sampled = sum(group[2] for group in groups)
+    rows = [(purpose_id, total, active) for purpose_id, current, total, active in groups if current]
+    in_force = sum(row[1] for row in rows)
+    return rows, int(round(estimated_rows * in_force / sampled)) if sampled else 0, False
+
+
+def _sample_by_key(conn, sample_rows, now):
+    """Aggregate rows found by probing random primary keys"""
+    low, high = conn.execute(text("SELECT MIN(id), MAX(id) FROM consents")).first()
+    if low is None:
+        return [], 0, True
+    key_range = high - low + 1
+    if key_range <= sample_rows:
+        return _exact_counts(conn, now)
+
+    ids = random.sample(range(low, high + 1), sample_rows)
+    counts = {}
+    hits = 0
+    for start in range(0, len(ids), PROBE_CHUNK):
+        chunk = ids[start:start + PROBE_CHUNK]
+        for purpose_id, status in conn.execute(text(
+            f"SELECT purpose_id, status FROM consents WHERE id IN ({', '.join(str(i) for i in chunk)}) "
+            f"AND {IN_FORCE}"
+        ).bindparams(bindparam('now', type_=DateTime)), {'now': now}):
+            total, active = counts.get(purpose_id, (0, 0))
+            counts[purpose_id] = (total + 1, active + (1 if status else 0))
+            hits += 1
+    # Deleted ids and expired rows leave gaps in the key range; scale by the observed hit rate.
+    estimated_total = int(round(key_range * hits / sample_rows))
+    rows = [(purpose_id, total, active) for purpose_id, (total, active) in counts.items()]
+    return rows, estimated_total, False
+
+
+def sample_consents(conn, sample_rows=SAMPLE_ROWS, now=None):
+    """Return ([(purpose_id, sampled, sampled_active)], estimated_total, exact) for consents in force"""
+    now = now or datetime.utcnow()
+    if conn.dialect.name == 'postgresql':
+        return _sample_postgresql(conn, sample_rows, now)
+    return _sample_by_key(conn, sample_rows, now)
+
+
+def load_sketches(conn):
+    """Load all HyperLogLog registers as {purpose_id: {index: rank}}"""
+    sketches = {}
+    for purpose_id, index, rank in conn.execute(text(
+        "SELECT purpose_id, register, rank FROM hll_registers"
+    )):
+        sketches.setdefault(purpose_id, {})[index] = rank
+    return sketches
+
+
+def approximate_stats(conn, purpose_names, sample_rows=SAMPLE_ROWS):
+    """Build the approximate statistics payload.
+
+    `purpose_names` maps purpose ids to names. Counts are scaled estimates;
+    every estimate has a matching `*_ci` 95% confidence interval.
+    """
+    rows, estimated_total, exact = sample_consents(conn, sample_rows)
+    sampled = sum(row[1] for row in rows)
+    sampled_active = sum(int(row[2] or 0) for row in rows)
+    sketches = load_sketches(conn)
+
+    def scaled(low, high):
+        return [int(round(low * estimated_total)), int(round(high * estimated_total))]
+
+    active_ci = wilson_interval(sampled_active, sampled)
+    active = int(round(estimated_total * sampled_active / sampled)) if sampled else 0
+
+    by_purpose = []
+    for purpose_id, purpose_total, purpose_active in sorted(rows):
+        purpose_active = int(purpose_active or 0)
+        share_ci = wilson_interval(purpose_total, sampled)
+        rate_ci = wilson_interval(purpose_active, purpose_total)
+        by_purpose.append({
+            'purpose_id': purpose_id,
+            'purpose_name': purpose_names.get(purpose_id, f"Purpose {purpose_id}"),
+            'total': int(round(estimated_total * purpose_total / sampled)),
+            'total_ci': scaled(*share_ci),
+            'active': int(round(estimated_total * purpose_active / sampled)),
+            'rate': purpose_active / purpose_total * 100 if purpose_total else 0,
+            'rate_ci': [rate_ci[0] * 100, rate_ci[1] * 100],
+            'distinct_users': hll_estimate(sketches.get(purpose_id, {})),
+            'sample_size': purpose_total
+        })
+
+    return {
+        'mode': 'approx',
+        'exact': exact,
+        'confidence': 0.95,
+        'sample_size': sampled,
+        'total_consents': estimated_total,
+        'active_consents': active,
+        'active_consents_ci': scaled(*active_ci),
+        'inactive_consents': estimated_total - active,
+        'consent_rate': sampled_active / sampled * 100 if sampled else 0,
+        'consent_rate_ci': [active_ci[0] * 100, active_ci[1] * 100],
+        'distinct_users': hll_estimate(sketches.get(ALL_PURPOSES, {})),
+        'distinct_users_error': hll_standard_error(),
+        'by_purpose': by_purpose
+    }
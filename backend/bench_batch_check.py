@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Benchmark for POST /api/consent/check/batch.
+
+Builds a throwaway SQLite database with synthetic consents, then times batch
+checks at several batch sizes against the equivalent number of single-user
+POST /api/consent/check calls. Uses the Flask test client, so the numbers
+cover routing, queries and JSON encoding but not the network.
+
+Usage:
+    python bench_batch_check.py
+    python bench_batch_check.py --users 200000 --purposes 8 --sizes 100 1000 10000
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the batch consent check endpoint')
+    parser.add_argument('--users', type=int, default=50000, help='users in the synthetic table')
+    parser.add_argument('--purposes', type=int, default=8)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(), 'bench_batch_check.db')
+    os.environ['DATABASE_URL'] = f'sqlite:///{db_path}'
+    os.environ['RATE_LIMIT_ENABLED'] = '0'
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from app import app, db, Consent, Purpose
+
+    rng = random.Random(42)
+    with app.app_context():
+        db.create_all()
+        db.session.add_all(Purpose(name=f"Purpose {i}", description='bench') for i in range(args.purposes))
+        db.session.commit()
+        purpose_ids = [p.id for p in Purpose.query.order_by(Purpose.id)]
+        rows = [
+            {'user_id': f'user-{u}', 'purpose_id': p, 'status': rng.random() < 0.6, 'ip_address': '10.0.0.1'}
+            for u in range(args.users) for p in purpose_ids if rng.random() < 0.8
+        ]
+        db.session.bulk_insert_mappings(Consent, rows)
+        db.session.execute(db.text('CREATE INDEX IF NOT EXISTS bench_user_purpose ON consents (user_id, purpose_id)'))
+        db.session.commit()
+    print(f"{len(rows)} consents for {args.users} users x {args.purposes} purposes")
+
+    client = app.test_client()
+    print(f"{'batch size':>10} {'batch ms':>10} {'pairs/s':>12} {'single ms (est)':>16} {'speedup':>8}")
+    for size in args.sizes:
+        batch_times = []
+        for _ in range(args.repeat):
+            users = [f'user-{rng.randrange(args.users)}' for _ in range(size)]
+            started = time.perf_counter()
+            response = client.post('/api/consent/check/batch', json={'user_ids': users, 'purpose_ids': purpose_ids})
+            batch_times.append(time.perf_counter() - started)
+            assert response.status_code == 200, response.get_data(as_text=True)
+        batch = min(batch_times)
+
+        # Single-user checks are timed on a sample and extrapolated
+        sample = min(size, 200)
+        started = time.perf_counter()
+        for _ in range(sample):
+            client.post('/api/consent/check', json={
+                'user_id': f'user-{rng.randrange(args.users)}', 'purpose_ids': purpose_ids
+            })
+        single = (time.perf_counter() - started) / sample * size
+
+        pairs = len(set(users)) * len(purpose_ids)
+        print(f"{size:>10} {batch * 1000:>10.1f} {pairs / batch:>12,.0f} {single * 1000:>16.1f} {single / batch:>7.0f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Benchmark for consent_client.py against plain `requests` calls.
+
+Serves the app from a throwaway SQLite database on a local threaded HTTP
+server. It then times the same workloads two ways: the ad-hoc pattern from
+test_api.py (a new connection and one request per call), and ConsentClient
+or AsyncConsentClient (pooled connections, auto-batched checks, cached reads).
+
+Workloads:
+- checks: one consent check per user, issued from a pool of threads
+- reads:  repeated GET /consent for a small set of hot users
+
+Usage:
+    python bench_client.py
+    python bench_client.py --users 5000 --checks 2000 --threads 32
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def timed(label, fn, calls):
+    started = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - started
+    print(f"{label:<44} {elapsed * 1000:>9.0f} ms {calls / elapsed:>10,.0f} calls/s")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Python client against plain requests')
+    parser.add_argument('--users', type=int, default=2000, help='users in the synthetic table')
+    parser.add_argument('--purposes', type=int, default=4)
+    parser.add_argument('--checks', type=int, default=1000, help='single-user checks per run')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--hot-users', type=int, default=20)
+    parser.add_argument('--rounds', type=int, default=20, help='reads of each hot user')
+    parser.add_argument('--port', type=int, default=5099)
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(), 'bench_client.db')
+    os.environ['DATABASE_URL'] = f'sqlite:///{db_path}'
+    os.environ['RATE_LIMIT_ENABLED'] = '0'
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from werkzeug.serving import make_server
+    from app import app, db, Consent, Purpose
+    from consent_client import AsyncConsentClient, ConsentClient
+
+    rng = random.Random(42)
+    with app.app_context():
+        db.create_all()
+        db.session.add_all(Purpose(name=f"Purpose {i}", description='bench') for i in range(args.purposes))
+        db.session.commit()
+        purpose_ids = [p.id for p in Purpose.query.order_by(Purpose.id)]
+        db.session.bulk_insert_mappings(Consent, [
+            {'user_id': f'user-{u}', 'purpose_id': p, 'status': rng.random() < 0.6, 'ip_address': '10.0.0.1'}
+            for u in range(args.users) for p in purpose_ids if rng.random() < 0.8
+        ])
+        db.session.execute(db.text('CREATE INDEX IF NOT EXISTS bench_user_purpose ON consents (user_id, purpose_id)'))
+        db.session.commit()
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', args.port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{args.port}/api'
+
+    users = [f'user-{rng.randrange(args.users)}' for _ in range(args.checks)]
+    hot = [f'user-{u}' for u in range(args.hot_users)]
+    reads = hot * args.rounds
+    print(f"{args.users} users x {args.purposes} purposes, {args.checks} checks, {len(reads)} reads, "
+          f"{args.threads} threads\n")
+
+    # Checks
+    def plain_check(user_id):
+        requests.post(f'{base_url}/consent/check', json={'user_id': user_id, 'purpose_ids': purpose_ids}).json()
+
+    with ThreadPoolExecutor(args.threads) as pool:
+        plain = timed('checks: plain requests', lambda: list(pool.map(plain_check, users)), len(users))
+
+    with ConsentClient(base_url, pool_size=args.threads, cache_ttl=0) as client:
+        with ThreadPoolExecutor(args.threads) as pool:
+            elapsed = timed('checks: ConsentClient.check (auto-batched)',
+                            lambda: list(pool.map(lambda u: client.check(u, purpose_ids), users)), len(users))
+        print(f"{'':<44} {plain / elapsed:>9.1f}x, {client.stats['requests']} HTTP requests")
+
+        elapsed = timed('checks: ConsentClient.check_many', lambda: client.check_many(users, purpose_ids),
+                        len(users))
+        print(f"{'':<44} {plain / elapsed:>9.1f}x")
+
+    async def async_checks():
+        async with AsyncConsentClient(base_url, max_workers=args.threads, cache_ttl=0) as client:
+            await asyncio.gather(*(client.check(u, purpose_ids) for u in users))
+
+    elapsed = timed('checks: AsyncConsentClient.check (gathered)', lambda: asyncio.run(async_checks()), len(users))
+    print(f"{'':<44} {plain / elapsed:>9.1f}x\n")
+
+    # Repeated reads of hot users
+    def plain_read(user_id):
+        requests.get(f'{base_url}/consent', params={'user_id': user_id}).json()
+
+    plain = timed('reads: plain requests', lambda: [plain_read(u) for u in reads], len(reads))
+
+    with ConsentClient(base_url, cache_ttl=0) as client:
+        # TTL 0: every read revalidates, unchanged users come back as 304
+        elapsed = timed('reads: ConsentClient, ETag revalidation only', lambda: [client.get_consents(u) for u in reads],
+                        len(reads))
+        print(f"{'':<44} {plain / elapsed:>9.1f}x, {client.stats['not_modified']} not modified")
+
+    with ConsentClient(base_url, cache_ttl=30) as client:
+        elapsed = timed('reads: ConsentClient, 30 s TTL cache', lambda: [client.get_consents(u) for u in reads],
+                        len(reads))
+        print(f"{'':<44} {plain / elapsed:>9.1f}x, {client.stats['requests']} HTTP requests")
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
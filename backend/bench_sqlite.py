@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the embedded SQLite backend (sqlite_edge.py).
+
+Runs the same concurrent workload against a throwaway SQLite file twice:
+once with plain pysqlite connections (SQLITE_EDGE=0) and once with the
+tuned edge settings. Each run is a separate process, because the mode is
+fixed when app.py is imported. Worker threads send a mix of consent writes
+(POST /api/consent, which also writes history) and consent
+checks (POST /api/consent/check) through the Flask test client. So the
+numbers cover routing, queries and commits, but not the network.
+
+Reported per mode: throughput, p50/p99 latency per operation, and errors
+("database is locked" and any other 5xx).
+
+Usage:
+    python bench_sqlite.py
+    python bench_sqlite.py --threads 8 --seconds 20 --write-ratio 0.3
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000
+
+
+def run_mode(args):
+    """Child process: run the workload in the mode set by SQLITE_EDGE and print JSON"""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from app import app, db, Consent, Purpose
+    from migrations import migrate
+    import sqlite_edge
+
+    with app.app_context():
+        migrate(db, log=lambda message: None)
+        db.session.add_all(Purpose(name=f"Purpose {i}", description='bench') for i in range(args.purposes))
+        db.session.commit()
+        purpose_ids = [p.id for p in Purpose.query.order_by(Purpose.id)]
+        db.session.bulk_insert_mappings(Consent, [
+            {'user_id': f'user-{u}', 'purpose_id': p, 'status': u % 3 != 0, 'ip_address': '10.0.0.1'}
+            for u in range(args.users) for p in purpose_ids
+        ])
+        db.session.commit()
+
+    latencies = {'write': [], 'read': []}
+    errors = {'locked': 0, 'other': 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.seconds
+
+    def worker(seed):
+        rng = random.Random(seed)
+        client = app.test_client()
+        mine = {'write': [], 'read': []}
+        locked = other = 0
+        while time.perf_counter() < deadline:
+            user_id = f'user-{rng.randrange(args.users)}'
+            kind = 'write' if rng.random() < args.write_ratio else 'read'
+            started = time.perf_counter()
+            if kind == 'write':
+                response = client.post('/api/consent', json={
+                    'user_id': user_id, 'purpose_id': rng.choice(purpose_ids), 'status': rng.random() < 0.5
+                })
+            else:
+                response = client.post('/api/consent/check', json={'user_id': user_id, 'purpose_ids': purpose_ids})
+            elapsed = time.perf_counter() - started
+            if response.status_code >= 500:
+                if 'locked' in response.get_data(as_text=True):
+                    locked += 1
+                else:
+                    other += 1
+            else:
+                mine[kind].append(elapsed)
+        with lock:
+            for kind in mine:
+                latencies[kind].extend(mine[kind])
+            errors['locked'] += locked
+            errors['other'] += other
+
+    threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    result = {
+        'writes_per_second': round(len(latencies['write']) / elapsed),
+        'reads_per_second': round(len(latencies['read']) / elapsed),
+        'write_p50_ms': round(_percentile(latencies['write'], 0.5), 2),
+        'write_p99_ms': round(_percentile(latencies['write'], 0.99), 2),
+        'read_p50_ms': round(_percentile(latencies['read'], 0.5), 2),
+        'read_p99_ms': round(_percentile(latencies['read'], 0.99), 2),
+        'locked_errors': errors['locked'],
+        'other_errors': errors['other'],
+    }
+    if sqlite_edge.enabled(app.config['SQLALCHEMY_DATABASE_URI']):
+        result['writer_queue'] = dict(sqlite_edge.writer_queue.stats, wait_ms=round(sqlite_edge.writer_queue.stats['wait_ms']))
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark default vs tuned SQLite under concurrent load')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--write-ratio', type=float, default=0.2, help='share of requests that write')
+    parser.add_argument('--users', type=int, default=20000, help='users with existing consents')
+    parser.add_argument('--purposes', type=int, default=4)
+    parser.add_argument('--run-mode', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_mode:
+        run_mode(args)
+        return
+
+    print(f"{args.threads} threads, {args.seconds:g} s, {args.write_ratio:.0%} writes, "
+          f"{args.users} users x {args.purposes} purposes")
+    results = {}
+    for mode, edge in (('default', '0'), ('edge', '1')):
+        db_path = os.path.join(tempfile.mkdtemp(), 'bench_sqlite.db')
+        env = dict(os.environ, DATABASE_URL=f'sqlite:///{db_path}', SQLITE_EDGE=edge,
+                   RATE_LIMIT_ENABLED='0', MAX_CONCURRENT_REQUESTS='1000', WARMUP_ON_START='0')
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--run-mode', '--threads', str(args.threads),
+             '--seconds', str(args.seconds), '--write-ratio', str(args.write_ratio),
+             '--users', str(args.users), '--purposes', str(args.purposes)],
+            env=env, check=True, capture_output=True, text=True
+        ).stdout
+        results[mode] = json.loads(output.strip().splitlines()[-1])
+
+    fields = ['writes_per_second', 'reads_per_second', 'write_p50_ms', 'write_p99_ms',
+              'read_p50_ms', 'read_p99_ms', 'locked_errors', 'other_errors']
+    print(f"{'':>20} {'default':>10} {'edge':>10}")
+    for field in fields:
+        print(f"{field:>20} {results['default'][field]:>10} {results['edge'][field]:>10}")
+    print(f"writer queue: {results['edge'].get('writer_queue')}")
+
+
+if __name__ == '__main__':
+    main()
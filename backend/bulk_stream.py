@@ -0,0 +1,153 @@
+"""
+Incremental parsing of large bulk consent payloads.
+
+The streamed bulk endpoint never holds the whole request body in memory.
+It reads the body in fixed-size blocks and turns it into events as the
+bytes arrive:
+
+    ('field', name, value)   a top-level JSON member other than `consents`
+    ('item', value)          one element of the `consents` array / one NDJSON line
+    ('invalid', message)     an NDJSON line that isn't valid JSON
+
+Two body formats are understood:
+
+- application/json, the regular bulk shape
+  {"user_id": ..., "consents": [{...}, ...]}. The `consents` array is decoded
+  one element at a time. Top-level members are reported when they are
+  reached, so `user_id` has to come before `consents` to apply to its items.
+  Malformed JSON raises BulkPayloadError at the point it is found; items
+  before it have already been yielded
+- application/x-ndjson, one item object per line. Lines are independent:
+  a bad line is reported as 'invalid' and the stream carries on. Blank
+  lines are skipped
+
+Memory is bounded by the block size plus the largest single item, which is
+capped at BULK_STREAM_MAX_ITEM_BYTES.
+"""
+
+import codecs
+import json
+import os
+
+BULK_STREAM_BLOCK_BYTES = 64 * 1024
+BULK_STREAM_MAX_ITEM_BYTES = int(os.getenv('BULK_STREAM_MAX_ITEM_BYTES', str(64 * 1024)))
+
+_WHITESPACE = ' \t\n\r'
+_NUMBER_CHARS = '0123456789+-.eE'
+
+
+class BulkPayloadError(ValueError):
+    """The body can't be parsed any further"""
+
+
+class _Reader:
+    """A sliding text window over a byte stream"""
+
+    def __init__(self, stream, block_bytes):
+        self.stream = stream
+        self.block_bytes = block_bytes
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        data = self.stream.read(self.block_bytes)
+        if not data:
+            self.eof = True
+        try:
+            text = self.decoder.decode(data, final=self.eof)
+        except UnicodeDecodeError as e:
+            raise BulkPayloadError(f'Body is not valid UTF-8: {e}') from None
+        # Drop what was consumed so the window only holds unparsed text
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+
+    def peek(self):
+        """Next non-whitespace character without consuming it; '' at the end"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                return ''
+            self._fill()
+
+    def take(self, expected):
+        char = self.peek()
+        # '' (end of body) is a substring of every string, so test it explicitly
+        if not char or char not in expected:
+            found = repr(char) if char else 'end of body'
+            raise BulkPayloadError(f"Expected {' or '.join(map(repr, expected))}, found {found}")
+        self.pos += 1
+        return char
+
+    def value(self, decoder=json.JSONDecoder()):
+        """Decode the JSON value starting at the next non-whitespace character"""
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+                # A number running into the end of the window may continue in the
+                # next block, also after a partial fraction or exponent ("2.", "1e-")
+                cut_number = isinstance(value, (int, float)) and not isinstance(value, bool) and \
+                    not self.buffer[end:].strip(_NUMBER_CHARS)
+                if self.eof or not cut_number:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError as e:
+                if self.eof:
+                    raise BulkPayloadError(f'Malformed JSON: {e.msg}') from None
+            if len(self.buffer) - self.pos > BULK_STREAM_MAX_ITEM_BYTES:
+                raise BulkPayloadError(f'JSON value exceeds {BULK_STREAM_MAX_ITEM_BYTES} bytes')
+            self._fill()
+
+
+def iter_json(stream, block_bytes=BULK_STREAM_BLOCK_BYTES):
+    """Events for a {"user_id": ..., "consents": [...]} body"""
+    reader = _Reader(stream, block_bytes)
+    reader.take('{')
+    if reader.peek() == '}':
+        reader.take('}')
+    else:
+        while True:
+            if reader.peek() != '"':
+                reader.take('"')
+            name = reader.value()
+            reader.take(':')
+            if name == 'consents':
+                reader.take('[')
+                if reader.peek() == ']':
+                    reader.take(']')
+                else:
+                    while True:
+                        yield ('item', reader.value())
+                        if reader.take(',]') == ']':
+                            break
+            else:
+                yield ('field', name, reader.value())
+            if reader.take(',}') == '}':
+                break
+    if reader.peek():
+        raise BulkPayloadError('Unexpected data after the JSON body')
+
+
+def iter_ndjson(stream, max_line_bytes=BULK_STREAM_MAX_ITEM_BYTES):
+    """Events for a newline-delimited JSON body, one item per line"""
+    while True:
+        line = stream.readline(max_line_bytes + 1)
+        if not line:
+            return
+        if len(line) > max_line_bytes and not line.endswith(b'\n'):
+            # Skip the rest of the oversized line
+            while line and not line.endswith(b'\n'):
+                line = stream.readline(BULK_STREAM_BLOCK_BYTES)
+            yield ('invalid', f'Line exceeds {max_line_bytes} bytes')
+            continue
+        if not line.strip():
+            continue
+        try:
+            yield ('item', json.loads(line))
+        except ValueError as e:
+            yield ('invalid', f'Malformed JSON: {e}')
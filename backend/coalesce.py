@@ -0,0 +1,98 @@
+"""
+Request coalescing for expensive, cacheable GETs.
+
+Concurrent identical requests share one in-flight computation: the first
+caller (the leader) runs the view while the others wait for its result. The
+result is then kept in a short micro-cache so bursts that arrive just after
+the leader finished are served without running the view again.
+
+Followers wait at most `wait_seconds` for the leader. Past that they get
+CoalesceTimeout, which the API answers with 503, rather than tying up a
+worker thread for as long as a stuck leader runs.
+
+Counters per route show how many requests were executed, collapsed into an
+in-flight call or served from the micro-cache, and how many followers gave
+up waiting.
+"""
+
+import threading
+import time
+
+
+class CoalesceTimeout(Exception):
+    """A follower waited longer than wait_seconds for the leader"""
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class Coalescer:
+    """Single-flight execution with a TTL micro-cache, keyed by request"""
+
+    def __init__(self, ttl_seconds=0.25, max_entries=1024, wait_seconds=None):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.wait_seconds = wait_seconds
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.cache = {}
+        self.stats = {}
+
+    def _count(self, name, field):
+        counters = self.stats.setdefault(name, {'requests': 0, 'executed': 0, 'collapsed': 0, 'cache_hits': 0,
+                                                'timeouts': 0})
+        if field != 'timeouts':
+            counters['requests'] += 1
+        counters[field] += 1
+
+    def run(self, name, key, compute, cacheable=lambda value: True):
+        """Return (value, source) where source is 'executed', 'collapsed' or 'cache'"""
+        now = time.monotonic()
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None and cached[0] > now:
+                self._count(name, 'cache_hits')
+                return cached[1], 'cache'
+            call = self.inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self.inflight[key] = _Call()
+                self._count(name, 'executed')
+            else:
+                self._count(name, 'collapsed')
+
+        if not leader:
+            if not call.done.wait(self.wait_seconds):
+                with self.lock:
+                    self._count(name, 'timeouts')
+                raise CoalesceTimeout(f"{name} is still being computed")
+            if call.error is not None:
+                raise call.error
+            return call.value, 'collapsed'
+
+        try:
+            call.value = compute()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+                if call.error is None and self.ttl_seconds > 0 and cacheable(call.value):
+                    if len(self.cache) >= self.max_entries:
+                        expired = time.monotonic()
+                        self.cache = {k: v for k, v in self.cache.items() if v[0] > expired}
+                        if len(self.cache) >= self.max_entries:
+                            self.cache.clear()
+                    self.cache[key] = (time.monotonic() + self.ttl_seconds, call.value)
+            call.done.set()
+        return call.value, 'executed'
+
+    def snapshot(self):
+        """Copy of the per-route counters"""
+        with self.lock:
+            return {name: dict(counters) for name, counters in self.stats.items()}
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""
+Cohort analytics over an in-memory consent snapshot.
+
+Answers questions the per-purpose group-by in get_consent_stats can't, such
+as "of users who opted into Analytics, what fraction also opted into
+Personalization" or "how correlated are two purposes".
+
+The snapshot is one row per user, bit-packed into the smallest unsigned
+integer type that fits the purpose catalog (uint8 for up to 8 purposes).
+Bit i of `granted` / `recorded` refers to purpose_ids[i]. A uint16 holds the
+user's cohort, the month of their first consent. With 8 purposes, 10M users
+take about 40 MB.
+
+Everything after loading is vectorized:
+- co-consent counts are X.T @ X over blocks of unpacked rows
+- conditional rates and phi correlations are derived from those counts
+- segment breakdowns are bincounts
+
+Loading streams `consents` ordered by user_id in chunks, through a
+server-side cursor where the driver supports one, so memory is bounded by
+the snapshot and not by the result set.
+
+Requires numpy, an optional dependency used only by this module.
+
+Usage:
+    python cohort_analytics.py
+    python cohort_analytics.py --segment 2        # split by the answer to purpose 2
+    python cohort_analytics.py --json
+    python cohort_analytics.py --synthetic 10000000 --purposes 8
+"""
+
+import argparse
+import json
+import time
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import Boolean, DateTime, Integer, String, bindparam, text
+
+LOAD_CHUNK_ROWS = 100000
+# Rows unpacked per matrix product. float32 sums stay exact below 2**24.
+BLOCK_ROWS = 1 << 20
+NO_COHORT = np.iinfo(np.uint16).max
+
+SEGMENT_ANSWERS = ('unanswered', 'denied', 'granted')
+
+
+def _bit_dtype(purpose_count):
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if purpose_count <= np.dtype(dtype).itemsize * 8:
+            return dtype
+    raise ValueError('Snapshots support at most 64 purposes')
+
+
+class Snapshot:
+    """Bit-packed user x purpose consent matrix"""
+
+    def __init__(self, purpose_ids, purpose_names, granted, recorded, cohorts, generated_at=None):
+        self.purpose_ids = list(purpose_ids)
+        self.purpose_names = list(purpose_names)
+        self.granted = granted
+        self.recorded = recorded
+        self.cohorts = cohorts
+        self.generated_at = generated_at or datetime.utcnow()
+
+    @property
+    def users(self):
+        return len(self.granted)
+
+    @property
+    def nbytes(self):
+        return self.granted.nbytes + self.recorded.nbytes + self.cohorts.nbytes
+
+    def bit(self, purpose_id):
+        return self.purpose_ids.index(purpose_id)
+
+    def unpack(self, start, stop, which='granted'):
+        """Rows start:stop as a float32 0/1 matrix, one column per purpose"""
+        values = getattr(self, which)[start:stop]
+        shifts = np.arange(len(self.purpose_ids), dtype=values.dtype)
+        return ((values[:, None] >> shifts) & 1).astype(np.float32)
+
+    def column(self, purpose_id, which='granted'):
+        values = getattr(self, which)
+        return (values >> values.dtype.type(self.bit(purpose_id))) & 1
+
+
+class _SnapshotBuilder:
+    """Accumulates user_id-ordered consent rows into growing per-user arrays"""
+
+    def __init__(self, purpose_ids, capacity=1 << 16):
+        self.dtype = _bit_dtype(len(purpose_ids))
+        self.bit_of = np.zeros(max(purpose_ids, default=0) + 1, dtype=np.int64)
+        self.bit_of[purpose_ids] = np.arange(len(purpose_ids))
+        self.granted = np.zeros(capacity, dtype=self.dtype)
+        self.recorded = np.zeros(capacity, dtype=self.dtype)
+        self.cohorts = np.full(capacity, NO_COHORT, dtype=np.uint16)
+        self.count = 0
+        self.last_user = None
+
+    def _reserve(self, needed):
+        capacity = len(self.granted)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        grow = capacity - len(self.granted)
+        self.granted = np.concatenate([self.granted, np.zeros(grow, dtype=self.dtype)])
+        self.recorded = np.concatenate([self.recorded, np.zeros(grow, dtype=self.dtype)])
+        self.cohorts = np.concatenate([self.cohorts, np.full(grow, NO_COHORT, dtype=np.uint16)])
+
+    def add(self, rows):
+        user_ids, purpose_ids, statuses, created = zip(*rows)
+        user_ids = np.array(user_ids, dtype=object)
+        bits = (np.ones(len(user_ids), dtype=self.dtype) << self.bit_of[list(purpose_ids)].astype(self.dtype))
+        granted = np.where(np.array(statuses, dtype=bool), bits, self.dtype(0))
+        months = np.array(created, dtype='datetime64[M]').astype(np.int64).clip(0, NO_COHORT - 1)
+
+        # Rows are ordered by user, so each user is one contiguous segment;
+        # the first may continue the last user of the previous chunk.
+        new_user = np.empty(len(user_ids), dtype=bool)
+        new_user[0] = user_ids[0] != self.last_user
+        new_user[1:] = user_ids[1:] != user_ids[:-1]
+        starts = np.flatnonzero(new_user)
+        first = self.count
+        if not new_user[0]:
+            starts = np.concatenate([[0], starts])
+            first -= 1
+        targets = first + np.arange(len(starts))
+
+        self._reserve(targets[-1] + 1)
+        self.recorded[targets] |= np.bitwise_or.reduceat(bits, starts)
+        self.granted[targets] |= np.bitwise_or.reduceat(granted, starts)
+        self.cohorts[targets] = np.minimum(self.cohorts[targets], np.minimum.reduceat(months, starts))
+        self.count = targets[-1] + 1
+        self.last_user = user_ids[-1]
+
+    def finish(self, purpose_ids, purpose_names):
+        n = self.count
+        return Snapshot(purpose_ids, purpose_names, self.granted[:n].copy(), self.recorded[:n].copy(),
+                        self.cohorts[:n].copy())
+
+
+def load_snapshot(engine, now=None, chunk_rows=LOAD_CHUNK_ROWS):
+    """Build a snapshot of unexpired consents"""
+    now = now or datetime.utcnow()
+    query = text(
+        "SELECT user_id, purpose_id, status, created_at FROM consents "
+        "WHERE expires_at IS NULL OR expires_at > :now ORDER BY user_id"
+    ).bindparams(bindparam('now', type_=DateTime)).columns(
+        user_id=String, purpose_id=Integer, status=Boolean, created_at=DateTime
+    )
+    with engine.connect() as conn:
+        purposes = conn.execute(text("SELECT id, name FROM purposes ORDER BY id")).all()
+        purpose_ids = [row[0] for row in purposes]
+        builder = _SnapshotBuilder(purpose_ids)
+        result = conn.execution_options(stream_results=True).execute(query, {'now': now})
+        while True:
+            rows = result.fetchmany(chunk_rows)
+            if not rows:
+                break
+            builder.add(rows)
+    return builder.finish(purpose_ids, [row[1] for row in purposes])
+
+
+def synthetic_snapshot(users, purposes=8, seed=42):
+    """Random snapshot with correlated purposes, for sizing and benchmarks"""
+    rng = np.random.default_rng(seed)
+    dtype = _bit_dtype(purposes)
+    # One latent propensity per user makes purposes positively correlated
+    propensity = rng.random(users, dtype=np.float32)
+    granted = np.zeros(users, dtype=dtype)
+    recorded = np.zeros(users, dtype=dtype)
+    for bit in range(purposes):
+        base = 0.3 + 0.5 * bit / max(1, purposes - 1)
+        answered = rng.random(users, dtype=np.float32) < 0.9
+        yes = rng.random(users, dtype=np.float32) < base * (0.5 + propensity)
+        recorded |= answered.astype(dtype) << dtype(bit)
+        granted |= (answered & yes).astype(dtype) << dtype(bit)
+    first_month = (datetime.utcnow().year - 1970) * 12 + datetime.utcnow().month - 36
+    cohorts = (first_month + rng.integers(0, 36, users)).astype(np.uint16)
+    ids = list(range(1, purposes + 1))
+    return Snapshot(ids, [f"Purpose {i}" for i in ids], granted, recorded, cohorts)
+
+
+def co_consent(snapshot, block_rows=BLOCK_ROWS):
+    """counts[i, j] = users granting both purposes i and j; the diagonal is opt-ins"""
+    size = len(snapshot.purpose_ids)
+    counts = np.zeros((size, size), dtype=np.int64)
+    for start in range(0, snapshot.users, block_rows):
+        x = snapshot.unpack(start, start + block_rows)
+        counts += np.rint(x.T @ x).astype(np.int64)
+    return counts
+
+
+def conditional_rates(counts):
+    """rates[i, j] = P(granted j | granted i); NaN where nobody granted i"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return counts / np.diag(counts)[:, None]
+
+
+def phi_correlation(counts, users):
+    """Phi (Pearson on 0/1) correlation between purposes' opt-ins across users"""
+    opt_ins = np.diag(counts).astype(np.float64)
+    spread = np.sqrt(opt_ins * (users - opt_ins))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (users * counts - np.outer(opt_ins, opt_ins)) / np.outer(spread, spread)
+
+
+def answered_counts(snapshot):
+    return np.array([int(snapshot.column(p, 'recorded').sum()) for p in snapshot.purpose_ids], dtype=np.int64)
+
+
+def breakdown(snapshot, segments, labels):
+    """Per-segment users, answers and opt-ins per purpose; `segments` is one small int per user"""
+    size = len(labels)
+    users = np.bincount(segments, minlength=size)
+    answered = np.stack([np.bincount(segments, weights=snapshot.column(p, 'recorded'), minlength=size)
+                         for p in snapshot.purpose_ids], axis=1)
+    opt_ins = np.stack([np.bincount(segments, weights=snapshot.column(p), minlength=size)
+                        for p in snapshot.purpose_ids], axis=1)
+    return [
+        {
+            'segment': label,
+            'users': int(users[i]),
+            'answered': answered[i].astype(np.int64).tolist(),
+            'opt_ins': opt_ins[i].astype(np.int64).tolist(),
+            'opt_in_rate': _rates(opt_ins[i], answered[i])
+        }
+        for i, label in enumerate(labels) if users[i]
+    ]
+
+
+def cohort_segments(snapshot):
+    """Segment users by the month of their first consent"""
+    first = int(snapshot.cohorts.min()) if snapshot.users else 0
+    segments = (snapshot.cohorts - first).astype(np.int64)
+    labels = [f"{1970 + (first + i) // 12}-{(first + i) % 12 + 1:02d}" for i in range(int(segments.max(initial=0)) + 1)]
+    return segments, labels
+
+
+def purpose_segments(snapshot, purpose_id):
+    """Segment users by their answer to one purpose"""
+    segments = (snapshot.column(purpose_id, 'recorded') + snapshot.column(purpose_id)).astype(np.int64)
+    return segments, list(SEGMENT_ANSWERS)
+
+
+def _rates(numerators, denominators):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rates = np.asarray(numerators, dtype=np.float64) / np.asarray(denominators, dtype=np.float64)
+    return _json_matrix(rates)
+
+
+def _json_matrix(values):
+    """Round to 4 places with NaN as null"""
+    rounded = np.round(values, 4).astype(object)
+    rounded[np.isnan(values)] = None
+    return rounded.tolist()
+
+
+def report(snapshot, segment='cohort'):
+    """All cohort analytics for a snapshot as a JSON-ready dict"""
+    started = time.perf_counter()
+    counts = co_consent(snapshot)
+    if segment == 'cohort':
+        segments, labels = cohort_segments(snapshot)
+    else:
+        segments, labels = purpose_segments(snapshot, int(segment))
+
+    return {
+        'generated_at': snapshot.generated_at.isoformat(),
+        'users': snapshot.users,
+        'purposes': [{'id': p, 'name': n} for p, n in zip(snapshot.purpose_ids, snapshot.purpose_names)],
+        'opt_ins': np.diag(counts).tolist(),
+        'opt_in_rate': _rates(np.diag(counts), answered_counts(snapshot)),
+        # Row i: users who granted purpose i; column j: the other purpose
+        'co_consent': counts.tolist(),
+        'conditional_rate': _json_matrix(conditional_rates(counts)),
+        'correlation': _json_matrix(phi_correlation(counts, snapshot.users)),
+        'segment_by': segment,
+        'segments': breakdown(snapshot, segments, labels),
+        'compute_seconds': round(time.perf_counter() - started, 3)
+    }
+
+
+def print_report(result):
+    names = [p['name'] for p in result['purposes']]
+    width = max(12, max((len(n) for n in names), default=0) + 2)
+    print(f"{result['users']:,} users, snapshot {result['generated_at']}, "
+          f"computed in {result['compute_seconds']} s\n")
+    print(f"{'purpose':<{width}} {'opt-ins':>12} {'rate':>7}")
+    for name, opt_ins, rate in zip(names, result['opt_ins'], result['opt_in_rate']):
+        print(f"{name:<{width}} {opt_ins:>12,} {rate if rate is not None else '-':>7}")
+
+    for title, key in (('P(column | row)', 'conditional_rate'), ('Phi correlation', 'correlation')):
+        print(f"\n{title}")
+        print(' ' * width + ''.join(f"{p['id']:>8}" for p in result['purposes']))
+        for name, row in zip(names, result[key]):
+            print(f"{name:<{width}}" + ''.join(f"{v if v is not None else '-':>8}" for v in row))
+
+    print(f"\nOpt-in rate by {result['segment_by']}")
+    print(f"{'segment':<12} {'users':>12}" + ''.join(f"{p['id']:>8}" for p in result['purposes']))
+    for row in result['segments']:
+        print(f"{row['segment']:<12} {row['users']:>12,}" +
+              ''.join(f"{v if v is not None else '-':>8}" for v in row['opt_in_rate']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Co-consent, conditional rate and segment analytics')
+    parser.add_argument('--segment', default='cohort', help="'cohort' or a purpose id (default: %(default)s)")
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    parser.add_argument('--synthetic', type=int, metavar='USERS', help='use random data instead of the database')
+    parser.add_argument('--purposes', type=int, default=8, help='purposes in the synthetic snapshot')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    if args.synthetic:
+        snapshot = synthetic_snapshot(args.synthetic, args.purposes)
+    else:
+        from app import app, db
+
+        with app.app_context():
+            snapshot = load_snapshot(db.engine)
+    loaded = time.perf_counter() - started
+    if args.segment != 'cohort' and int(args.segment) not in snapshot.purpose_ids:
+        parser.error(f"Unknown purpose id {args.segment}")
+
+    result = report(snapshot, args.segment)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print(f"Snapshot: {snapshot.users:,} users in {snapshot.nbytes / 2**20:.1f} MB, loaded in {loaded:.2f} s")
+        print_report(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,409 @@
+"""
+Python client for the Consent Management API.
+
+Use one client per process instead of ad-hoc requests.get/post calls:
+
+- A pooled keep-alive requests.Session, so calls reuse TCP connections.
+  Connection errors, 429 and 503 are retried, honouring Retry-After. Writes
+  carry an Idempotency-Key, which makes retrying them safe.
+- check() calls made around the same time, from many threads, are collected
+  for `batch_window` seconds and sent as one POST /consent/check/batch.
+  check_many() batches explicitly.
+- Purposes and per-user consents are cached for `cache_ttl` seconds. Stale
+  entries are revalidated with If-None-Match, so an unchanged resource costs
+  a body-less 304. Writes through the client invalidate the user's entry.
+
+AsyncConsentClient offers the same calls for asyncio code. It runs them on
+a small thread pool over the same pooled session, so it needs no extra
+dependency. Concurrent check() coroutines are batched on the event loop.
+
+Usage:
+    with ConsentClient('http://localhost:5000/api') as client:
+        client.get_purposes()
+        client.has_consent('user123', 1)
+        client.check_many(['user123', 'user456'], [1, 2, 3])
+
+    async with AsyncConsentClient('http://localhost:5000/api') as client:
+        await asyncio.gather(*(client.has_consent(u, 1) for u in users))
+"""
+
+import asyncio
+import functools
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_BASE_URL = 'http://localhost:5000/api'
+BATCH_MAX_USERS = 1000
+BATCH_MAX_PURPOSES = 52  # Server limit for /consent/check/batch
+CACHE_MAX_ENTRIES = 10000
+
+
+class ConsentAPIError(Exception):
+    """Raised for error responses from the API"""
+
+    def __init__(self, status_code, message):
+        super().__init__(f"HTTP {status_code}: {message}")
+        self.status_code = status_code
+        self.message = message
+
+
+class _TTLCache:
+    """LRU-bounded (expires_at, etag, value) entries; stale ones are kept for revalidation"""
+
+    def __init__(self, ttl, max_entries=CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns (fresh, etag, value) or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            expires_at, etag, value = entry
+            return expires_at > time.monotonic(), etag, value
+
+    def put(self, key, etag, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, etag, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class _PendingCheck:
+    def __init__(self, user_id, purpose_ids):
+        self.user_id = user_id
+        self.purpose_ids = purpose_ids
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def _batch_arguments(calls):
+    user_ids = list(dict.fromkeys(call.user_id for call in calls))
+    purpose_ids = sorted({p for call in calls for p in call.purpose_ids})
+    return user_ids, purpose_ids
+
+
+def _slice_result(results, call):
+    statuses = results.get(call.user_id, {})
+    return {purpose_id: statuses.get(purpose_id) for purpose_id in call.purpose_ids}
+
+
+class _Batcher:
+    """Collects check() calls from many threads into one batch request.
+
+    The first caller of a round waits `window` seconds, then sends everything
+    that queued up meanwhile; the others just wait for their slice.
+    """
+
+    def __init__(self, check_many, window, max_users):
+        self.check_many = check_many
+        self.window = window
+        self.max_users = max_users
+        self.lock = threading.Lock()
+        self.pending = []
+
+    def submit(self, user_id, purpose_ids):
+        call = _PendingCheck(user_id, purpose_ids)
+        with self.lock:
+            self.pending.append(call)
+            leader = len(self.pending) == 1
+            batch = self._take() if len(self.pending) >= self.max_users else None
+
+        if batch:
+            self._run(batch)
+        elif leader:
+            time.sleep(self.window)
+            with self.lock:
+                batch = self._take()
+            if batch:
+                self._run(batch)
+
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _take(self):
+        batch, self.pending = self.pending, []
+        return batch
+
+    def _run(self, batch):
+        try:
+            results = self.check_many(*_batch_arguments(batch))
+        except Exception as e:
+            for call in batch:
+                call.error = e
+                call.done.set()
+            return
+        for call in batch:
+            call.result = _slice_result(results, call)
+            call.done.set()
+
+
+class ConsentClient:
+    """Thread-safe synchronous client; share one instance per process"""
+
+    def __init__(self, base_url=DEFAULT_BASE_URL, api_key=None, timeout=10.0, cache_ttl=30.0,
+                 pool_size=10, retries=3, batch_window=0.005, max_batch_users=BATCH_MAX_USERS):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=Retry(
+            total=retries,
+            backoff_factor=0.2,
+            status_forcelist=(429, 503),
+            # POSTs are either reads (checks) or carry an Idempotency-Key
+            allowed_methods=frozenset({'GET', 'POST', 'DELETE'}),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        ))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if api_key:
+            self.session.headers['X-API-Key'] = api_key
+
+        self.max_batch_users = max_batch_users
+        self.purposes_cache = _TTLCache(cache_ttl)
+        self.consents_cache = _TTLCache(cache_ttl)
+        self.batcher = _Batcher(self.check_many, batch_window, max_batch_users) if batch_window > 0 else None
+        self.stats = {'requests': 0, 'cache_hits': 0, 'not_modified': 0, 'batched_checks': 0}
+
+    def _request(self, method, path, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        self.stats['requests'] += 1
+        response = self.session.request(method, f"{self.base_url}{path}", **kwargs)
+        if response.status_code >= 400:
+            try:
+                message = response.json().get('error', response.text)
+            except ValueError:
+                message = response.text
+            raise ConsentAPIError(response.status_code, message)
+        return response
+
+    def _cached_get(self, cache, key, path, params=None):
+        entry = cache.get(key)
+        headers = {}
+        if entry is not None:
+            fresh, etag, value = entry
+            if fresh:
+                self.stats['cache_hits'] += 1
+                return value
+            if etag:
+                headers['If-None-Match'] = etag
+
+        response = self._request('GET', path, params=params, headers=headers)
+        if response.status_code == 304:
+            self.stats['not_modified'] += 1
+            cache.put(key, entry[1], entry[2])
+            return entry[2]
+        value = response.json()
+        cache.put(key, response.headers.get('ETag'), value)
+        return value
+
+    # Reads
+    def get_purposes(self):
+        return self._cached_get(self.purposes_cache, 'all', '/purposes')
+
+    def get_consents(self, user_id):
+        """All consent records for a user"""
+        return self._cached_get(self.consents_cache, user_id, '/consent', params={'user_id': user_id})
+
+    def check_many(self, user_ids, purpose_ids):
+        """{user_id: {purpose_id: True/False/None}} for every pair, in as few requests as possible"""
+        user_ids = list(dict.fromkeys(user_ids))
+        purpose_ids = list(dict.fromkeys(purpose_ids))
+        results = {user_id: {} for user_id in user_ids}
+        for p_start in range(0, len(purpose_ids), BATCH_MAX_PURPOSES):
+            purposes = purpose_ids[p_start:p_start + BATCH_MAX_PURPOSES]
+            for u_start in range(0, len(user_ids), self.max_batch_users):
+                data = self._request('POST', '/consent/check/batch', json={
+                    'user_ids': user_ids[u_start:u_start + self.max_batch_users],
+                    'purpose_ids': purposes
+                }).json()
+                for user_id, granted, recorded in zip(data['user_ids'], data['granted'], data['recorded']):
+                    statuses = results[user_id]
+                    for bit, purpose_id in enumerate(data['purpose_ids']):
+                        statuses[purpose_id] = bool(granted >> bit & 1) if recorded >> bit & 1 else None
+        return results
+
+    def sync(self, watermark=None, limit=1000):
+        """One page of consent changes after a {'seq', 'id'} watermark (None = from the start)"""
+        params = {'limit': limit}
+        if watermark and watermark.get('seq') is not None:
+            params['seq'] = watermark['seq']
+            if watermark.get('id') is not None:
+                params['id'] = watermark['id']
+        return self._request('GET', '/consent/sync', params=params).json()
+
+    def _check_cached(self, user_id, purpose_ids):
+        entry = self.consents_cache.get(user_id)
+        if entry is None or not entry[0]:
+            return None
+        self.stats['cache_hits'] += 1
+        statuses = {consent['purpose_id']: consent['status'] for consent in entry[2]}
+        return {purpose_id: statuses.get(purpose_id) for purpose_id in purpose_ids}
+
+    def check(self, user_id, purpose_ids):
+        """{purpose_id: True/False/None} for one user (None = never answered)"""
+        purpose_ids = list(purpose_ids)
+        cached = self._check_cached(user_id, purpose_ids)
+        if cached is not None:
+            return cached
+        if self.batcher is None:
+            return self.check_many([user_id], purpose_ids)[user_id]
+        self.stats['batched_checks'] += 1
+        return self.batcher.submit(user_id, purpose_ids)
+
+    def has_consent(self, user_id, purpose_id):
+        return self.check(user_id, [purpose_id])[purpose_id] is True
+
+    # Writes
+    def update_consent(self, user_id, purpose_id, status, idempotency_key=None):
+        try:
+            return self._request('POST', '/consent', json={
+                'user_id': user_id, 'purpose_id': purpose_id, 'status': status
+            }, headers={'Idempotency-Key': idempotency_key or str(uuid.uuid4())}).json()
+        finally:
+            self.consents_cache.invalidate(user_id)
+
+    def bulk_update(self, user_id, statuses, idempotency_key=None):
+        """Set several consents from a {purpose_id: status} mapping"""
+        try:
+            return self._request('POST', '/consent/bulk', json={
+                'user_id': user_id,
+                'consents': [{'purpose_id': p, 'status': s} for p, s in statuses.items()]
+            }, headers={'Idempotency-Key': idempotency_key or str(uuid.uuid4())}).json()
+        finally:
+            self.consents_cache.invalidate(user_id)
+
+    def delete_user_consents(self, user_id):
+        try:
+            return self._request('DELETE', f'/consent/user/{user_id}').json()
+        finally:
+            self.consents_cache.invalidate(user_id)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AsyncConsentClient:
+    """asyncio interface over a pooled ConsentClient"""
+
+    def __init__(self, base_url=DEFAULT_BASE_URL, max_workers=8, batch_window=0.005,
+                 max_batch_users=BATCH_MAX_USERS, **kwargs):
+        self.client = ConsentClient(base_url, pool_size=max_workers, batch_window=0,
+                                    max_batch_users=max_batch_users, **kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.batch_window = batch_window
+        self.max_batch_users = max_batch_users
+        self.pending = []
+        self.flush_handle = None
+        self.tasks = set()
+
+    async def _call(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    async def get_purposes(self):
+        return await self._call(self.client.get_purposes)
+
+    async def get_consents(self, user_id):
+        return await self._call(self.client.get_consents, user_id)
+
+    async def check_many(self, user_ids, purpose_ids):
+        return await self._call(self.client.check_many, user_ids, purpose_ids)
+
+    async def sync(self, watermark=None, limit=1000):
+        return await self._call(self.client.sync, watermark, limit)
+
+    async def check(self, user_id, purpose_ids):
+        purpose_ids = list(purpose_ids)
+        cached = self.client._check_cached(user_id, purpose_ids)
+        if cached is not None:
+            return cached
+        if self.batch_window <= 0:
+            return (await self.check_many([user_id], purpose_ids))[user_id]
+
+        loop = asyncio.get_running_loop()
+        call = _PendingCheck(user_id, purpose_ids)
+        call.future = loop.create_future()
+        self.pending.append(call)
+        if len(self.pending) >= self.max_batch_users:
+            self._flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.batch_window, self._flush)
+        return await call.future
+
+    def _flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, batch):
+        try:
+            results = await self.check_many(*_batch_arguments(batch))
+        except Exception as e:
+            for call in batch:
+                if not call.future.done():
+                    call.future.set_exception(e)
+            return
+        for call in batch:
+            if not call.future.done():
+                call.future.set_result(_slice_result(results, call))
+
+    async def has_consent(self, user_id, purpose_id):
+        return (await self.check(user_id, [purpose_id]))[purpose_id] is True
+
+    async def update_consent(self, user_id, purpose_id, status, idempotency_key=None):
+        return await self._call(self.client.update_consent, user_id, purpose_id, status, idempotency_key)
+
+    async def bulk_update(self, user_id, statuses, idempotency_key=None):
+        return await self._call(self.client.bulk_update, user_id, statuses, idempotency_key)
+
+    async def delete_user_consents(self, user_id):
+        return await self._call(self.client.delete_user_consents, user_id)
+
+    async def close(self):
+        self._flush()
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.executor.shutdown(wait=True)
+        self.client.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
@@ -0,0 +1,484 @@
+#!/usr/bin/env python3
+"""
+Memory-mapped, read-only consent index for hot status lookups.
+
+A periodically rebuilt, immutable file with one entry per user. Entries are
+sorted by a 64-bit blake2b hash of the user id, and each one carries a
+packed purpose bitmask. Workers open it with mmap, so every process on a
+host shares the same page-cache copy. Opening is constant time whatever the
+file size, and a lookup touches a handful of pages.
+
+File layout (little-endian, each section 8-byte aligned):
+
+    header      64 bytes   magic, version, purpose count, mask width, user
+                           count, ambiguous count, built_at, change_seq
+    purposes    128 bytes  up to 64 uint16 purpose ids; bit i refers to entry i
+    keys        8n         sorted uint64 user hashes
+    ambiguous   8a         sorted hashes shared by two different users
+    valid_until 4n         uint32 unix seconds of each user's earliest expiry
+    granted     wn         purpose bitmasks, w = 1, 2, 4 or 8 bytes
+    recorded    wn
+
+Because the hashes are uniform, lookups use interpolation search and take
+two or three probes even at 10M users. Hash collisions are very rare; at
+10M users the chance of any is about 3 in a million. Colliding hashes go
+to the ambiguous section, and lookups for them fall back to the database,
+as do lookups for users whose earliest consent expiry has passed.
+
+`change_seq` is the consent_history sequence the build was taken at. The
+API overlays change-feed rows above it (see ChangeOverlay), so answers lag
+writes by about CONSENT_INDEX_OVERLAY_SECONDS and not by the rebuild
+interval. The overlay holds at most CONSENT_INDEX_OVERLAY_MAX_ENTRIES
+changed consents; past that it is dropped and lookups go to the database
+until a rebuild replaces the file.
+
+Building requires numpy; lookups only need the standard library.
+
+Usage:
+    python consent_index.py build --output consent_index.bin
+    python consent_index.py lookup user123 --index consent_index.bin
+    python consent_index.py bench --users 10000000 --purposes 8
+"""
+
+import argparse
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from datetime import datetime
+
+MAGIC = b'CIDX'
+VERSION = 1
+HEADER = struct.Struct('<4sHHHHQQQQ')
+HEADER_SIZE = 64
+MAX_PURPOSES = 64
+PURPOSES_SIZE = MAX_PURPOSES * 2
+DATA_OFFSET = HEADER_SIZE + PURPOSES_SIZE
+NO_EXPIRY = 0xFFFFFFFF
+MASK_FORMATS = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+BUILD_CHUNK_ROWS = 100000
+OVERLAY_MAX_ENTRIES = 100000
+
+# Lookup results that are not an entry
+MISSING = None
+AMBIGUOUS = 'ambiguous'
+
+logger = logging.getLogger(__name__)
+
+
+def user_key(user_id):
+    """64-bit hash the index is sorted by"""
+    return int.from_bytes(hashlib.blake2b(user_id.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def _mask_width(purpose_count):
+    for width in (1, 2, 4, 8):
+        if purpose_count <= width * 8:
+            return width
+    raise ValueError(f'The index supports at most {MAX_PURPOSES} purposes')
+
+
+def _padded(size):
+    return (size + 7) & ~7
+
+
+def write_index(path, purpose_ids, keys, granted, recorded, valid_until, change_seq=0, built_at=None):
+    """Sort entries by key and write them to `path` atomically"""
+    import numpy as np
+
+    width = _mask_width(len(purpose_ids))
+    dtype = np.dtype(f'<u{width}')
+    keys = np.asarray(keys, dtype='<u8')
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    granted = np.asarray(granted, dtype=dtype)[order]
+    recorded = np.asarray(recorded, dtype=dtype)[order]
+    valid_until = np.asarray(valid_until, dtype='<u4')[order]
+
+    # Two users with one hash can't share an entry; keep neither
+    duplicate = np.zeros(len(keys), dtype=bool)
+    if len(keys) > 1:
+        same = keys[1:] == keys[:-1]
+        duplicate[1:] |= same
+        duplicate[:-1] |= same
+    ambiguous = np.unique(keys[duplicate])
+    if len(ambiguous):
+        keep = ~duplicate
+        keys, granted, recorded, valid_until = keys[keep], granted[keep], recorded[keep], valid_until[keep]
+
+    header = HEADER.pack(MAGIC, VERSION, len(purpose_ids), width, 0, len(keys), len(ambiguous),
+                         int(built_at if built_at is not None else time.time()), change_seq)
+    purposes = struct.pack(f'<{len(purpose_ids)}H', *purpose_ids)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(header.ljust(HEADER_SIZE, b'\0'))
+        f.write(purposes.ljust(PURPOSES_SIZE, b'\0'))
+        for section in (keys, ambiguous, valid_until, granted, recorded):
+            data = section.tobytes()
+            f.write(data.ljust(_padded(len(data)), b'\0'))
+        f.flush()
+        os.fsync(f.fileno())
+    # Readers holding the old file keep their mapping until they reopen
+    os.replace(tmp_path, path)
+    return {'users': len(keys), 'ambiguous': len(ambiguous), 'bytes': os.path.getsize(path)}
+
+
+class ConsentIndex:
+    """Read-only view over an index file"""
+
+    def __init__(self, path):
+        if sys.byteorder != 'little':
+            raise RuntimeError('Consent index files are little-endian')
+        self.path = path
+        with open(path, 'rb') as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, purpose_count, width, _, self.count, ambiguous_count,
+         self.built_at, self.change_seq) = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            self._mmap.close()
+            raise ValueError(f'{path} is not a version {VERSION} consent index')
+        self.purpose_ids = list(struct.unpack_from(f'<{purpose_count}H', self._mmap, HEADER_SIZE))
+        self.bit_of = {purpose_id: bit for bit, purpose_id in enumerate(self.purpose_ids)}
+
+        self._view = view = memoryview(self._mmap)
+        offset = DATA_OFFSET
+        sections = []
+        for itemsize, fmt, length in ((8, 'Q', self.count), (8, 'Q', ambiguous_count), (4, 'I', self.count),
+                                      (width, MASK_FORMATS[width], self.count),
+                                      (width, MASK_FORMATS[width], self.count)):
+            sections.append(view[offset:offset + itemsize * length].cast(fmt))
+            offset += _padded(itemsize * length)
+        self._keys, self._ambiguous, self._valid_until, self._granted, self._recorded = sections
+
+    def close(self):
+        for section in (self._keys, self._ambiguous, self._valid_until, self._granted, self._recorded):
+            section.release()
+        self._view.release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def _find(keys, key):
+        lo, hi = 0, len(keys) - 1
+        while lo <= hi:
+            lo_key, hi_key = keys[lo], keys[hi]
+            if key < lo_key or key > hi_key:
+                return -1
+            if lo_key == hi_key:
+                mid = lo
+            else:
+                mid = lo + (key - lo_key) * (hi - lo) // (hi_key - lo_key)
+            found = keys[mid]
+            if found == key:
+                return mid
+            if found < key:
+                lo = mid + 1
+            else:
+                hi = mid - 1
+        return -1
+
+    def lookup(self, user_id, now=None):
+        """(granted, recorded) masks, MISSING if the user had no consents, or
+        AMBIGUOUS if the index can't answer and the database must"""
+        key = user_key(user_id)
+        position = self._find(self._keys, key)
+        if position < 0:
+            if self._ambiguous and self._find(self._ambiguous, key) >= 0:
+                return AMBIGUOUS
+            return MISSING
+        if self._valid_until[position] <= (now if now is not None else time.time()):
+            return AMBIGUOUS
+        return self._granted[position], self._recorded[position]
+
+    def statuses(self, user_id, purpose_ids, now=None):
+        """{purpose_id: True/False/None} as of the build, or AMBIGUOUS"""
+        entry = self.lookup(user_id, now)
+        if entry is AMBIGUOUS:
+            return AMBIGUOUS
+        granted, recorded = entry if entry is not MISSING else (0, 0)
+        result = {}
+        for purpose_id in purpose_ids:
+            bit = self.bit_of.get(purpose_id)
+            if bit is None or not recorded >> bit & 1:
+                result[purpose_id] = None
+            else:
+                result[purpose_id] = bool(granted >> bit & 1)
+        return result
+
+
+class ChangeOverlay:
+    """Consent changes after an index build, replayed from the change feed.
+
+    Once more than `max_entries` consents have changed, the overlay is
+    dropped and marked overflowed: the index is then too far behind to be
+    worth patching, and the database answers until the next build.
+    """
+
+    def __init__(self, since, max_entries=OVERLAY_MAX_ENTRIES):
+        self.since = since
+        self.max_entries = max_entries
+        self.changes = {}
+        self.overflowed = False
+        self.refreshed_at = None
+        self.lock = threading.Lock()
+
+    def apply(self, rows):
+        for row in rows:
+            # Deleted and expired consents read as absent, like on the database path
+            status = None if row.event in ('delete', 'expire') else row.status
+            self.changes[(row.user_id, row.purpose_id)] = status
+            self.since = row.seq
+        if len(self.changes) > self.max_entries:
+            logger.warning('Consent index overlay passed %d changes; checks use the database until the '
+                           'index is rebuilt', self.max_entries)
+            self.overflowed = True
+            self.changes = {}
+
+    def refresh(self, fetch_changes, max_age, limit=1000):
+        """Pull new changes if the last refresh is older than max_age seconds"""
+        if self.overflowed:
+            return
+        if self.refreshed_at is not None and time.monotonic() - self.refreshed_at < max_age:
+            return
+        # One request thread refreshes; the others answer from what is already applied
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            while not self.overflowed:
+                rows, has_more = fetch_changes(self.since, limit)
+                self.apply(rows)
+                if not has_more:
+                    break
+            self.refreshed_at = time.monotonic()
+        finally:
+            self.lock.release()
+
+    def overlay(self, user_id, statuses):
+        for purpose_id in statuses:
+            key = (user_id, purpose_id)
+            if key in self.changes:
+                statuses[purpose_id] = self.changes[key]
+        return statuses
+
+
+class IndexReader:
+    """An index file plus its overlay, reopened when the file is replaced"""
+
+    def __init__(self, path, fetch_changes, refresh_seconds=1.0, reload_seconds=30.0,
+                 max_overlay_entries=OVERLAY_MAX_ENTRIES):
+        self.path = path
+        self.fetch_changes = fetch_changes
+        self.refresh_seconds = refresh_seconds
+        self.reload_seconds = reload_seconds
+        self.max_overlay_entries = max_overlay_entries
+        self.index = None
+        self.overlay = None
+        self.checked_at = None
+        self.lock = threading.Lock()
+
+    def _current(self):
+        now = time.monotonic()
+        if self.index is not None and now - self.checked_at < self.reload_seconds:
+            return self.index, self.overlay
+        with self.lock:
+            if self.index is None or now - self.checked_at >= self.reload_seconds:
+                self.checked_at = now
+                try:
+                    inode = os.stat(self.path).st_ino
+                except FileNotFoundError:
+                    inode = None
+                if inode is not None and (self.index is None or inode != self.index.inode):
+                    # The old mapping is left to the garbage collector; requests
+                    # still using it finish against the previous build
+                    self.index = ConsentIndex(self.path)
+                    self.overlay = ChangeOverlay(self.index.change_seq, self.max_overlay_entries)
+        return self.index, self.overlay
+
+    def statuses(self, user_id, purpose_ids):
+        """{purpose_id: status} for the user, or None if the database must answer"""
+        index, overlay = self._current()
+        if index is None:
+            return None
+        overlay.refresh(self.fetch_changes, self.refresh_seconds)
+        if overlay.overflowed:
+            return None
+        statuses = index.statuses(user_id, purpose_ids)
+        if statuses is AMBIGUOUS:
+            return None
+        return overlay.overlay(user_id, statuses)
+
+
+def _valid_until(expires_at):
+    if expires_at is None:
+        return NO_EXPIRY
+    return min(int((expires_at - datetime(1970, 1, 1)).total_seconds()), NO_EXPIRY - 1)
+
+
+def build_from_database(engine, path, chunk_rows=BUILD_CHUNK_ROWS):
+    """Snapshot unexpired consents into an index file"""
+    from array import array
+
+    from sqlalchemy import Boolean, DateTime, Integer, String, bindparam, text
+
+    from sequencer import sequence_changes
+
+    now = datetime.utcnow()
+    query = text(
+        "SELECT user_id, purpose_id, status, expires_at FROM consents "
+        "WHERE expires_at IS NULL OR expires_at > :now ORDER BY user_id"
+    ).bindparams(bindparam('now', type_=DateTime)).columns(
+        user_id=String, purpose_id=Integer, status=Boolean, expires_at=DateTime
+    )
+    # Changes numbered before the snapshot starts have committed and are in
+    # it; anything later is replayed by the overlay, and replaying a change
+    # already included is harmless
+    sequence_changes(engine)
+    seq_query = text("SELECT MAX(seq) FROM consent_history")
+    keys, granted, recorded, valid_until = array('Q'), array('Q'), array('Q'), array('I')
+    with engine.connect() as conn:
+        change_seq = conn.execute(seq_query).scalar() or 0
+        purpose_ids = [row[0] for row in conn.execute(text("SELECT id FROM purposes ORDER BY id"))]
+        bit_of = {purpose_id: 1 << bit for bit, purpose_id in enumerate(purpose_ids)}
+        _mask_width(len(purpose_ids))
+        result = conn.execution_options(stream_results=True).execute(query, {'now': now})
+        last_user = None
+        while True:
+            rows = result.fetchmany(chunk_rows)
+            if not rows:
+                break
+            for user_id, purpose_id, status, expires_at in rows:
+                if user_id != last_user:
+                    keys.append(user_key(user_id))
+                    granted.append(0)
+                    recorded.append(0)
+                    valid_until.append(NO_EXPIRY)
+                    last_user = user_id
+                bit = bit_of[purpose_id]
+                recorded[-1] |= bit
+                if status:
+                    granted[-1] |= bit
+                if expires_at is not None:
+                    valid_until[-1] = min(valid_until[-1], _valid_until(expires_at))
+    summary = write_index(path, purpose_ids, keys, granted, recorded, valid_until, change_seq=change_seq)
+    summary['change_seq'] = change_seq
+    return summary
+
+
+def build_synthetic(path, users, purposes=8, seed=42):
+    """Random index for `user-<n>` ids, for sizing and benchmarks"""
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    dtype = np.dtype(f'<u{_mask_width(purposes)}')
+    recorded = rng.integers(0, 1 << purposes, users, dtype=np.uint64).astype(dtype)
+    granted = recorded & rng.integers(0, 1 << purposes, users, dtype=np.uint64).astype(dtype)
+    keys = np.fromiter((user_key(f"user-{i}") for i in range(users)), dtype=np.uint64, count=users)
+    valid_until = np.full(users, NO_EXPIRY, dtype=np.uint32)
+    return write_index(path, list(range(1, purposes + 1)), keys, granted, recorded, valid_until)
+
+
+def _memory_mb():
+    """(private, file-backed) resident MB; file-backed pages are shared page cache"""
+    fields = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            if name in ('RssAnon', 'RssFile'):
+                fields[name] = int(value.split()[0]) / 1024
+    return fields.get('RssAnon', 0.0), fields.get('RssFile', 0.0)
+
+
+def _bench_worker(args):
+    path, users, lookups, seed = args
+    import random
+
+    rng = random.Random(seed)
+    # Half existing users, half unknown ids
+    ids = [f"user-{rng.randrange(users)}" if i % 2 else f"nobody-{i}" for i in range(lookups)]
+    private, mapped = _memory_mb()
+    started = time.perf_counter()
+    index = ConsentIndex(path)
+    opened = time.perf_counter() - started
+    started = time.perf_counter()
+    for user_id in ids:
+        index.lookup(user_id)
+    elapsed = time.perf_counter() - started
+    after_private, after_mapped = _memory_mb()
+    index.close()
+    return opened, lookups / elapsed, after_private - private, after_mapped - mapped
+
+
+def bench(path, users, purposes, lookups, processes):
+    from multiprocessing import Pool
+
+    started = time.perf_counter()
+    summary = build_synthetic(path, users, purposes)
+    print(f"Built {summary['users']:,} users ({summary['ambiguous']} ambiguous) in "
+          f"{time.perf_counter() - started:.1f} s, {summary['bytes'] / 2**20:.1f} MB")
+
+    opened, rate, private, mapped = _bench_worker((path, users, lookups, 0))
+    print(f"1 process: opened in {opened * 1000:.2f} ms, {rate:,.0f} lookups/s; after {lookups:,} lookups "
+          f"+{private:.1f} MB private, +{mapped:.1f} MB mapped from the page cache")
+    if processes > 1:
+        with Pool(processes) as pool:
+            results = pool.map(_bench_worker, [(path, users, lookups, seed) for seed in range(processes)])
+        print(f"{processes} processes: {sum(r[1] for r in results):,.0f} lookups/s total, "
+              f"+{max(r[2] for r in results):.1f} MB private each at most; mapped pages are shared")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build, query and benchmark the mmap consent index')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='snapshot the database into an index file')
+    build.add_argument('--output', default=os.getenv('CONSENT_INDEX_PATH', 'consent_index.bin'),
+                       help='index file to replace (default: %(default)s)')
+    build.add_argument('--chunk-rows', type=int, default=BUILD_CHUNK_ROWS)
+    lookup = commands.add_parser('lookup', help="print a user's indexed statuses")
+    lookup.add_argument('user_id')
+    lookup.add_argument('--index', default=os.getenv('CONSENT_INDEX_PATH', 'consent_index.bin'))
+    benchmark = commands.add_parser('bench', help='benchmark a synthetic index')
+    benchmark.add_argument('--users', type=int, default=10000000)
+    benchmark.add_argument('--purposes', type=int, default=8)
+    benchmark.add_argument('--lookups', type=int, default=200000)
+    benchmark.add_argument('--processes', type=int, default=1)
+    benchmark.add_argument('--output', default='consent_index_bench.bin')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        from app import app, db
+
+        started = time.perf_counter()
+        with app.app_context():
+            summary = build_from_database(db.engine, args.output, args.chunk_rows)
+        print(f"✓ Indexed {summary['users']:,} users at change {summary['change_seq']} into {args.output} "
+              f"({summary['bytes'] / 2**20:.1f} MB) in {time.perf_counter() - started:.1f} s")
+    elif args.command == 'lookup':
+        with ConsentIndex(args.index) as index:
+            statuses = index.statuses(args.user_id, index.purpose_ids)
+            built = datetime.utcfromtimestamp(index.built_at).isoformat()
+            if statuses is AMBIGUOUS:
+                print(f"{args.user_id}: not answerable from the index built at {built}")
+            else:
+                print(f"{args.user_id} as of {built}:")
+                for purpose_id, status in statuses.items():
+                    print(f"  purpose {purpose_id}: {status}")
+    else:
+        try:
+            bench(args.output, args.users, args.purposes, args.lookups, args.processes)
+        finally:
+            if os.path.exists(args.output):
+                os.remove(args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+"""
+Compact signed consent tokens.
+
+A token carries one user's purpose-status vector so edge code can answer "does
+user X consent to purpose Y" without calling the API or the database. It is
+similar in spirit to a TCF consent string:
+
+    version      1 byte
+    catalog      4 bytes  purpose catalog version the vector was built from
+    issued_at    4 bytes  unix seconds
+    expires_at   4 bytes  unix seconds
+    user         8 bytes  BLAKE2b fingerprint of the user id
+    first_id     2 bytes  purpose id of bit 0
+    count        1 byte   number of purpose bits
+    granted      ceil(count / 8) bytes
+    recorded     ceil(count / 8) bytes
+    signature    16 bytes truncated HMAC-SHA256 over everything above
+
+encoded as unpadded base64url. Revocations are handled by short lifetimes
+plus a RevocationList of (user fingerprint, revoked_at) pairs: a token is
+rejected if it was issued before its user's latest revocation. revoked_at is
+rounded up to the next second, and tokens minted after a revocation are
+issued at no earlier than that time, so they are never rejected by it.
+
+This module only depends on the standard library so it can be imported
+outside the Flask app.
+"""
+
+import base64
+import hashlib
+import hmac
+import struct
+import time
+
+VERSION = 1
+SIGNATURE_BYTES = 16
+DEFAULT_LIFETIME_SECONDS = 900
+
+_HEADER = struct.Struct('>BIII8sHB')
+_REVOCATION = struct.Struct('>8sI')
+
+
+class InvalidToken(ValueError):
+    """Raised for tokens that are malformed, forged or expired"""
+
+
+def user_fingerprint(user_id):
+    return hashlib.blake2b(user_id.encode('utf-8'), digest_size=8).digest()
+
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    try:
+        return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+    except (ValueError, TypeError) as e:
+        raise InvalidToken('Token is not valid base64url') from e
+
+
+def _sign(secret, payload):
+    return hmac.new(secret, payload, hashlib.sha256).digest()[:SIGNATURE_BYTES]
+
+
+def _secret_bytes(secret):
+    return secret.encode('utf-8') if isinstance(secret, str) else secret
+
+
+class ConsentToken:
+    """A verified token"""
+
+    __slots__ = ('catalog_version', 'issued_at', 'expires_at', 'fingerprint', 'first_id', 'count',
+                 'granted', 'recorded')
+
+    def __init__(self, catalog_version, issued_at, expires_at, fingerprint, first_id, count, granted, recorded):
+        self.catalog_version = catalog_version
+        self.issued_at = issued_at
+        self.expires_at = expires_at
+        self.fingerprint = fingerprint
+        self.first_id = first_id
+        self.count = count
+        self.granted = granted
+        self.recorded = recorded
+
+    def belongs_to(self, user_id):
+        return hmac.compare_digest(self.fingerprint, user_fingerprint(user_id))
+
+    def status(self, purpose_id):
+        """True/False for a recorded consent, None if the user never answered"""
+        bit = purpose_id - self.first_id
+        if bit < 0 or bit >= self.count or not (self.recorded >> bit) & 1:
+            return None
+        return bool((self.granted >> bit) & 1)
+
+    def has_consent(self, purpose_id):
+        return self.status(purpose_id) is True
+
+
+def encode_token(secret, user_id, statuses, catalog_version, issued_at=None,
+                 lifetime=DEFAULT_LIFETIME_SECONDS):
+    """Build a token from a {purpose_id: status} mapping"""
+    issued_at = int(issued_at if issued_at is not None else time.time())
+    first_id = min(statuses) if statuses else 0
+    count = max(statuses) - first_id + 1 if statuses else 0
+    if count > 255 or first_id > 0xFFFF:
+        raise ValueError('Purpose ids must span at most 255 values below 65536')
+
+    granted = recorded = 0
+    for purpose_id, status in statuses.items():
+        bit = 1 << (purpose_id - first_id)
+        recorded |= bit
+        if status:
+            granted |= bit
+    width = (count + 7) // 8
+    payload = _HEADER.pack(VERSION, catalog_version & 0xFFFFFFFF, issued_at, issued_at + lifetime,
+                           user_fingerprint(user_id), first_id, count) + \
+        granted.to_bytes(width, 'little') + recorded.to_bytes(width, 'little')
+    return _b64encode(payload + _sign(_secret_bytes(secret), payload))
+
+
+def decode_token(secret, token, now=None):
+    """Verify a token's signature and lifetime and return a ConsentToken"""
+    raw = _b64decode(token)
+    if len(raw) < _HEADER.size + SIGNATURE_BYTES:
+        raise InvalidToken('Token is too short')
+    payload, signature = raw[:-SIGNATURE_BYTES], raw[-SIGNATURE_BYTES:]
+    if not hmac.compare_digest(signature, _sign(_secret_bytes(secret), payload)):
+        raise InvalidToken('Token signature does not match')
+
+    version, catalog_version, issued_at, expires_at, fingerprint, first_id, count = \
+        _HEADER.unpack_from(payload)
+    if version != VERSION:
+        raise InvalidToken(f'Unsupported token version {version}')
+    width = (count + 7) // 8
+    if len(payload) != _HEADER.size + 2 * width:
+        raise InvalidToken('Token length does not match its purpose count')
+    if (now if now is not None else time.time()) >= expires_at:
+        raise InvalidToken('Token has expired')
+
+    offset = _HEADER.size
+    granted = int.from_bytes(payload[offset:offset + width], 'little')
+    recorded = int.from_bytes(payload[offset + width:], 'little')
+    return ConsentToken(catalog_version, issued_at, expires_at, fingerprint, first_id, count, granted, recorded)
+
+
+class RevocationList:
+    """Latest revocation time per user fingerprint"""
+
+    def __init__(self, entries=None):
+        self.entries = dict(entries or {})
+
+    def add(self, user_id, revoked_at):
+        fingerprint = user_fingerprint(user_id)
+        self.entries[fingerprint] = max(int(revoked_at), self.entries.get(fingerprint, 0))
+
+    def is_revoked(self, token):
+        revoked_at = self.entries.get(token.fingerprint)
+        return revoked_at is not None and token.issued_at < revoked_at
+
+    def to_string(self):
+        return _b64encode(b''.join(_REVOCATION.pack(f, t) for f, t in sorted(self.entries.items())))
+
+    @classmethod
+    def from_string(cls, text):
+        raw = _b64decode(text) if text else b''
+        if len(raw) % _REVOCATION.size:
+            raise ValueError('Revocation list has a truncated entry')
+        return cls(_REVOCATION.iter_unpack(raw))
+
+
+def check_consent(secret, token, user_id, purpose_id, revocations=None, now=None):
+    """Evaluate consent from a token alone; anything unverifiable counts as no consent"""
+    try:
+        decoded = decode_token(secret, token, now=now)
+    except InvalidToken:
+        return False
+    if not decoded.belongs_to(user_id):
+        return False
+    if revocations is not None and revocations.is_revoked(decoded):
+        return False
+    return decoded.has_consent(purpose_id)
@@ -82,5 +82,14 @@ def create_database():
         if 'conn' in locals():
             conn.close()
 
+def migrate_schema():
+    """Create missing tables and apply pending schema migrations"""
+    from app import app, db
+    from migrations import migrate
+
+    with app.app_context():
+        migrate(db)
+
 if __name__ == "__main__":
-    create_database() 
\ No newline at end of file
+    create_database()
+    migrate_schema() 
\ No newline at end of file
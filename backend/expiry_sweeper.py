@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Expiry sweeper for consents.
+
+Consents for purposes with a lifetime policy get an expires_at when they are
+given. Read paths already treat expired rows as absent; this job records
+each expiry as an 'expire' event, so history, rollups, webhooks and token
+revocation see it like any other withdrawal. The row itself is kept and
+marked with expired_at; the next write for the user and purpose clears it.
+Unswept rows are found through the partial ix_consents_expiry_pending index
+in small batches. Run it from cron or as the scheduled `consent_expiry`
+Lambda.
+
+Usage:
+    python expiry_sweeper.py
+    python expiry_sweeper.py --batch-size 200 --dry-run
+"""
+
+import argparse
+import os
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SWEEP_BATCH_SIZE = int(os.getenv('CONSENT_EXPIRY_SWEEP_BATCH', '500'))
+
+
+def expired_query(now):
+    from app import Consent
+
+    # The IS NOT NULL / IS NULL predicates match the partial index
+    return Consent.query.filter(
+        Consent.expires_at.isnot(None),
+        Consent.expired_at.is_(None),
+        Consent.expires_at <= now
+    )
+
+
+def sweep(batch_size=SWEEP_BATCH_SIZE, now=None):
+    """Expire consents past their expires_at; returns the number expired"""
+    from app import Consent, commit_changes, record_consent_change
+
+    now = now or datetime.utcnow()
+    expired = 0
+    while True:
+        # SKIP LOCKED lets concurrent sweepers split the work on PostgreSQL
+        consents = expired_query(now).order_by(Consent.expires_at).limit(batch_size).with_for_update(
+            skip_locked=True
+        ).all()
+        if not consents:
+            return expired
+        for consent in consents:
+            record_consent_change(consent, 'expire')
+            consent.expired_at = now
+        commit_changes()
+        expired += len(consents)
+        if len(consents) < batch_size:
+            return expired
+
+
+def handler(event, context):
+    """Lambda entry point for the scheduled sweep"""
+    from app import app
+
+    with app.app_context():
+        return {'expired': sweep()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Expire consents past their re-collection date')
+    parser.add_argument('--batch-size', type=int, default=SWEEP_BATCH_SIZE,
+                        help='consents expired per transaction (default: %(default)s)')
+    parser.add_argument('--dry-run', action='store_true', help='only count expired consents')
+    args = parser.parse_args()
+
+    from app import app
+
+    with app.app_context():
+        if args.dry_run:
+            print(f"Would expire {expired_query(datetime.utcnow()).count()} consents")
+            return
+        expired = sweep(batch_size=args.batch_size)
+    print(f"✓ Expired {expired} consents")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Columnar snapshot export of consents to Parquet.
+
+Streams `consents` joined with `purposes` through a server-side cursor in
+chunks. Rows are written as Hive-partitioned Parquet files:
+
+    <output>/purpose_id=<id>/month=<YYYY-MM>/part-0.parquet
+
+`month` is the month of the consent's updated_at; rows without one go to
+month=__HIVE_DEFAULT_PARTITION__, which readers load as a null month. user_id and purpose_name
+are dictionary-encoded. Each purpose is read in updated_at order, so only
+one partition file is open per worker, and memory stays bounded by
+--chunk-rows whatever the table size. With --workers > 1, purposes are
+exported in parallel processes. Each process opens its own database
+connection.
+
+The output loads directly into DuckDB, pyarrow or pandas; the partition
+columns come from the paths:
+
+    duckdb:  SELECT * FROM read_parquet('consents_parquet/**/*.parquet', hive_partitioning = true)
+    pandas:  pandas.read_parquet('consents_parquet')
+
+The database comes from DATABASE_URL (or .env), as for the app; the app
+itself is not imported.
+
+Requires pyarrow, an optional dependency used only by this tool.
+
+Usage:
+    python export_parquet.py --output consents_parquet
+    python export_parquet.py --output consents_parquet --workers 4 --chunk-rows 200000 --overwrite
+"""
+
+import argparse
+import os
+import shutil
+import time
+from bisect import bisect_left
+from datetime import datetime
+from multiprocessing import Pool
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+from sqlalchemy import Boolean, DateTime, Integer, String, bindparam, create_engine, text
+
+load_dotenv()
+
+CHUNK_ROWS = int(os.getenv('PARQUET_EXPORT_CHUNK_ROWS', '100000'))
+# Hive's name for a null partition value; pyarrow, DuckDB and Spark read it back as null
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+SCHEMA = pa.schema([
+    ('id', pa.int64()),
+    ('user_id', pa.dictionary(pa.int32(), pa.string())),
+    ('purpose_name', pa.dictionary(pa.int32(), pa.string())),
+    ('status', pa.bool_()),
+    ('ip_address', pa.string()),
+    ('created_at', pa.timestamp('us')),
+    ('updated_at', pa.timestamp('us')),
+    ('expires_at', pa.timestamp('us')),
+])
+
+QUERY = text(
+    "SELECT c.id, c.user_id, p.name, c.status, c.ip_address, c.created_at, c.updated_at, c.expires_at "
+    "FROM consents c JOIN purposes p ON p.id = c.purpose_id "
+    "WHERE c.purpose_id = :purpose_id ORDER BY c.updated_at, c.id"
+).bindparams(bindparam('purpose_id', type_=Integer)).columns(
+    id=Integer, user_id=String, name=String, status=Boolean, ip_address=String,
+    created_at=DateTime, updated_at=DateTime, expires_at=DateTime
+)
+
+
+def database_url():
+    """DATABASE_URL with the same pg8000 driver the app uses"""
+    return os.getenv('DATABASE_URL', '').replace('postgresql://', 'postgresql+pg8000://')
+
+
+def _month_run(rows, start):
+    """(partition key, end) of the run of rows[start:] in the same updated_at month"""
+    first = rows[start].updated_at
+    if first is None:
+        # NULLs sort together, first or last depending on the database
+        end = start
+        while end < len(rows) and rows[end].updated_at is None:
+            end += 1
+        return NULL_PARTITION, end
+    next_month = datetime(first.year + first.month // 12, first.month % 12 + 1, 1)
+    end = bisect_left(rows, next_month, lo=start, key=lambda row: row.updated_at or datetime.max)
+    return f"{first:%Y-%m}", end
+
+
+def _table(rows):
+    columns = list(zip(*rows))
+    return pa.Table.from_arrays(
+        [pa.array(values, type=field.type) if not pa.types.is_dictionary(field.type)
+         else pa.array(values, type=pa.string()).dictionary_encode()
+         for values, field in zip(columns, SCHEMA)],
+        schema=SCHEMA
+    )
+
+
+def export_purpose(database_url, purpose_id, output, chunk_rows=CHUNK_ROWS):
+    """Write one purpose's partitions; returns (purpose_id, rows, files, seconds)"""
+    started = time.perf_counter()
+    engine = create_engine(database_url)
+    rows_written = files = 0
+    writer = month = None
+    try:
+        with engine.connect() as conn:
+            result = conn.execution_options(stream_results=True, max_row_buffer=chunk_rows).execute(
+                QUERY, {'purpose_id': purpose_id}
+            )
+            while True:
+                rows = result.fetchmany(chunk_rows)
+                if not rows:
+                    break
+                # Rows arrive in updated_at order, so each month is one contiguous
+                # run whose end can be found by binary search
+                start = 0
+                while start < len(rows):
+                    key, end = _month_run(rows, start)
+                    if key != month:
+                        if writer is not None:
+                            writer.close()
+                        directory = os.path.join(output, f"purpose_id={purpose_id}", f"month={key}")
+                        os.makedirs(directory, exist_ok=True)
+                        writer = pq.ParquetWriter(os.path.join(directory, 'part-0.parquet'), SCHEMA,
+                                                  compression='zstd', use_dictionary=['user_id', 'purpose_name'])
+                        month = key
+                        files += 1
+                    writer.write_table(_table(rows[start:end]))
+                    rows_written += end - start
+                    start = end
+    finally:
+        if writer is not None:
+            writer.close()
+        engine.dispose()
+    return purpose_id, rows_written, files, time.perf_counter() - started
+
+
+def _export_task(args):
+    return export_purpose(*args)
+
+
+def export(database_url, output, workers=1, chunk_rows=CHUNK_ROWS):
+    """Export every purpose; returns a summary dict"""
+    engine = create_engine(database_url)
+    try:
+        with engine.connect() as conn:
+            purpose_ids = [row[0] for row in conn.execute(text("SELECT id FROM purposes ORDER BY id"))]
+    finally:
+        engine.dispose()
+
+    started = time.perf_counter()
+    tasks = [(database_url, purpose_id, output, chunk_rows) for purpose_id in purpose_ids]
+    if workers > 1:
+        with Pool(workers) as pool:
+            results = list(pool.imap_unordered(_export_task, tasks))
+    else:
+        results = [_export_task(task) for task in tasks]
+    elapsed = time.perf_counter() - started
+
+    for purpose_id, rows, files, seconds in sorted(results):
+        rate = rows / seconds if seconds else 0
+        print(f"  purpose {purpose_id}: {rows:,} rows in {files} files, {rate:,.0f} rows/s")
+    total = sum(result[1] for result in results)
+    return {
+        'rows': total,
+        'files': sum(result[2] for result in results),
+        'seconds': round(elapsed, 3),
+        'rows_per_second': round(total / elapsed) if elapsed else 0
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export consents as partitioned Parquet')
+    parser.add_argument('--output', default='consents_parquet', help='output directory (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=1, help='parallel processes, one purpose each')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS,
+                        help='rows fetched and written per step (default: %(default)s)')
+    parser.add_argument('--overwrite', action='store_true', help='replace an existing output directory')
+    args = parser.parse_args()
+
+    url = database_url()
+    if not url:
+        parser.error('DATABASE_URL is not set')
+    if os.path.isdir(args.output) and os.listdir(args.output):
+        if not args.overwrite:
+            parser.error(f"{args.output} is not empty; pass --overwrite to replace it")
+        shutil.rmtree(args.output)
+    os.makedirs(args.output, exist_ok=True)
+
+    print(f"Exporting consents to {args.output} with {args.workers} worker(s)")
+    summary = export(url, args.output, workers=args.workers, chunk_rows=args.chunk_rows)
+    print(f"✓ Exported {summary['rows']:,} rows to {summary['files']} files in {summary['seconds']} s "
+          f"({summary['rows_per_second']:,} rows/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+"""
+Synthetic consent data at production scale.
+
+seed_data.py only creates the four demo purposes. This generator fills the
+database with configurable numbers of purposes and users, with realistic
+shapes:
+
+- opt-in and answer rates that differ by purpose and correlate within a
+  user (one latent propensity per user)
+- sign-ups spread over --years and skewed towards recent months (growth)
+- consents given some days after sign-up, a geometric number of later
+  updates each, and the full create/update trail in consent_history
+- IP addresses drawn from a pool in which ~30% of users share a few
+  carrier or office NAT addresses, with ~15% IPv6 and ~20% of consents
+  given from a second address
+- expires_at for purposes with a consent lifetime, so some rows are
+  already expired
+
+With partitioned history, monthly partitions are created for the whole
+span, also past the retention window; the next retention.py run detaches
+those as usual.
+
+The data is generated with numpy in chunks of --chunk-users users, in
+--workers processes. PostgreSQL workers load their chunks in parallel with
+COPY. SQLite workers take turns at the single writer with executemany, so
+generation still overlaps with loading. Each chunk has its own random
+stream derived from (--seed, chunk number), so the same seed and chunk size
+give the same data whatever the worker count. Timestamps are laid out
+relative to the time of the run.
+
+HyperLogLog sketches and hourly/daily trend rollups are computed alongside,
+so the approximate stats and trends endpoints work straight away without a
+rollups.py backfill. History rows are numbered for the change feed as they
+are generated, from a block of sequence numbers reserved up front; the
+rollups cursor skips the block, as its counts are already in the rollups.
+
+With --reset or --drop-indexes, the secondary indexes on consents and
+consent_history are dropped for the load and rebuilt at the end, which is
+much faster at scale; the API is slow until they are back. Otherwise they
+are kept and maintained row by row.
+
+Requires numpy, an optional dependency used only by tools like this one.
+
+Usage:
+    python generate_data.py --users 100000
+    python generate_data.py --users 10000000 --purposes 8 --workers 8 --reset
+"""
+
+import argparse
+import io
+import os
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+
+import numpy as np
+
+from approx_stats import ALL_PURPOSES, HLL_REGISTERS, hll_register
+
+CHUNK_USERS = 100000
+MAX_UPDATES = 6
+IP_POOL_MAX = 200000
+ROLLUP_SIZES = (('hour', 3600), ('day', 86400))
+
+PURPOSE_NAMES = [
+    ('Marketing Communications', 'Receive marketing emails and promotional offers', 395),
+    ('Analytics', 'Allow us to analyze your usage patterns to improve our services', None),
+    ('Personalization', 'Personalize your experience based on your preferences', None),
+    ('Third-party Sharing', 'Share your data with trusted third-party partners', 365),
+    ('Product Updates', 'Receive news about product changes and new features', None),
+    ('Location Services', 'Use your approximate location to tailor content', 180),
+    ('Research', 'Take part in surveys and product research', None),
+    ('Advertising Cookies', 'Show advertising based on your activity on other sites', 395),
+]
+
+CONSENT_COLUMNS = 'user_id, purpose_id, status, ip_address, created_at, updated_at, expires_at'
+HISTORY_COLUMNS = 'user_id, purpose_id, status, ip_address, event, created_at, seq'
+
+_ip_pools = {}
+
+
+def _ip_pool(seed, size):
+    """Deterministic pool of IPv4/IPv6 address strings, built once per process"""
+    key = (seed, size)
+    if key not in _ip_pools:
+        rng = np.random.default_rng([seed, 0xA11])
+        v4 = rng.integers(1 << 24, 0xDFFFFFFF, size, dtype=np.uint64)
+        v6 = rng.random(size) < 0.15
+        groups = rng.integers(0, 1 << 16, (size, 4))
+        _ip_pools[key] = np.array([
+            f"2001:db8:{g[0]:x}:{g[1]:x}::{g[2]:x}:{g[3]:x}" if is_v6 else
+            f"{a >> 24}.{(a >> 16) & 255}.{(a >> 8) & 255}.{a & 255}"
+            for a, is_v6, g in zip(v4.tolist(), v6.tolist(), groups.tolist())
+        ], dtype=object)
+    return _ip_pools[key]
+
+
+_times_of_day = None
+
+
+def _timestamps(seconds):
+    """Unix seconds to 'YYYY-MM-DD HH:MM:SS.000000' strings, the format SQLAlchemy uses on SQLite"""
+    global _times_of_day
+    if _times_of_day is None:
+        _times_of_day = np.array([f" {s // 3600:02d}:{s // 60 % 60:02d}:{s % 60:02d}.000000" for s in range(86400)],
+                                 dtype=object)
+    # Whole seconds, joined from a per-day and a per-second-of-day table
+    whole = seconds.astype(np.int64)
+    days, time_of_day = np.divmod(whole, 86400)
+    first_day = days.min(initial=0)
+    dates = np.datetime_as_string(np.arange(first_day, days.max(initial=0) + 1).astype('datetime64[D]')).astype(object)
+    return dates[days - first_day] + _times_of_day[time_of_day]
+
+
+def build_spec(purposes, users, seed, years, chunk_users, now=None):
+    """Generation parameters shared by every chunk; `purposes` is [(id, lifetime_days)]"""
+    rng = np.random.default_rng([seed, 0x5EC])
+    end = (now or datetime.utcnow()) - timedelta(minutes=5)
+    start = end - timedelta(days=365 * years)
+    epoch = datetime(1970, 1, 1)
+    return {
+        'seed': seed,
+        'users': users,
+        'chunk_users': chunk_users,
+        'user_width': len(str(max(users - 1, 1))),
+        'start': (start - epoch).total_seconds(),
+        'end': (end - epoch).total_seconds(),
+        'purpose_ids': [purpose_id for purpose_id, _ in purposes],
+        'lifetime_days': np.array([days or 0 for _, days in purposes], dtype=np.float64),
+        'opt_in': rng.uniform(0.2, 0.8, len(purposes)),
+        'answer_rate': rng.uniform(0.6, 0.98, len(purposes)),
+        'update_rate': 0.25,
+        'answer_delay_days': 14.0,
+        'update_gap_days': 90.0,
+        'ip_pool': min(IP_POOL_MAX, max(1000, users // 10)),
+        # Each chunk numbers its history from its own block, so chunks can load in any order
+        'seq_start': 0,
+        'chunk_events': chunk_users * len(purposes) * (MAX_UPDATES + 1),
+    }
+
+
+def generate_chunk(spec, chunk):
+    """Consent and history columns, HLL registers and rollup counts for one chunk of users"""
+    rng = np.random.default_rng([spec['seed'], chunk])
+    first_user = chunk * spec['chunk_users']
+    n = min(spec['chunk_users'], spec['users'] - first_user)
+    purpose_count = len(spec['purpose_ids'])
+    start, end = spec['start'], spec['end']
+    day = 86400.0
+
+    user_ids = np.array([f"user-{i:0{spec['user_width']}d}" for i in range(first_user, first_user + n)],
+                        dtype=object)
+    # rng.power(3) has density 3x^2, so there are more recent sign-ups than old ones
+    signup = start + (end - start) * rng.power(3, n)
+    propensity = rng.beta(2, 2, n)
+    pool = _ip_pool(spec['seed'], spec['ip_pool'])
+    # About 30% of users sit behind a few shared (carrier or office NAT) addresses
+    shared = rng.random(n) < 0.3
+    home_ip = np.where(shared, rng.integers(0, max(1, len(pool) // 100), n), rng.integers(0, len(pool), n))
+
+    # One consent per answered (user, purpose); np.nonzero keeps them in user order
+    users, purposes = np.nonzero(rng.random((n, purpose_count)) < spec['answer_rate'])
+    rows = len(users)
+    created = np.minimum(signup[users] + rng.exponential(spec['answer_delay_days'] * day, rows), end)
+    yes = np.clip(spec['opt_in'][purposes] * (0.5 + propensity[users]), 0, 1)
+    updates = np.minimum(rng.geometric(1 - spec['update_rate'], rows) - 1, MAX_UPDATES)
+
+    # Event trail: a create followed by `updates` updates per consent
+    per_row = updates + 1
+    event_row = np.repeat(np.arange(rows), per_row)
+    first = np.cumsum(per_row) - per_row
+    gaps = rng.exponential(spec['update_gap_days'] * day, len(event_row))
+    gaps[first] = 0
+    elapsed = np.cumsum(gaps)
+    event_time = np.minimum(created[event_row] + elapsed - elapsed[first][event_row], end)
+    event_status = rng.random(len(event_row)) < yes[event_row]
+    is_create = np.zeros(len(event_row), dtype=bool)
+    is_create[first] = True
+
+    last = first + updates
+    status = event_status[last]
+    updated = event_time[last]
+    roaming = rng.random(rows) < 0.2
+    ip = pool[np.where(roaming, rng.integers(0, len(pool), rows), home_ip[users])]
+    lifetime = spec['lifetime_days'][purposes]
+    expires = updated + lifetime * day
+
+    user_column = user_ids[users]
+    purpose_column = np.asarray(spec['purpose_ids'])[purposes]
+    consents = {
+        'user_id': user_column.tolist(),
+        'purpose_id': purpose_column.tolist(),
+        'status': status.tolist(),
+        'ip_address': ip.tolist(),
+        'created_at': _timestamps(created).tolist(),
+        'updated_at': _timestamps(updated).tolist(),
+        'expires_at': np.where(lifetime > 0, _timestamps(expires), None).tolist(),
+    }
+    history = {
+        'user_id': user_column[event_row].tolist(),
+        'purpose_id': purpose_column[event_row].tolist(),
+        'status': event_status.tolist(),
+        'ip_address': ip[event_row].tolist(),
+        'event': np.where(is_create, 'create', 'update').tolist(),
+        'created_at': _timestamps(event_time).tolist(),
+        'seq': (spec['seq_start'] + chunk * spec['chunk_events'] + 1 + np.arange(len(event_row))).tolist(),
+    }
+
+    # Registers are maxed per purpose and over all purposes, like register_distinct_user
+    registers = np.zeros((purpose_count + 1, HLL_REGISTERS), dtype=np.uint8)
+    index, rank = map(np.array, zip(*(hll_register(user_id) for user_id in user_ids.tolist())))
+    np.maximum.at(registers, (purposes, index[users]), rank[users])
+    registers[purpose_count] = registers[:purpose_count].max(axis=0)
+
+    rollups = {}
+    for granularity, size in ROLLUP_SIZES:
+        # Buckets count from a calendar-aligned origin, so they match bucket_start()
+        origin = start // size * size
+        buckets = int((end - origin) // size) + 1
+        key = ((event_time - origin) // size).astype(np.int64) * purpose_count + purposes[event_row]
+        rollups[granularity] = (
+            np.bincount(key[event_status], minlength=buckets * purpose_count),
+            np.bincount(key[~event_status], minlength=buckets * purpose_count),
+        )
+    return consents, history, registers, rollups
+
+
+def _csv(columns, names):
+    # COPY ... (FORMAT csv): unquoted empty fields are NULL
+    values = []
+    for name in names:
+        column = columns[name]
+        if name == 'status':
+            values.append(['t' if v else 'f' for v in column])
+        elif name in ('purpose_id', 'seq'):
+            values.append([str(v) for v in column])
+        else:
+            values.append(['' if v is None else v for v in column])
+    return io.StringIO('\n'.join(map(','.join, zip(*values))) + '\n')
+
+
+def _load_postgresql(database_url, consents, history):
+    from sqlalchemy import create_engine
+
+    engine = create_engine(database_url)
+    try:
+        raw = engine.raw_connection()
+        try:
+            cursor = raw.cursor()
+            for table, columns, names in (('consents', consents, CONSENT_COLUMNS),
+                                          ('consent_history', history, HISTORY_COLUMNS)):
+                cursor.execute(f"COPY {table} ({names}) FROM STDIN WITH (FORMAT csv)",
+                               stream=_csv(columns, names.split(', ')))
+            raw.commit()
+        finally:
+            raw.close()
+    finally:
+        engine.dispose()
+
+
+def _load_sqlite(path, consents, history):
+    # Writers queue on the database lock; generation of other chunks continues meanwhile
+    conn = sqlite3.connect(path, timeout=3600)
+    try:
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute('BEGIN IMMEDIATE')
+        for table, columns, names in (('consents', consents, CONSENT_COLUMNS),
+                                      ('consent_history', history, HISTORY_COLUMNS)):
+            fields = names.split(', ')
+            conn.executemany(
+                f"INSERT INTO {table} ({names}) VALUES ({', '.join('?' * len(fields))})",
+                zip(*(columns[field] for field in fields))
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _chunk_task(args):
+    database_url, sqlite_path, spec, chunk = args
+    consents, history, registers, rollups = generate_chunk(spec, chunk)
+    if sqlite_path:
+        _load_sqlite(sqlite_path, consents, history)
+    else:
+        _load_postgresql(database_url, consents, history)
+    return len(consents['user_id']), len(history['user_id']), registers, rollups
+
+
+def _reset(conn):
+    for table in ('consent_rollups', 'hll_registers', 'consent_history', 'consents', 'purposes'):
+        conn.exec_driver_sql(f"DELETE FROM {table}")
+
+
+def _reserve_sequence(conn, count):
+    """Move the change-feed cursors past `count` new sequence numbers; returns the first minus one"""
+    from sqlalchemy import text
+
+    from rollups import ROLLUP_CURSOR
+    from sequencer import SEQUENCE_CURSOR
+
+    start = conn.execute(text("SELECT position FROM change_cursors WHERE name = :name"),
+                         {'name': SEQUENCE_CURSOR}).scalar() or 0
+    for name in (SEQUENCE_CURSOR, ROLLUP_CURSOR):
+        conn.execute(text(
+            "INSERT INTO change_cursors (name, position) VALUES (:name, :position) "
+            "ON CONFLICT (name) DO UPDATE SET position = excluded.position"
+        ), {'name': name, 'position': start + count})
+    return start
+
+
+def _provision_partitions(conn, spec):
+    """Give every month of the span a history partition; returns the partitions created"""
+    from partitions import ensure_partitions, is_partitioned
+
+    if not is_partitioned(conn):
+        return []
+    start = datetime(1970, 1, 1) + timedelta(seconds=spec['start'])
+    now = datetime.utcnow()
+    months_back = (now.year - start.year) * 12 + now.month - start.month
+    return ensure_partitions(conn, months_back=months_back, now=now)
+
+
+def _purposes(conn, count):
+    """Existing purposes, or `count` new ones; returns [(id, lifetime_days)]"""
+    from sqlalchemy import text
+
+    rows = conn.execute(text("SELECT id, consent_lifetime_days FROM purposes ORDER BY id")).all()
+    if rows:
+        return [tuple(row) for row in rows]
+    now = datetime.utcnow()
+    for i in range(count):
+        name, description, lifetime = PURPOSE_NAMES[i] if i < len(PURPOSE_NAMES) else (
+            f"Purpose {i + 1}", f"Synthetic purpose {i + 1}", None)
+        conn.execute(text(
+            "INSERT INTO purposes (name, description, consent_lifetime_days, created_at) "
+            "VALUES (:name, :description, :lifetime, :created_at)"
+        ), {'name': name, 'description': description, 'lifetime': lifetime, 'created_at': now})
+    return [tuple(row) for row in conn.execute(
+        text("SELECT id, consent_lifetime_days FROM purposes ORDER BY id")
+    ).all()]
+
+
+def _write_aggregates(conn, spec, registers, rollups):
+    from sqlalchemy import text
+
+    purpose_ids = spec['purpose_ids'] + [ALL_PURPOSES]
+    # Upserts: the tables may hold rows from earlier writes even when
+    # consents is empty. Registers keep the higher rank; rollups add up.
+    conn.execute(text(
+        "INSERT INTO hll_registers (purpose_id, register, rank) VALUES (:purpose_id, :register, :rank) "
+        "ON CONFLICT (purpose_id, register) DO UPDATE SET rank = excluded.rank "
+        "WHERE hll_registers.rank < excluded.rank"
+    ), [
+        {'purpose_id': purpose_ids[p], 'register': int(r), 'rank': int(registers[p, r])}
+        for p, r in zip(*np.nonzero(registers))
+    ])
+    epoch = datetime(1970, 1, 1)
+    purpose_count = len(spec['purpose_ids'])
+    rows = []
+    for granularity, size in ROLLUP_SIZES:
+        origin = spec['start'] // size * size
+        opt_ins, opt_outs = rollups[granularity]
+        for key in np.flatnonzero(opt_ins + opt_outs).tolist():
+            bucket, purpose = divmod(key, purpose_count)
+            rows.append({
+                'granularity': granularity,
+                'purpose_id': spec['purpose_ids'][purpose],
+                'bucket_start': epoch + timedelta(seconds=origin + bucket * size),
+                'opt_ins': int(opt_ins[key]),
+                'opt_outs': int(opt_outs[key]),
+            })
+    if rows:
+        conn.execute(text(
+            "INSERT INTO consent_rollups (granularity, purpose_id, bucket_start, opt_ins, opt_outs) "
+            "VALUES (:granularity, :purpose_id, :bucket_start, :opt_ins, :opt_outs) "
+            "ON CONFLICT (granularity, purpose_id, bucket_start) DO UPDATE SET "
+            "opt_ins = consent_rollups.opt_ins + excluded.opt_ins, "
+            "opt_outs = consent_rollups.opt_outs + excluded.opt_outs"
+        ), rows)
+    return len(rows)
+
+
+def generate(engine, users, purposes=8, seed=42, workers=1, chunk_users=CHUNK_USERS, years=3, reset=False,
+             drop_indexes=False):
+    """Fill the database; returns a summary dict.
+
+    Secondary indexes are dropped for the load only with `reset` or
+    `drop_indexes`, since the API can't use them until they are rebuilt.
+    """
+    from sqlalchemy import text
+
+    with engine.begin() as conn:
+        if reset:
+            _reset(conn)
+        elif conn.execute(text("SELECT 1 FROM consents LIMIT 1")).first():
+            raise ValueError('The database already has consents; pass --reset to replace them')
+        spec = build_spec(_purposes(conn, purposes), users, seed, years, chunk_users)
+        chunks = (users + chunk_users - 1) // chunk_users
+        spec['seq_start'] = _reserve_sequence(conn, chunks * spec['chunk_events'])
+        _provision_partitions(conn, spec)
+
+    url = engine.url
+    sqlite_path = url.database if url.get_backend_name() == 'sqlite' else None
+    if sqlite_path:
+        with sqlite3.connect(sqlite_path) as conn:
+            conn.execute('PRAGMA journal_mode = WAL')
+    tasks = [(url.render_as_string(hide_password=False), sqlite_path, spec, chunk)
+             for chunk in range(chunks)]
+
+    # Building the secondary indexes once at the end is cheaper than
+    # maintaining them through millions of inserts
+    from app import db
+
+    indexes = []
+    if reset or drop_indexes:
+        indexes = [index for name in ('consents', 'consent_history') for index in db.metadata.tables[name].indexes]
+    started = time.perf_counter()
+    consents = history = 0
+    registers = rollups = None
+    try:
+        with engine.begin() as conn:
+            for index in indexes:
+                index.drop(conn, checkfirst=True)
+        with Pool(workers) as pool:
+            for done, (chunk_consents, chunk_history, chunk_registers, chunk_rollups) in enumerate(
+                pool.imap_unordered(_chunk_task, tasks), 1
+            ):
+                consents += chunk_consents
+                history += chunk_history
+                if registers is None:
+                    registers, rollups = chunk_registers, chunk_rollups
+                else:
+                    np.maximum(registers, chunk_registers, out=registers)
+                    for granularity, (opt_ins, opt_outs) in chunk_rollups.items():
+                        rollups[granularity][0][:] += opt_ins
+                        rollups[granularity][1][:] += opt_outs
+                elapsed = time.perf_counter() - started
+                print(f"  {done}/{len(tasks)} chunks, {consents:,} consents, "
+                      f"{(consents + history) / elapsed:,.0f} rows/s", flush=True)
+    finally:
+        # Also after a failed run: the API must never be left without its indexes
+        if indexes:
+            print(f"  rebuilding {len(indexes)} indexes", flush=True)
+            with engine.begin() as conn:
+                for index in indexes:
+                    index.create(conn, checkfirst=True)
+
+    with engine.begin() as conn:
+        buckets = _write_aggregates(conn, spec, registers, rollups)
+        # Fresh planner statistics; approximate stats also read the row estimate
+        conn.exec_driver_sql('ANALYZE')
+    elapsed = time.perf_counter() - started
+    return {
+        'users': users,
+        'purposes': len(spec['purpose_ids']),
+        'consents': consents,
+        'history': history,
+        'rollup_buckets': buckets,
+        'seconds': round(elapsed, 1),
+        'rows_per_second': round((consents + history) / elapsed) if elapsed else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic consent data at scale')
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--purposes', type=int, default=8, help='purposes to create if there are none')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--years', type=float, default=3, help='time span of the data (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--chunk-users', type=int, default=CHUNK_USERS,
+                        help='users per generated chunk; part of what the seed reproduces')
+    parser.add_argument('--reset', action='store_true',
+                        help='delete existing purposes, consents, history, rollups and sketches first')
+    parser.add_argument('--drop-indexes', action='store_true',
+                        help='drop secondary indexes during the load and rebuild them after (implied by --reset)')
+    args = parser.parse_args()
+
+    from app import app, db
+    from migrations import migrate
+
+    with app.app_context():
+        migrate(db)
+        print(f"Generating {args.users:,} users with {args.workers} worker(s) into {db.engine.url.get_backend_name()}")
+        try:
+            summary = generate(db.engine, args.users, args.purposes, args.seed, args.workers,
+                               args.chunk_users, args.years, args.reset, args.drop_indexes)
+        except ValueError as e:
+            parser.error(str(e))
+    print(f"✓ {summary['consents']:,} consents and {summary['history']:,} history rows for "
+          f"{summary['users']:,} users x {summary['purposes']} purposes in {summary['seconds']} s "
+          f"({summary['rows_per_second']:,} rows/s), {summary['rollup_buckets']:,} rollup buckets")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Gunicorn settings for the production server (`python start_server.py --production`).
+
+Workers are forked from a master that has already imported the app
+(preload_app), so code and warmed caches are shared copy-on-write. Each
+worker serves requests on a few threads and gets its own connection pool
+sized to them. Every setting can be overridden through the environment.
+
+Workers default to 2 x CPUs + 1, but never more than the database can
+serve: each worker may open DB_POOL_SIZE + DB_MAX_OVERFLOW connections, and
+workers x that is kept within DB_CONNECTION_BUDGET (default 90, which
+leaves PostgreSQL's default max_connections of 100 some room for superuser
+slots, migrations and the CLIs). An explicit GUNICORN_WORKERS above the
+budget is lowered too, with a warning.
+
+Signals to the master (pid in GUNICORN_PIDFILE):
+    HUP    reload this file and gracefully replace the workers
+    TTIN / TTOU    add / remove a worker
+    USR2 then QUIT to the old master    deploy new code with no downtime;
+           preloaded code is not re-imported on HUP
+    TERM   graceful shutdown, waiting up to graceful_timeout for requests
+"""
+
+import multiprocessing
+import os
+import sys
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+worker_class = 'gthread'
+preload_app = True
+
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+keepalive = 5
+# Recycle workers now and then so slow leaks can't accumulate; the jitter
+# keeps them from all restarting at once
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '10000'))
+max_requests_jitter = max_requests // 10
+
+pidfile = os.getenv('GUNICORN_PIDFILE')
+accesslog = os.getenv('GUNICORN_ACCESS_LOG', '-')
+errorlog = '-'
+
+# One pooled connection per thread, plus overflow for change-feed streams.
+# Read by app.py, which is imported after this file.
+os.environ.setdefault('DB_POOL_SIZE', str(threads))
+os.environ.setdefault('DB_MAX_OVERFLOW', str(threads))
+
+db_connection_budget = int(os.getenv('DB_CONNECTION_BUDGET', '90'))
+connections_per_worker = int(os.environ['DB_POOL_SIZE']) + int(os.environ['DB_MAX_OVERFLOW'])
+max_workers = max(1, db_connection_budget // connections_per_worker)
+workers = int(os.getenv('GUNICORN_WORKERS', str(multiprocessing.cpu_count() * 2 + 1)))
+if workers > max_workers:
+    if 'GUNICORN_WORKERS' in os.environ:
+        print(f"GUNICORN_WORKERS={workers} x {connections_per_worker} connections exceeds DB_CONNECTION_BUDGET="
+              f"{db_connection_budget}; starting {max_workers} workers", file=sys.stderr)
+    workers = max_workers
+if connections_per_worker > db_connection_budget:
+    print(f"One worker's pool ({connections_per_worker} connections) exceeds DB_CONNECTION_BUDGET="
+          f"{db_connection_budget}; lower GUNICORN_THREADS or DB_POOL_SIZE / DB_MAX_OVERFLOW", file=sys.stderr)
+
+
+def when_ready(server):
+    # Connections opened in the master while preloading (e.g. by the warm-up)
+    # are never used there again
+    from app import app, db
+
+    with app.app_context():
+        db.engine.dispose()
+    server.log.info("Master ready: %s workers x %s threads, up to %s database connections",
+                    workers, threads, workers * connections_per_worker)
+
+
+def post_fork(server, worker):
+    from app import app, db, WARMUP_ON_START
+
+    # Sockets inherited from the master belong to it; start with an empty pool
+    # without closing them
+    with app.app_context():
+        db.engine.dispose(close=False)
+    if WARMUP_ON_START:
+        from warmup import prime
+
+        server.log.info("Worker %s warm-up: %s", worker.pid, prime(app))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Expiry sweeper for idempotency keys.
+
+Stored responses are only useful for IDEMPOTENCY_TTL_SECONDS; this deletes
+expired keys in small batches through the expires_at index so the table stays
+small without long-running deletes. Run it from cron or as the scheduled
+`idempotency_sweeper` Lambda.
+
+Usage:
+    python idempotency_sweeper.py
+    python idempotency_sweeper.py --batch-size 500
+"""
+
+import argparse
+import os
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SWEEP_BATCH_SIZE = int(os.getenv('IDEMPOTENCY_SWEEP_BATCH', '1000'))
+
+
+def sweep(batch_size=SWEEP_BATCH_SIZE, now=None):
+    """Delete expired idempotency keys; returns the number removed"""
+    from app import db, IdempotencyKey
+
+    now = now or datetime.utcnow()
+    removed = 0
+    while True:
+        keys = [row.key for row in db.session.query(IdempotencyKey.key).filter(
+            IdempotencyKey.expires_at <= now
+        ).limit(batch_size)]
+        if not keys:
+            return removed
+        IdempotencyKey.query.filter(IdempotencyKey.key.in_(keys)).delete(synchronize_session=False)
+        db.session.commit()
+        removed += len(keys)
+        if len(keys) < batch_size:
+            return removed
+
+
+def handler(event, context):
+    """Lambda entry point for the scheduled sweep"""
+    from app import app
+
+    with app.app_context():
+        return {'removed': sweep()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Delete expired idempotency keys')
+    parser.add_argument('--batch-size', type=int, default=SWEEP_BATCH_SIZE,
+                        help='keys deleted per transaction (default: %(default)s)')
+    args = parser.parse_args()
+
+    from app import app
+
+    with app.app_context():
+        removed = sweep(batch_size=args.batch_size)
+    print(f"✓ Removed {removed} expired idempotency keys")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+Versioned schema migrations.
+
+Each migration has a version number and runs at most once per database;
+applied versions are recorded in `schema_migrations`. Migrations run in
+version order. The first one creates whatever tables are missing
+(db.create_all() after partition provisioning). Later ones evolve tables
+that already hold data: they add the columns and indexes that create_all()
+skips for existing tables.
+
+Migrations must be safe on a live database:
+- indexes on PostgreSQL are built with CREATE INDEX CONCURRENTLY, outside a
+  transaction, so writes continue during the build. A concurrent build that
+  failed leaves an INVALID index behind; it is dropped and rebuilt on the
+  next run
+- every step is idempotent (IF NOT EXISTS, column checks), so a migration
+  interrupted half way can simply be run again; its version is only recorded
+  once all of its steps succeeded
+- on PostgreSQL an advisory lock keeps two deploys from migrating at once
+
+Works with pg8000 and SQLite.
+
+Usage:
+    python migrations.py             # apply pending migrations
+    python migrations.py --status
+"""
+
+import argparse
+import time
+from datetime import datetime
+
+from dotenv import load_dotenv
+from sqlalchemy import DateTime, bindparam, inspect, text
+from sqlalchemy.schema import CreateIndex
+
+load_dotenv()
+
+# Arbitrary key for pg_advisory_lock, shared by every deploy of this app
+MIGRATION_LOCK_KEY = 7316402
+# Source rows per transaction for data migrations
+BACKFILL_BATCH_SIZE = 10000
+
+
+def _create_table(conn):
+    conn.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INTEGER PRIMARY KEY, "
+        "name VARCHAR(100) NOT NULL, "
+        "applied_at TIMESTAMP NOT NULL, "
+        "duration_ms INTEGER NOT NULL)"
+    )
+
+
+def applied_versions(engine):
+    with engine.begin() as conn:
+        _create_table(conn)
+        return {row[0]: row for row in conn.execute(
+            text("SELECT version, name, applied_at, duration_ms FROM schema_migrations ORDER BY version")
+            .columns(applied_at=DateTime)
+        )}
+
+
+def create_index(db, table, name, ddl=None):
+    """Build one of the model's indexes if it is missing, concurrently on PostgreSQL.
+
+    `ddl` is a CREATE INDEX IF NOT EXISTS statement for indexes the model no
+    longer declares but an old migration still builds.
+    """
+    engine = db.engine
+    if ddl is None:
+        index = next(index for index in db.metadata.tables[table].indexes if index.name == name)
+        ddl = str(CreateIndex(index, if_not_exists=True).compile(dialect=engine.dialect))
+    if engine.dialect.name != 'postgresql':
+        with engine.begin() as conn:
+            conn.exec_driver_sql(ddl)
+        return
+
+    # CONCURRENTLY can't run inside a transaction block
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        valid = conn.exec_driver_sql(
+            "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE c.relname = %s", (name,)
+        ).scalar()
+        if valid is False:
+            conn.exec_driver_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+        partitioned = conn.exec_driver_sql(
+            "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+            "WHERE c.relname = %s", (table,)
+        ).first()
+        # Partitioned parents don't support CONCURRENTLY; their indexes are built per partition
+        if not partitioned:
+            ddl = ddl.replace('CREATE INDEX', 'CREATE INDEX CONCURRENTLY', 1)
+        conn.exec_driver_sql(ddl)
+
+
+def drop_index(db, name):
+    """DROP INDEX IF EXISTS, concurrently on PostgreSQL"""
+    if db.engine.dialect.name != 'postgresql':
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
+        return
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.exec_driver_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+
+def add_column(db, table, column, ddl_type):
+    """ALTER TABLE ... ADD COLUMN unless the column exists"""
+    if column in {c['name'] for c in inspect(db.engine).get_columns(table)}:
+        return
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}")
+
+
+def baseline(db):
+    """Create every missing table, the partitioned history table first"""
+    from partitions import provision_history_schema
+
+    provision_history_schema(db.engine)
+    db.create_all()
+
+
+def consent_expiry_columns(db):
+    add_column(db, 'purposes', 'consent_lifetime_days', 'INTEGER')
+    add_column(db, 'consents', 'expires_at', 'TIMESTAMP')
+
+
+def consent_read_indexes(db):
+    """Expiry sweep and sync watermark indexes for tables created before them"""
+    # Dropped again by consent_expired_at and drop_sync_watermark_index
+    create_index(db, 'consents', 'ix_consents_expires_at',
+                 "CREATE INDEX IF NOT EXISTS ix_consents_expires_at ON consents (expires_at) "
+                 "WHERE expires_at IS NOT NULL")
+    create_index(db, 'consents', 'ix_consents_updated_id',
+                 "CREATE INDEX IF NOT EXISTS ix_consents_updated_id ON consents (updated_at, id)")
+
+
+def consent_user_purpose_index(db):
+    """Every per-user read filters on user_id, usually with purpose_id"""
+    create_index(db, 'consents', 'ix_consents_user_purpose')
+
+
+def consent_history_backfill(db, batch_size=BACKFILL_BATCH_SIZE):
+    """A create event for every consent that has no history yet.
+
+    Consents written before consent_history existed would otherwise have an
+    empty history. Each one gets a single create event with its current
+    status, dated when that status was recorded (updated_at). Consents last
+    changed before the retention window are skipped, as retention would
+    remove their history anyway.
+    """
+    from partitions import history_window_start
+
+    insert = text(
+        "INSERT INTO consent_history (user_id, purpose_id, status, ip_address, event, created_at) "
+        "SELECT c.user_id, c.purpose_id, c.status, c.ip_address, 'create', "
+        "COALESCE(c.updated_at, c.created_at, :now) FROM consents c "
+        "WHERE c.id > :low AND c.id <= :high AND COALESCE(c.updated_at, c.created_at, :now) >= :window_start "
+        "AND NOT EXISTS (SELECT 1 FROM consent_history h "
+        "WHERE h.user_id = c.user_id AND h.purpose_id = c.purpose_id)"
+    ).bindparams(bindparam('now', type_=DateTime), bindparam('window_start', type_=DateTime))
+    with db.engine.connect() as conn:
+        high = conn.execute(text("SELECT MAX(id) FROM consents")).scalar() or 0
+    now = datetime.utcnow()
+    window_start = history_window_start(now)
+    # Short transactions by id range, so writers are never blocked for long
+    for low in range(0, high, batch_size):
+        with db.engine.begin() as conn:
+            conn.execute(insert, {'low': low, 'high': low + batch_size, 'now': now, 'window_start': window_start})
+
+
+def distinct_user_sketches(db):
+    """Register consents written before the HyperLogLog sketches existed"""
+    from approx_stats import backfill_sketches
+
+    backfill_sketches(db.engine)
+
+
+def change_sequence(db, batch_size=BACKFILL_BATCH_SIZE):
+    """Commit-ordered change feed: seq column, cursors and numbering of existing rows.
+
+    Rows already written keep their id as their seq, so consumers resume from
+    the `since` they stored. The sequence cursor is created at the highest id
+    in the same transaction as the column, so rows the API numbers while the
+    backfill runs always sort after all of them. A database that already has
+    the cursor (created with seq in place) is numbered by the API alone.
+    """
+    from sequencer import SEQUENCE_CURSOR
+
+    db.metadata.tables['change_cursors'].create(db.engine, checkfirst=True)
+    columns = {c['name'] for c in inspect(db.engine).get_columns('consent_history')}
+    with db.engine.begin() as conn:
+        if 'seq' not in columns:
+            conn.exec_driver_sql("ALTER TABLE consent_history ADD COLUMN seq BIGINT")
+        high = 0
+        if conn.execute(text("SELECT 1 FROM change_cursors WHERE name = :name"),
+                        {'name': SEQUENCE_CURSOR}).first() is None:
+            high = conn.execute(text("SELECT COALESCE(MAX(id), 0) FROM consent_history")).scalar()
+            conn.execute(text("INSERT INTO change_cursors (name, position) VALUES (:name, :position)"),
+                         {'name': SEQUENCE_CURSOR, 'position': high})
+    create_index(db, 'consent_history', 'ix_consent_history_seq')
+    create_index(db, 'consent_history', 'ix_consent_history_unsequenced')
+    number = text("UPDATE consent_history SET seq = id WHERE seq IS NULL AND id > :low AND id <= :high")
+    for low in range(0, high, batch_size):
+        with db.engine.begin() as conn:
+            conn.execute(number, {'low': low, 'high': min(low + batch_size, high)})
+
+
+def rollup_cursor(db):
+    """Rollups are aggregated from the change feed instead of on write.
+
+    Everything written so far was rolled up on write, so the rollups cursor
+    starts at the current end of the sequence.
+    """
+    from rollups import ROLLUP_CURSOR
+    from sequencer import sequence_changes
+
+    sequence_changes(db.engine)
+    with db.engine.begin() as conn:
+        conn.execute(text(
+            "INSERT INTO change_cursors (name, position) "
+            "SELECT :name, COALESCE(MAX(seq), 0) FROM consent_history WHERE true "
+            "ON CONFLICT (name) DO NOTHING"
+        ), {'name': ROLLUP_CURSOR})
+
+
+def idempotency_response_headers(db):
+    add_column(db, 'idempotency_keys', 'response_headers', 'TEXT')
+
+
+def consent_expired_at(db):
+    """Expired consents are marked instead of deleted; the sweep index skips marked rows"""
+    add_column(db, 'consents', 'expired_at', 'TIMESTAMP')
+    create_index(db, 'consents', 'ix_consents_expiry_pending')
+    drop_index(db, 'ix_consents_expires_at')
+
+
+def drop_sync_watermark_index(db):
+    """Sync follows the change feed now; ix_consents_updated_id only costs writes"""
+    drop_index(db, 'ix_consents_updated_id')
+
+
+MIGRATIONS = [
+    (1, 'baseline', baseline),
+    (2, 'consent_expiry_columns', consent_expiry_columns),
+    (3, 'consent_read_indexes', consent_read_indexes),
+    (4, 'consent_user_purpose_index', consent_user_purpose_index),
+    (5, 'consent_history_backfill', consent_history_backfill),
+    (6, 'distinct_user_sketches', distinct_user_sketches),
+    (7, 'change_sequence', change_sequence),
+    (8, 'rollup_cursor', rollup_cursor),
+    (9, 'idempotency_response_headers', idempotency_response_headers),
+    (10, 'consent_expired_at', consent_expired_at),
+    (11, 'drop_sync_watermark_index', drop_sync_watermark_index),
+]
+
+
+def migrate(db, log=print):
+    """Apply pending migrations in order; returns the versions applied.
+
+    Needs an app context; `db` is the app's Flask-SQLAlchemy instance.
+    """
+    engine = db.engine
+    lock = None
+    if engine.dialect.name == 'postgresql':
+        # Autocommit, so the lock holder has no open transaction for the
+        # concurrent index builds to wait on
+        lock = engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+        lock.exec_driver_sql("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+    try:
+        done = applied_versions(engine)
+        applied = []
+        for version, name, migration in MIGRATIONS:
+            if version in done:
+                continue
+            started = time.perf_counter()
+            migration(db)
+            duration_ms = int((time.perf_counter() - started) * 1000)
+            with engine.begin() as conn:
+                conn.execute(text(
+                    "INSERT INTO schema_migrations (version, name, applied_at, duration_ms) "
+                    "VALUES (:version, :name, :applied_at, :duration_ms)"
+                ), {'version': version, 'name': name, 'applied_at': datetime.utcnow(), 'duration_ms': duration_ms})
+            log(f"✓ Applied migration {version} {name} in {duration_ms} ms")
+            applied.append(version)
+        return applied
+    finally:
+        if lock is not None:
+            lock.exec_driver_sql("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+            lock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Apply versioned schema migrations')
+    parser.add_argument('--status', action='store_true', help='list applied and pending migrations')
+    args = parser.parse_args()
+
+    from app import app, db
+
+    with app.app_context():
+        if args.status:
+            done = applied_versions(db.engine)
+            for version, name, _ in MIGRATIONS:
+                row = done.get(version)
+                state = f"applied {row[2]:%Y-%m-%d %H:%M} ({row[3]} ms)" if row else 'pending'
+                print(f"{version:4d}  {name:30s} {state}")
+            return
+        applied = migrate(db)
+    print(f"✓ Schema up to date ({len(applied)} migrations applied)")
+
+
+if __name__ == '__main__':
+    main()
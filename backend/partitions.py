@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Schema provisioning for time-partitioned consent history.
+
+On PostgreSQL the consent_history table is created as a native range
+partitioned table (one partition per calendar month on created_at), and
+partitions are created ahead of time so inserts never hit a missing range.
+SQLite and other backends keep a single plain table created by db.create_all().
+
+Usage:
+    python partitions.py                   # create table + partitions ahead
+    python partitions.py --months-ahead 6
+    python partitions.py --list
+"""
+
+import argparse
+import os
+import re
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+HISTORY_TABLE = 'consent_history'
+PARTITION_NAME_RE = re.compile(r'^consent_history_p(\d{4})(\d{2})$')
+
+# How many months of history are kept online, and how many empty partitions
+# are provisioned ahead of the current month.
+RETENTION_MONTHS = int(os.getenv('CONSENT_HISTORY_RETENTION_MONTHS', '24'))
+MONTHS_AHEAD = int(os.getenv('CONSENT_HISTORY_MONTHS_AHEAD', '3'))
+
+
+def partitioning_enabled():
+    """Whether native partitioning was requested for this deployment"""
+    return os.getenv('CONSENT_HISTORY_PARTITIONING', '').lower() in ('1', 'true', 'yes')
+
+
+def month_start(dt):
+    """Truncate a datetime to the first instant of its month"""
+    return datetime(dt.year, dt.month, 1)
+
+
+def add_months(dt, months):
+    """Shift a month-aligned datetime by a number of months"""
+    index = dt.year * 12 + (dt.month - 1) + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def history_window_start(now=None, months=None):
+    """Oldest created_at still covered by the retention policy"""
+    months = RETENTION_MONTHS if months is None else months
+    return add_months(month_start(now or datetime.utcnow()), -months)
+
+
+def partition_name(month):
+    """Partition table name for the month containing `month`"""
+    return f'{HISTORY_TABLE}_p{month.year:04d}{month.month:02d}'
+
+
+def partition_month(name):
+    """Inverse of partition_name(); None for names that don't follow the convention"""
+    match = PARTITION_NAME_RE.match(name)
+    if not match:
+        return None
+    return datetime(int(match.group(1)), int(match.group(2)), 1)
+
+
+def is_postgresql(conn):
+    return conn.dialect.name == 'postgresql'
+
+
+def is_partitioned(conn):
+    """Whether consent_history exists as a partitioned table"""
+    if not is_postgresql(conn):
+        return False
+    row = conn.exec_driver_sql(
+        "SELECT 1 FROM pg_partitioned_table pt "
+        "JOIN pg_class c ON c.oid = pt.partrelid "
+        "WHERE c.relname = %s AND c.relnamespace = 'public'::regnamespace",
+        (HISTORY_TABLE,)
+    ).first()
+    return row is not None
+
+
+def list_partitions(conn):
+    """Return [(name, month)] for the attached partitions, oldest first"""
+    rows = conn.exec_driver_sql(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = %s",
+        (HISTORY_TABLE,)
+    ).fetchall()
+    partitions = [(row[0], partition_month(row[0])) for row in rows]
+    return sorted((p for p in partitions if p[1] is not None), key=lambda p: p[1])
+
+
+def create_partitioned_table(conn):
+    """Create consent_history as a partitioned table if it doesn't exist yet"""
+    # The partition key has to be part of the primary key on partitioned tables.
+    conn.exec_driver_sql(f"""
+        CREATE TABLE IF NOT EXISTS {HISTORY_TABLE} (
+            id BIGSERIAL NOT NULL,
+            user_id VARCHAR(36) NOT NULL,
+            purpose_id INTEGER NOT NULL,
+            status BOOLEAN NOT NULL,
+            ip_address VARCHAR(45),
+            event VARCHAR(20) NOT NULL,
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            seq BIGINT,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    """)
+    conn.exec_driver_sql(
+        f"CREATE INDEX IF NOT EXISTS ix_consent_history_user_created "
+        f"ON {HISTORY_TABLE} (user_id, created_at)"
+    )
+    conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS ix_consent_history_seq ON {HISTORY_TABLE} (seq)")
+    conn.exec_driver_sql(
+        f"CREATE INDEX IF NOT EXISTS ix_consent_history_unsequenced "
+        f"ON {HISTORY_TABLE} (id) WHERE seq IS NULL"
+    )
+
+
+def ensure_partitions(conn, months_ahead=MONTHS_AHEAD, months_back=0, now=None):
+    """Create monthly partitions from `months_back` months ago to `months_ahead` ahead"""
+    current = month_start(now or datetime.utcnow())
+    created = []
+    for offset in range(-months_back, months_ahead + 1):
+        start = add_months(current, offset)
+        end = add_months(start, 1)
+        name = partition_name(start)
+        exists = conn.exec_driver_sql(
+            "SELECT 1 FROM pg_class WHERE relname = %s", (name,)
+        ).first()
+        if exists:
+            continue
+        conn.exec_driver_sql(
+            f"CREATE TABLE {name} PARTITION OF {HISTORY_TABLE} "
+            f"FOR VALUES FROM ('{start.isoformat(' ')}') TO ('{end.isoformat(' ')}')"
+        )
+        created.append(name)
+    return created
+
+
+def provision_history_schema(engine, months_ahead=MONTHS_AHEAD):
+    """Create the partitioned history table and upcoming partitions.
+
+    Returns the list of partitions created. On backends other than PostgreSQL,
+    or when partitioning isn't enabled, this is a no-op and db.create_all()
+    provides the single-table fallback.
+    """
+    if engine.dialect.name != 'postgresql' or not partitioning_enabled():
+        return []
+    with engine.begin() as conn:
+        create_partitioned_table(conn)
+        # Cover the whole retention window so backfilled rows have a home.
+        return ensure_partitions(conn, months_ahead=months_ahead, months_back=RETENTION_MONTHS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Provision consent history partitions')
+    parser.add_argument('--months-ahead', type=int, default=MONTHS_AHEAD,
+                        help='number of future monthly partitions to keep ready')
+    parser.add_argument('--list', action='store_true', help='only list existing partitions')
+    args = parser.parse_args()
+
+    from app import db, app
+
+    with app.app_context():
+        engine = db.engine
+        if engine.dialect.name != 'postgresql':
+            print(f"{engine.dialect.name} backend: consent_history uses a single table, nothing to do.")
+            return
+        if args.list:
+            with engine.connect() as conn:
+                for name, month in list_partitions(conn):
+                    print(f"{name}  {month:%Y-%m}")
+            return
+        if not partitioning_enabled():
+            print("CONSENT_HISTORY_PARTITIONING is not enabled, skipping.")
+            return
+        created = provision_history_schema(engine, months_ahead=args.months_ahead)
+        for name in created:
+            print(f"Created partition {name}")
+        print(f"✓ consent_history partitions provisioned ({len(created)} new)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Replay a request against the local app under a profiler.
+
+Sends the request through the Flask test client, in process and against
+DATABASE_URL, so it runs the same code as production minus the network. The
+request is sent once unprofiled to warm caches. It is then repeated
+`--repeat` times under the profiler and the samples are aggregated:
+
+    sample    collapsed stacks rooted at the route, for flamegraph.pl,
+              speedscope or inferno (default)
+    cprofile  a pstats file; the top functions by cumulative time are printed
+
+Usage:
+    python profile_request.py POST /api/consent/check --json '{"user_id": "user123", "purpose_ids": [1, 2]}'
+    python profile_request.py GET "/api/consent/stats?mode=approx" --repeat 50 --output stats.folded
+    python profile_request.py POST /api/consent/bulk --data @payload.ndjson -H "Content-Type: application/x-ndjson"
+    flamegraph.pl /tmp/consent-profiles/POST_api_consent_check/replay.folded > check.svg
+"""
+
+import argparse
+import json
+import os
+import pstats
+import sys
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a request against the local app under a profiler')
+    parser.add_argument('method', type=str.upper)
+    parser.add_argument('path', help='path with query string, e.g. /api/consent/stats?mode=approx')
+    body = parser.add_mutually_exclusive_group()
+    body.add_argument('--json', help='JSON request body')
+    body.add_argument('--data', help='raw request body, or @file to read it from a file')
+    parser.add_argument('-H', '--header', action='append', default=[], help="'Name: value', repeatable")
+    parser.add_argument('--repeat', type=int, default=20, help='profiled repetitions (default: %(default)s)')
+    parser.add_argument('--mode', choices=['sample', 'cprofile'], default='sample')
+    parser.add_argument('--interval-ms', type=float, default=1.0, help='sampling interval (default: %(default)s)')
+    parser.add_argument('--output', help='output file (default: PROFILE_DIR/<route>/replay.folded or .prof)')
+    args = parser.parse_args()
+
+    headers = {}
+    for header in args.header:
+        name, _, value = header.partition(':')
+        headers[name.strip()] = value.strip()
+    data = args.data
+    if data is not None and data.startswith('@'):
+        with open(data[1:], 'rb') as f:
+            data = f.read()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from app import PROFILE_DIR, app
+    from profiling import collapsed, profile_call, route_slug, self_time
+
+    client = app.test_client()
+
+    def send():
+        kwargs = {'headers': headers}
+        if args.json is not None:
+            kwargs['json'] = json.loads(args.json)
+        elif data is not None:
+            kwargs['data'] = data
+        response = client.open(args.path, method=args.method, **kwargs)
+        response.get_data()
+        return response
+
+    # Warm-up: connections, caches and compiled statements
+    first = send()
+    adapter = app.url_map.bind('localhost')
+    try:
+        rule, _ = adapter.match(args.path.split('?', 1)[0], method=args.method, return_rule=True)
+        route = f"{args.method} {rule.rule}"
+    except Exception:
+        route = f"{args.method} unmatched"
+    print(f"{route}: HTTP {first.status_code}, {len(first.get_data())} bytes")
+
+    def repeated():
+        return [send().status_code for _ in range(args.repeat)]
+
+    statuses, result = profile_call(repeated, mode=args.mode, interval=args.interval_ms / 1000)
+    if any(status != first.status_code for status in statuses):
+        print(f"warning: statuses varied across repetitions: {sorted(set(statuses))}")
+
+    extension = 'folded' if args.mode == 'sample' else 'prof'
+    output = args.output or os.path.join(PROFILE_DIR, route_slug(route), f"replay.{extension}")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    if args.mode == 'cprofile':
+        result.dump_stats(output)
+        pstats.Stats(result).sort_stats('cumulative').print_stats(25)
+    else:
+        with open(output, 'w', encoding='utf-8') as f:
+            f.writelines(line + '\n' for line in collapsed(result, root=route))
+        total = sum(result.values())
+        print(f"{total} samples over {args.repeat} requests; hottest frames:")
+        for frame, samples in self_time(result):
+            print(f"  {samples / total:>6.1%}  {frame}")
+    print(f"✓ Wrote {output}")
+
+
+if __name__ == '__main__':
+    main()
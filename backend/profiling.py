@@ -0,0 +1,209 @@
+"""
+On-demand request profiling with flamegraph output.
+
+A profiled request is run under one of two profilers:
+
+    sample    (default) a statistical sampler. A helper thread snapshots the
+              request thread's stack every `interval` seconds. The result is
+              written as collapsed stacks ("frame;frame;frame count" per
+              line, root first), which flamegraph.pl, speedscope and
+              inferno read directly. Overhead does not depend on how many
+              calls the request makes
+    cprofile  deterministic cProfile of the request thread, written as a
+              pstats file for snakeviz, flameprof or gprof2dot. Exact call
+              counts, but slows call-heavy code down noticeably
+
+Every stack starts with a frame naming the route ("POST /api/consent/check").
+Files are stored per route:
+
+    <directory>/POST_api_consent_check/20240101T120000123456-1a2b3c.folded
+
+Only the newest `max_files` profiles per route are kept; older ones are
+removed as new ones are written. At most `max_concurrent` requests per
+process are profiled at once; further requests run unprofiled. A profile
+that can't be written (full disk, read-only directory) is logged and
+dropped; the request itself is never failed by it.
+"""
+
+import collections
+import cProfile
+import logging
+import os
+import re
+import secrets
+import sys
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+def frame_label(code):
+    # ';' separates frames in the collapsed format
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ':')
+
+
+class StackSampler:
+    """Counts the stacks of one thread, sampled from a helper thread.
+
+    The sampler thread can only look while the profiled thread has released
+    the GIL, which it otherwise does every switch interval (5 ms) or around
+    I/O. Samples would then pile up on I/O calls. While any sampler runs,
+    the switch interval is lowered to the sampling interval.
+    """
+
+    _active = 0
+    _saved_switch_interval = None
+    _lock = threading.Lock()
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame.f_code))
+                frame = frame.f_back
+            self.stacks[tuple(reversed(stack))] += 1
+
+    def start(self):
+        with StackSampler._lock:
+            if StackSampler._active == 0:
+                StackSampler._saved_switch_interval = sys.getswitchinterval()
+                sys.setswitchinterval(min(self.interval, StackSampler._saved_switch_interval))
+            StackSampler._active += 1
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        with StackSampler._lock:
+            StackSampler._active -= 1
+            if StackSampler._active == 0:
+                sys.setswitchinterval(StackSampler._saved_switch_interval)
+        return self.stacks
+
+
+def collapsed(stacks, root=None, trim_to='wsgi_app'):
+    """Collapsed-stack lines for a {stack tuple: count} mapping.
+
+    Frames below the first `trim_to` function (the server or test client
+    that called Flask) are dropped so stacks line up across servers.
+    """
+    prefix = (root.replace(';', ':'),) if root else ()
+    merged = collections.Counter()
+    for stack, count in stacks.items():
+        start = next((i for i, frame in enumerate(stack) if frame.startswith(f'{trim_to} (')), 0) if trim_to else 0
+        merged[stack[start:]] += count
+    return [f"{';'.join(prefix + stack)} {count}" for stack, count in sorted(merged.items())]
+
+
+def route_slug(route):
+    return re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root'
+
+
+class _Profile:
+    __slots__ = ('route', 'path', 'profiler', 'sampler')
+
+    def __init__(self, route, path):
+        self.route = route
+        self.path = path
+        self.profiler = None
+        self.sampler = None
+
+
+def prune(directory, keep):
+    """Remove all but the `keep` newest profiles in a route directory"""
+    # Names start with a UTC timestamp, so they sort oldest first
+    names = sorted(name for name in os.listdir(directory) if name.endswith(('.folded', '.prof')))
+    for name in names[:max(len(names) - keep, 0)]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            # Pruned by a concurrent request
+            pass
+
+
+class RequestProfiler:
+    def __init__(self, directory, mode='sample', interval=0.005, max_concurrent=2, max_files=100):
+        if mode not in ('sample', 'cprofile'):
+            raise ValueError(f"Unknown profiling mode {mode!r}; expected 'sample' or 'cprofile'")
+        self.directory = directory
+        self.mode = mode
+        self.interval = interval
+        self.max_files = max_files
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+
+    def start(self, route):
+        """Profile the calling thread until stop(); None when all slots are busy"""
+        if not self.slots.acquire(blocking=False):
+            return None
+        name = f"{datetime.utcnow():%Y%m%dT%H%M%S%f}-{secrets.token_hex(3)}"
+        extension = 'folded' if self.mode == 'sample' else 'prof'
+        profile = _Profile(route, os.path.join(self.directory, route_slug(route), f"{name}.{extension}"))
+        try:
+            if self.mode == 'sample':
+                profile.sampler = StackSampler(threading.get_ident(), self.interval).start()
+            else:
+                profile.profiler = cProfile.Profile()
+                profile.profiler.enable()
+        except Exception:
+            # e.g. another profiler already owns this interpreter's profiling hook
+            self.slots.release()
+            return None
+        return profile
+
+    def stop(self, profile):
+        """Stop profiling and write the output file; returns its path, or None if it couldn't be written"""
+        try:
+            if profile.sampler is not None:
+                stacks = profile.sampler.stop()
+            else:
+                profile.profiler.disable()
+            directory = os.path.dirname(profile.path)
+            try:
+                os.makedirs(directory, exist_ok=True)
+                if profile.sampler is not None:
+                    with open(profile.path, 'w', encoding='utf-8') as f:
+                        f.writelines(line + '\n' for line in collapsed(stacks, root=profile.route))
+                else:
+                    profile.profiler.dump_stats(profile.path)
+                prune(directory, self.max_files)
+            except OSError as e:
+                logger.warning('Could not write profile %s: %s', profile.path, e)
+                return None
+            return profile.path
+        finally:
+            self.slots.release()
+
+
+def profile_call(func, mode='sample', interval=0.001):
+    """Run func() under a profiler; returns (result, stacks Counter or cProfile.Profile)"""
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+        result = profiler.runcall(func)
+        return result, profiler
+    sampler = StackSampler(threading.get_ident(), interval).start()
+    try:
+        result = func()
+    finally:
+        stacks = sampler.stop()
+    return result, stacks
+
+
+def self_time(stacks, limit=15):
+    """[(frame, samples)] of the frames at the top of the most samples"""
+    leaves = collections.Counter()
+    for stack, count in stacks.items():
+        if stack:
+            leaves[stack[-1]] += count
+    return leaves.most_common(limit)
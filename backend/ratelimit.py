@@ -0,0 +1,173 @@
+"""
+Admission control for the API.
+
+Two layers run before a request reaches the database:
+
+- Token buckets keyed by client (a known API key, else client IP) and
+  route, with a per-route refill rate and burst size. Requests over budget are answered
+  immediately with 429 and a Retry-After header.
+- A global concurrency limiter sized to the DB connection pool. When every
+  slot is busy the request is shed with 503 instead of queueing for a pool
+  connection.
+
+Bucket state lives in this process by default, split across lock stripes so
+concurrent requests rarely contend. RATE_LIMIT_REDIS_URL switches to a shared
+Redis backend (requires the `redis` package) so limits hold across instances.
+"""
+
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+
+# Route budgets as (tokens per second, burst). Keys are Flask endpoint names.
+DEFAULT_BUDGET = (20.0, 40)
+ROUTE_BUDGETS = {
+    'check_consent_status': (50.0, 100),
+    'get_consent_stats': (2.0, 10),
+    'get_consent_timeseries': (2.0, 10),
+    'update_consent': (10.0, 20),
+    'bulk_update_consent': (5.0, 10),
+    'stream_consent_changes': (0.2, 2),
+    'get_cohort_analytics': (0.5, 5),
+}
+EXEMPT_ENDPOINTS = {'health_check', 'static'}
+
+STRIPES = 64
+IDLE_SECONDS = 300
+
+
+def load_budgets():
+    """Route budgets with RATE_LIMITS JSON overrides, e.g. {"get_consent_stats": [1, 5]}"""
+    budgets = dict(ROUTE_BUDGETS)
+    overrides = os.getenv('RATE_LIMITS')
+    if overrides:
+        for endpoint, (rate, burst) in json.loads(overrides).items():
+            budgets[endpoint] = (float(rate), int(burst))
+    return budgets
+
+
+class LocalBackend:
+    """In-process token buckets, striped to keep lock hold times tiny"""
+
+    def __init__(self, stripes=STRIPES):
+        self.locks = [threading.Lock() for _ in range(stripes)]
+        self.buckets = [{} for _ in range(stripes)]
+        self.operations = [0] * stripes
+
+    def take(self, key, rate, burst, now=None):
+        """Take one token; returns (allowed, seconds until a token is available)"""
+        now = now if now is not None else time.monotonic()
+        stripe = hash(key) % len(self.locks)
+        with self.locks[stripe]:
+            buckets = self.buckets[stripe]
+            tokens, updated = buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            buckets[key] = (tokens, now)
+
+            self.operations[stripe] += 1
+            if self.operations[stripe] % 1024 == 0:
+                # Idle buckets would be full again anyway; drop them to bound memory
+                for stale in [k for k, (_, t) in buckets.items() if now - t > IDLE_SECONDS]:
+                    del buckets[stale]
+        return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+
+class RedisBackend:
+    """Token buckets shared across instances through Redis"""
+
+    SCRIPT = """
+        local tokens = tonumber(redis.call('HGET', KEYS[1], 't') or ARGV[2])
+        local updated = tonumber(redis.call('HGET', KEYS[1], 'u') or ARGV[3])
+        tokens = math.min(tonumber(ARGV[2]), tokens + (tonumber(ARGV[3]) - updated) * tonumber(ARGV[1]))
+        local allowed = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+            allowed = 1
+        end
+        redis.call('HSET', KEYS[1], 't', tokens, 'u', ARGV[3])
+        redis.call('EXPIRE', KEYS[1], ARGV[4])
+        return {allowed, tostring(tokens)}
+    """
+
+    def __init__(self, url):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.script = self.client.register_script(self.SCRIPT)
+
+    def take(self, key, rate, burst, now=None):
+        now = now if now is not None else time.time()
+        allowed, tokens = self.script(
+            keys=[f"ratelimit:{key}"],
+            args=[rate, burst, now, max(1, math.ceil(burst / rate))]
+        )
+        tokens = float(tokens)
+        return bool(allowed), 0.0 if allowed else (1 - tokens) / rate
+
+
+class ConcurrencyLimiter:
+    """Non-blocking cap on requests in flight"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        with self.lock:
+            if self.active >= self.limit:
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+
+
+class RateLimiter:
+    """Per-client, per-route token bucket admission"""
+
+    def __init__(self, backend, budgets=None):
+        self.backend = backend
+        self.budgets = budgets if budgets is not None else load_budgets()
+
+    @classmethod
+    def from_env(cls):
+        redis_url = os.getenv('RATE_LIMIT_REDIS_URL')
+        return cls(RedisBackend(redis_url) if redis_url else LocalBackend())
+
+    def check(self, client, endpoint):
+        """Returns (allowed, retry_after_seconds) for one request"""
+        rate, burst = self.budgets.get(endpoint, DEFAULT_BUDGET)
+        return self.backend.take(f"{client}|{endpoint}", rate, burst)
+
+
+def api_key_digest(api_key):
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+
+def load_api_keys():
+    """Digests of the comma-separated RATE_LIMIT_API_KEYS that get their own buckets"""
+    return frozenset(api_key_digest(key.strip()) for key in os.getenv('RATE_LIMIT_API_KEYS', '').split(',')
+                     if key.strip())
+
+
+def client_identity(request, api_keys=frozenset()):
+    """The client's API key if it is one of `api_keys` (digests), otherwise its IP address.
+
+    The header is not authenticated, so an unknown key is ignored: otherwise
+    a client could mint a fresh bucket per request just by changing it.
+    """
+    api_key = request.headers.get('X-API-Key')
+    if api_key:
+        digest = api_key_digest(api_key)
+        if digest in api_keys:
+            return 'key:' + digest[:32]
+    return 'ip:' + (request.remote_addr or 'unknown')
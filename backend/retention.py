@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Retention job for consent history.
+
+Partitioned PostgreSQL tables drop whole months at once: partitions that end
+before the retention cutoff are detached (kept as standalone tables for
+archiving) or dropped, which is instant and leaves no bloat to vacuum. On the
+single-table fallback old rows are deleted in small batches instead.
+
+The job also provisions upcoming partitions so it can be the only scheduled
+task needed. Run it from cron or as the scheduled `retention` Lambda.
+
+Usage:
+    python retention.py                    # detach expired partitions
+    python retention.py --mode drop
+    python retention.py --dry-run
+"""
+
+import argparse
+import os
+
+from dotenv import load_dotenv
+from sqlalchemy import DateTime, bindparam, text
+
+from partitions import (
+    HISTORY_TABLE, MONTHS_AHEAD, RETENTION_MONTHS, add_months, ensure_partitions,
+    history_window_start, is_partitioned, list_partitions
+)
+
+load_dotenv()
+
+RETENTION_MODE = os.getenv('CONSENT_HISTORY_RETENTION_MODE', 'detach')
+DELETE_BATCH_SIZE = int(os.getenv('CONSENT_HISTORY_DELETE_BATCH', '5000'))
+
+
+def expired_partitions(conn, cutoff):
+    """Partitions whose whole range lies before the cutoff"""
+    return [name for name, month in list_partitions(conn) if add_months(month, 1) <= cutoff]
+
+
+def retire_partitions(engine, cutoff, mode, dry_run=False):
+    """Detach or drop the expired partitions of a partitioned history table"""
+    with engine.begin() as conn:
+        names = expired_partitions(conn, cutoff)
+        for name in names:
+            if dry_run:
+                print(f"Would {mode} partition {name}")
+                continue
+            conn.exec_driver_sql(f"ALTER TABLE {HISTORY_TABLE} DETACH PARTITION {name}")
+            if mode == 'drop':
+                conn.exec_driver_sql(f"DROP TABLE {name}")
+            print(f"{'Dropped' if mode == 'drop' else 'Detached'} partition {name}")
+        if not dry_run:
+            ensure_partitions(conn, months_ahead=MONTHS_AHEAD)
+    return len(names)
+
+
+def delete_expired_rows(engine, cutoff, batch_size=DELETE_BATCH_SIZE, dry_run=False):
+    """Delete history rows older than the cutoff in short transactions"""
+    if dry_run:
+        with engine.connect() as conn:
+            count = conn.execute(
+                text(f"SELECT COUNT(*) FROM {HISTORY_TABLE} WHERE created_at < :cutoff")
+                .bindparams(bindparam('cutoff', type_=DateTime)),
+                {'cutoff': cutoff}
+            ).scalar()
+        print(f"Would delete {count} rows older than {cutoff:%Y-%m-%d}")
+        return 0
+
+    deleted = 0
+    while True:
+        with engine.begin() as conn:
+            result = conn.execute(text(
+                f"DELETE FROM {HISTORY_TABLE} WHERE id IN ("
+                f"SELECT id FROM {HISTORY_TABLE} WHERE created_at < :cutoff "
+                f"ORDER BY id LIMIT :limit)"
+            ).bindparams(bindparam('cutoff', type_=DateTime)), {'cutoff': cutoff, 'limit': batch_size})
+        deleted += result.rowcount
+        if result.rowcount < batch_size:
+            return deleted
+
+
+def apply_retention(engine, months=RETENTION_MONTHS, mode=RETENTION_MODE, dry_run=False):
+    """Apply the retention policy and return a summary dict"""
+    if mode not in ('detach', 'drop'):
+        raise ValueError("mode must be 'detach' or 'drop'")
+    cutoff = history_window_start(months=months)
+
+    with engine.connect() as conn:
+        partitioned = is_partitioned(conn)
+
+    if partitioned:
+        retired = retire_partitions(engine, cutoff, mode, dry_run=dry_run)
+        return {'cutoff': cutoff.isoformat(), 'partitioned': True, 'partitions_retired': retired}
+
+    deleted = delete_expired_rows(engine, cutoff, dry_run=dry_run)
+    return {'cutoff': cutoff.isoformat(), 'partitioned': False, 'rows_deleted': deleted}
+
+
+def handler(event, context):
+    """Lambda entry point for the scheduled retention job"""
+    from app import app, db
+
+    with app.app_context():
+        return apply_retention(db.engine)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Apply the consent history retention policy')
+    parser.add_argument('--months', type=int, default=RETENTION_MONTHS,
+                        help='months of history to keep (default: %(default)s)')
+    parser.add_argument('--mode', choices=['detach', 'drop'], default=RETENTION_MODE,
+                        help='what to do with expired partitions (default: %(default)s)')
+    parser.add_argument('--dry-run', action='store_true', help='only report what would change')
+    args = parser.parse_args()
+
+    from app import app, db
+
+    with app.app_context():
+        summary = apply_retention(db.engine, months=args.months, mode=args.mode, dry_run=args.dry_run)
+    print(f"✓ Retention applied: {summary}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Time-bucketed consent trend rollups.
+
+consent_rollups holds pre-aggregated opt-in/opt-out counts per purpose for
+hourly and daily buckets. Consent writes don't touch it: aggregate() folds
+history rows into it in change-feed order (see sequencer.py), tracked by the
+`rollups` row of change_cursors. Only one transaction aggregates at a time,
+so the hot current-hour buckets are updated once per batch instead of by
+every write transaction. The API server aggregates from a background job
+(ROLLUP_AGGREGATE_SECONDS, see scheduler.py); the trends endpoint only
+reads. This script or the scheduled `rollups` Lambda can do it instead.
+
+A backfill rebuilds the buckets inside the history retention window from
+consent_history, one day at a time. Older buckets are left alone, because
+the history they were built from may already have been removed. Each day
+is rebuilt and committed in its own transaction holding the rollups cursor,
+so it counts exactly the events of that day the cursor has already passed
+and never double counts ones aggregated later. Aggregation can run between
+days, so a long backfill never holds the cursor for long.
+
+Usage:
+    python rollups.py                       # rebuild from consent_history
+    python rollups.py --aggregate           # fold new history into the rollups
+    python rollups.py --source consents     # seed empty buckets from current consent rows
+    python rollups.py --batch-size 20000
+"""
+
+import argparse
+import os
+import time
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+from sqlalchemy import Boolean, DateTime, Integer, bindparam, column, text
+
+from partitions import history_window_start
+from sequencer import claim_cursor, move_cursor, sequence_changes
+
+load_dotenv()
+
+GRANULARITIES = {
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1)
+}
+ROLLUP_CURSOR = 'rollups'
+BACKFILL_BATCH_SIZE = int(os.getenv('ROLLUP_BACKFILL_BATCH', '10000'))
+AGGREGATE_BATCH_SIZE = int(os.getenv('ROLLUP_AGGREGATE_BATCH', '5000'))
+
+_EVENT_COLUMNS = (column('id', Integer), column('purpose_id', Integer),
+                  column('status', Boolean), column('event_time', DateTime))
+_PENDING = text(
+    "SELECT 1 FROM consent_history WHERE seq > COALESCE("
+    "(SELECT position FROM change_cursors WHERE name = :name), 0) LIMIT 1"
+)
+# Events are (position, purpose_id, status, timestamp)
+_NEW_EVENTS = text(
+    "SELECT seq AS id, purpose_id, status, created_at AS event_time FROM consent_history "
+    "WHERE seq > :position ORDER BY seq LIMIT :limit"
+).columns(*_EVENT_COLUMNS)
+_HISTORY_EVENTS = text(
+    "SELECT id, purpose_id, status, created_at AS event_time FROM consent_history "
+    "WHERE id > :last_id AND created_at >= :start AND created_at < :end AND seq <= :position "
+    "ORDER BY id LIMIT :limit"
+).bindparams(bindparam('start', type_=DateTime), bindparam('end', type_=DateTime)).columns(*_EVENT_COLUMNS)
+_DELETE_BUCKETS = text(
+    "DELETE FROM consent_rollups WHERE bucket_start >= :start AND bucket_start < :end"
+).bindparams(bindparam('start', type_=DateTime), bindparam('end', type_=DateTime))
+# Consents only know their latest state, so each row counts once at updated_at
+_CONSENT_EVENTS = text(
+    "SELECT id, purpose_id, status, updated_at AS event_time FROM consents "
+    "WHERE id > :last_id AND updated_at < :end ORDER BY id LIMIT :limit"
+).bindparams(bindparam('end', type_=DateTime)).columns(*_EVENT_COLUMNS)
+
+
+def bucket_start(dt, granularity):
+    """Truncate a timestamp to the start of its bucket"""
+    if granularity == 'hour':
+        return dt.replace(minute=0, second=0, microsecond=0)
+    if granularity == 'day':
+        return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    raise ValueError(f"Unknown granularity: {granularity}")
+
+
+def _count(rows, counts):
+    for _, purpose_id, status, event_time in rows:
+        for granularity in GRANULARITIES:
+            key = (granularity, bucket_start(event_time, granularity), purpose_id)
+            opt_ins, opt_outs = counts.get(key, (0, 0))
+            counts[key] = (opt_ins + (1 if status else 0), opt_outs + (0 if status else 1))
+    return counts
+
+
+def _apply(conn, upsert, counts):
+    # Sorted, so transactions that touch the same buckets lock them in the same order
+    for (granularity, start, purpose_id), (opt_ins, opt_outs) in sorted(counts.items()):
+        upsert(conn, granularity, start, purpose_id, opt_ins, opt_outs)
+
+
+def _replay(conn, query, params, batch_size):
+    """Count every event `query` pages out by id; returns (counts, rows read)"""
+    counts = {}
+    last_id = 0
+    read = 0
+    while True:
+        rows = conn.execute(query, {**params, 'last_id': last_id, 'limit': batch_size}).fetchall()
+        _count(rows, counts)
+        read += len(rows)
+        if len(rows) < batch_size:
+            return counts, read
+        last_id = rows[-1][0]
+
+
+def aggregate(engine, upsert, batch_size=AGGREGATE_BATCH_SIZE):
+    """Fold history numbered since the last run into the rollups; returns the events added.
+
+    `upsert(conn, granularity, bucket_start, purpose_id, opt_ins, opt_outs)`
+    adds the counts to a bucket. Returns at once if another transaction is
+    already aggregating.
+    """
+    sequence_changes(engine)
+    added = 0
+    while True:
+        with engine.connect() as conn:
+            if conn.execute(_PENDING, {'name': ROLLUP_CURSOR}).first() is None:
+                return added
+        with engine.begin() as conn:
+            position = claim_cursor(conn, ROLLUP_CURSOR)
+            if position is None:
+                return added
+            rows = conn.execute(_NEW_EVENTS, {'position': position, 'limit': batch_size}).fetchall()
+            if rows:
+                _apply(conn, upsert, _count(rows, {}))
+                move_cursor(conn, ROLLUP_CURSOR, rows[-1][0])
+        added += len(rows)
+        if len(rows) < batch_size:
+            return added
+
+
+def backfill(engine, upsert, batch_size=BACKFILL_BATCH_SIZE, now=None):
+    """Rebuild the buckets inside the history window a day per transaction; returns the events replayed"""
+    now = now or datetime.utcnow()
+    window_start = history_window_start(now)
+    # The first whole day in the window; a partial one would be rebuilt short
+    start = bucket_start(window_start, 'day')
+    if start < window_start:
+        start += GRANULARITIES['day']
+    replayed = 0
+    day = start
+    while day <= now:
+        end = day + GRANULARITIES['day']
+        # A day's hourly and daily buckets are rebuilt together against one cursor position
+        with engine.begin() as conn:
+            position = claim_cursor(conn, ROLLUP_CURSOR, wait=True)
+            conn.execute(_DELETE_BUCKETS, {'start': day, 'end': end})
+            counts, read = _replay(conn, _HISTORY_EVENTS,
+                                   {'start': day, 'end': end, 'position': position}, batch_size)
+            _apply(conn, upsert, counts)
+        replayed += read
+        day = end
+    print(f"✓ Rollups from {start:%Y-%m-%d} rebuilt")
+    return replayed
+
+
+def seed_from_consents(engine, upsert, batch_size=BACKFILL_BATCH_SIZE, now=None):
+    """Fill buckets before the history window that have no rollup yet; returns the consents read.
+
+    For databases whose history is incomplete: every consent counts once, at
+    its latest state. Existing buckets are never changed.
+    """
+    window_start = history_window_start(now or datetime.utcnow())
+    with engine.begin() as conn:
+        counts, read = _replay(conn, _CONSENT_EVENTS, {'end': window_start}, batch_size)
+        existing = set(conn.execute(text(
+            "SELECT granularity, bucket_start, purpose_id FROM consent_rollups WHERE bucket_start < :end"
+        ).bindparams(bindparam('end', type_=DateTime)).columns(
+            column('granularity'), column('bucket_start', DateTime), column('purpose_id', Integer)
+        ), {'end': window_start}).fetchall())
+        _apply(conn, upsert, {key: value for key, value in counts.items()
+                              if key not in existing and key[1] < bucket_start(window_start, key[0])})
+    return read
+
+
+def handler(event, context):
+    """Lambda entry point for the scheduled aggregation"""
+    from app import app, db, upsert_rollup
+
+    with app.app_context():
+        return {'aggregated': aggregate(db.engine, upsert_rollup)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintain consent trend rollups')
+    parser.add_argument('--aggregate', action='store_true',
+                        help='fold new history into the rollups instead of rebuilding')
+    parser.add_argument('--source', choices=['history', 'consents'], default='history',
+                        help='table to replay (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=BACKFILL_BATCH_SIZE,
+                        help='rows per batch (default: %(default)s)')
+    args = parser.parse_args()
+
+    from app import app, db, upsert_rollup
+
+    started = time.time()
+    with app.app_context():
+        if args.aggregate:
+            count = aggregate(db.engine, upsert_rollup, batch_size=args.batch_size)
+            print(f"✓ Aggregated {count} changes in {time.time() - started:.1f}s")
+        elif args.source == 'consents':
+            count = seed_from_consents(db.engine, upsert_rollup, batch_size=args.batch_size)
+            print(f"✓ Seeded from {count} consents in {time.time() - started:.1f}s")
+        else:
+            count = backfill(db.engine, upsert_rollup, batch_size=args.batch_size)
+            print(f"✓ Backfill complete: {count} rows replayed in {time.time() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+In-process periodic jobs for the API server.
+
+Maintenance that read endpoints used to do inline (folding the change feed
+into the trend rollups) runs here instead, so GETs never write. A
+PeriodicJob calls its function every `interval` seconds in a daemon thread,
+or sooner when notify() is called.
+
+The thread is started by the first request a process serves, not on import:
+gunicorn forks workers from a preloaded master, and threads don't survive a
+fork, so each worker starts its own. CLIs that import the app never start
+one. Every worker runs the job; the jobs claim a change_cursors row with
+SKIP LOCKED (see sequencer.py), so only one of them does the work at a time.
+
+Errors are logged and the job runs again at the next interval. An interval
+of 0 disables the job; cron or a scheduled Lambda does the work instead.
+"""
+
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicJob:
+    """Run `job()` every `interval` seconds in a daemon thread"""
+
+    def __init__(self, name, job, interval):
+        self.name = name
+        self.job = job
+        self.interval = interval
+        self.runs = 0
+        self.errors = 0
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Start the thread in this process unless it is running or disabled; returns whether it started"""
+        if self.interval <= 0 or self._pid == os.getpid():
+            return False
+        with self._lock:
+            if self._pid == os.getpid():
+                return False
+            # Events copied from a parent process may hold its thread's state
+            self._wake = threading.Event()
+            self._stopped = threading.Event()
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name=self.name, daemon=True).start()
+            return True
+
+    def notify(self):
+        """Run the job as soon as the thread is free instead of at the next interval"""
+        self._wake.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+
+    def _run(self):
+        wake, stopped = self._wake, self._stopped
+        while True:
+            wake.wait(self.interval)
+            wake.clear()
+            if stopped.is_set():
+                return
+            try:
+                self.job()
+                self.runs += 1
+            except Exception:
+                self.errors += 1
+                logger.exception('Background job %s failed', self.name)
@@ -12,7 +12,8 @@ def seed_data():
         purposes = [
             Purpose(
                 name="Marketing Communications",
-                description="Receive marketing emails and promotional offers"
+                description="Receive marketing emails and promotional offers",
+                consent_lifetime_days=395
             ),
             Purpose(
                 name="Analytics",
@@ -24,7 +25,8 @@ def seed_data():
             ),
             Purpose(
                 name="Third-party Sharing",
-                description="Share your data with trusted third-party partners"
+                description="Share your data with trusted third-party partners",
+                consent_lifetime_days=365
             )
         ]
 
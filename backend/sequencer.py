@@ -0,0 +1,107 @@
+"""
+Commit-ordered sequence numbers for consent_history.
+
+History ids are handed out when a row is inserted, not when its transaction
+commits, so a slow transaction can commit id 41 after a reader has already
+seen id 42; a reader paging by id would skip it for good. Instead, history
+rows are written with `seq` NULL and numbered once they are visible.
+
+sequence_changes() locks the `sequence` row of change_cursors, numbers
+every committed unsequenced row from the cursor position upwards, moves the
+cursor and commits. Only committed rows can be seen, and only one
+transaction numbers at a time, so every seq at or below the highest visible
+one is already visible: a reader's `since` never moves past a change that
+can still appear.
+
+Numbering is done on the write side, so change feed reads never write or
+wait for the cursor lock. The API calls sequence_changes() right after each
+consent write commits (commit_changes in app.py). A writer that finds the
+cursor locked leaves its rows to the holder, whose batch may have been read
+before they committed; a background sweep in every API process
+(CHANGE_SEQUENCE_SWEEP_SECONDS) numbers those, and rows of a writer that
+died between its commit and numbering. Until a row is numbered it is simply
+not in the feed yet.
+
+change_cursors holds one position per consumer of the sequence (see also
+rollups.py), each claimed the same way.
+
+Works with pg8000 and SQLite.
+"""
+
+import os
+
+from dotenv import load_dotenv
+from sqlalchemy import DateTime, Integer, bindparam, text
+
+load_dotenv()
+
+SEQUENCE_CURSOR = 'sequence'
+SEQUENCE_BATCH_SIZE = int(os.getenv('CHANGE_SEQUENCE_BATCH', '1000'))
+
+_PENDING = text("SELECT 1 FROM consent_history WHERE seq IS NULL LIMIT 1")
+_UNSEQUENCED = text(
+    "SELECT id, created_at FROM consent_history WHERE seq IS NULL ORDER BY id LIMIT :limit"
+).columns(id=Integer, created_at=DateTime)
+# created_at lets PostgreSQL go straight to the row's partition
+_NUMBER = text(
+    "UPDATE consent_history SET seq = :seq WHERE id = :id AND created_at = :created_at"
+).bindparams(bindparam('created_at', type_=DateTime))
+
+
+def _lock_cursor(conn, name, wait):
+    if conn.dialect.name == 'postgresql':
+        return conn.execute(text(
+            "SELECT position FROM change_cursors WHERE name = :name FOR UPDATE"
+            + ("" if wait else " SKIP LOCKED")
+        ), {'name': name}).scalar()
+    # SQLite has a single writer; a no-op write takes the database lock
+    conn.execute(text("UPDATE change_cursors SET position = position WHERE name = :name"), {'name': name})
+    return conn.execute(text("SELECT position FROM change_cursors WHERE name = :name"), {'name': name}).scalar()
+
+
+def claim_cursor(conn, name, wait=False):
+    """Lock a cursor for the current transaction and return its position.
+
+    Returns None if another transaction holds it and `wait` is false. A
+    missing cursor is created at the start of the sequence.
+    """
+    position = _lock_cursor(conn, name, wait)
+    if position is None and conn.execute(
+        text("SELECT 1 FROM change_cursors WHERE name = :name"), {'name': name}
+    ).first() is None:
+        conn.execute(text(
+            "INSERT INTO change_cursors (name, position) VALUES (:name, 0) ON CONFLICT (name) DO NOTHING"
+        ), {'name': name})
+        position = _lock_cursor(conn, name, wait)
+    return position
+
+
+def move_cursor(conn, name, position):
+    conn.execute(text("UPDATE change_cursors SET position = :position WHERE name = :name"),
+                 {'name': name, 'position': position})
+
+
+def sequence_changes(engine, batch_size=SEQUENCE_BATCH_SIZE):
+    """Number committed history rows that have no seq yet; returns how many were numbered"""
+    numbered = 0
+    while True:
+        # Readers poll often; only take the cursor lock when there is work
+        with engine.connect() as conn:
+            if conn.execute(_PENDING).first() is None:
+                return numbered
+        with engine.begin() as conn:
+            position = claim_cursor(conn, SEQUENCE_CURSOR)
+            if position is None:
+                # Another reader is numbering; its rows show up on the next poll
+                return numbered
+            rows = conn.execute(_UNSEQUENCED, {'limit': batch_size}).fetchall()
+            if rows:
+                conn.execute(_NUMBER, [
+                    {'seq': position + offset, 'id': row_id, 'created_at': created_at}
+                    for offset, (row_id, created_at) in enumerate(rows, start=1)
+                ])
+                move_cursor(conn, SEQUENCE_CURSOR, position + len(rows))
+        numbered += len(rows)
+        if len(rows) < batch_size:
+            return numbered
+
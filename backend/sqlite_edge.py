@@ -0,0 +1,185 @@
+"""
+Tuned SQLite backend for single-node ("edge") deployments.
+
+With DATABASE_URL=sqlite:///path/to/consent.db the app runs on an embedded
+database file instead of PostgreSQL. Out of the box SQLite serializes
+writers behind a file lock, fsyncs on every commit and rolls back the
+journal, and concurrent writers fail with "database is locked" as soon as
+the default timeout runs out. This module configures every connection for
+a small multi-threaded server:
+
+    journal_mode = WAL        readers never block the writer and vice versa
+    synchronous  = NORMAL     fsync at checkpoints only; a power cut can lose
+                              the last commits but never corrupts the file
+    busy_timeout              wait for another process's write lock
+    cache_size / mmap_size    page cache per connection, shared mmap reads
+    temp_store   = MEMORY
+
+The pragmas are applied once, when a connection is opened. Connections are
+pooled (QueuePool, sized like the PostgreSQL pool) and shared across threads
+one checkout at a time, so a tuned connection and its warm page cache are
+reused by whichever request runs next.
+
+Writes go through a single-writer queue. The first INSERT, UPDATE or
+DELETE of a transaction takes the process's writer slot, in FIFO order,
+and opens the transaction with BEGIN IMMEDIATE. The slot is handed to the
+next waiting thread on commit or rollback. Threads therefore queue for the
+write lock in Python instead of spinning on SQLITE_BUSY. Reads run outside
+the queue against WAL snapshots. Between processes (gunicorn workers),
+BEGIN IMMEDIATE and busy_timeout do the same job.
+
+Set SQLITE_EDGE=0 to get plain pysqlite connections.
+"""
+
+import collections
+import os
+import sqlite3
+import threading
+import time
+
+from sqlalchemy.pool import QueuePool
+
+SQLITE_EDGE = os.getenv('SQLITE_EDGE', '1').lower() in ('1', 'true', 'yes')
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+# Per connection, so this is multiplied by the thread count
+SQLITE_CACHE_KB = int(os.getenv('SQLITE_CACHE_KB', '16384'))
+SQLITE_MMAP_BYTES = int(os.getenv('SQLITE_MMAP_BYTES', str(256 * 1024 * 1024)))
+
+_WRITE_VERBS = ('INSERT', 'UPDATE', 'DELETE', 'REPLAC')
+
+
+class WriterQueue:
+    """A FIFO lock: waiting threads get the writer slot in arrival order"""
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self._mutex = threading.Lock()
+        self._waiters = collections.deque()
+        self._held = False
+        self.stats = {'acquired': 0, 'waited': 0, 'wait_ms': 0.0, 'max_queue': 0, 'timeouts': 0}
+
+    def acquire(self, timeout):
+        with self._mutex:
+            self.stats['acquired'] += 1
+            if not self._held:
+                self._held = True
+                return
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+            self.stats['waited'] += 1
+            self.stats['max_queue'] = max(self.stats['max_queue'], len(self._waiters))
+        started = time.perf_counter()
+        if not waiter.wait(timeout):
+            with self._mutex:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    self.stats['timeouts'] += 1
+                    raise sqlite3.OperationalError('database is locked (timed out in the writer queue)')
+            # Handed the slot just as the wait timed out
+        with self._mutex:
+            self.stats['wait_ms'] += (time.perf_counter() - started) * 1000
+
+    def release(self):
+        with self._mutex:
+            if self._waiters:
+                # Hand over directly so no newcomer can cut in
+                self._waiters.popleft().set()
+            else:
+                self._held = False
+
+
+writer_queue = WriterQueue()
+# A worker forked while another thread held the slot must not inherit it
+os.register_at_fork(after_in_child=writer_queue._reset)
+
+
+class _Cursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        self.connection._before_statement(sql)
+        return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        self.connection._before_statement(sql)
+        return super().executemany(sql, seq_of_parameters)
+
+
+class TunedConnection(sqlite3.Connection):
+    """pysqlite connection with the edge pragmas and writer queue"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.holds_writer = False
+        # On connect; pragmas last for the connection's lifetime in the pool
+        for pragma in (
+            'journal_mode = WAL',
+            f'synchronous = {SQLITE_SYNCHRONOUS}',
+            f'busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}',
+            f'cache_size = -{SQLITE_CACHE_KB}',
+            f'mmap_size = {SQLITE_MMAP_BYTES}',
+            'temp_store = MEMORY',
+        ):
+            super().execute(f'PRAGMA {pragma}')
+
+    def cursor(self, factory=_Cursor):
+        return super().cursor(factory)
+
+    def _before_statement(self, sql):
+        # pysqlite opens the transaction (BEGIN IMMEDIATE) right before the
+        # first write; take the writer slot just ahead of it
+        if not self.holds_writer and not self.in_transaction and sql.lstrip()[:6].upper() in _WRITE_VERBS:
+            writer_queue.acquire(SQLITE_BUSY_TIMEOUT_MS / 1000)
+            self.holds_writer = True
+
+    def _release_writer(self):
+        if self.holds_writer:
+            self.holds_writer = False
+            writer_queue.release()
+
+    def commit(self):
+        try:
+            super().commit()
+        finally:
+            self._release_writer()
+
+    def rollback(self):
+        try:
+            super().rollback()
+        finally:
+            self._release_writer()
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._release_writer()
+
+
+def enabled(database_uri):
+    """True for file-backed SQLite URLs unless SQLITE_EDGE=0"""
+    return SQLITE_EDGE and database_uri.startswith('sqlite') and ':memory:' not in database_uri \
+        and database_uri.rstrip('/') not in ('sqlite:', 'sqlite+pysqlite:')
+
+
+def engine_options(pool_size, max_overflow):
+    """SQLALCHEMY_ENGINE_OPTIONS with the same pool sizing as other backends"""
+    return {
+        'poolclass': QueuePool,
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'connect_args': {
+            'factory': TunedConnection,
+            'timeout': SQLITE_BUSY_TIMEOUT_MS / 1000,
+            'isolation_level': 'IMMEDIATE',
+            # Pooled connections move between threads, one checkout at a time
+            'check_same_thread': False,
+        },
+    }
+
+
+def settings(connection):
+    """Current pragma values of a DBAPI connection, for diagnostics"""
+    names = ('journal_mode', 'synchronous', 'busy_timeout', 'cache_size', 'mmap_size', 'temp_store')
+    return {name: connection.execute(f'PRAGMA {name}').fetchone()[0] for name in names}
@@ -2,11 +2,16 @@
 """
 Startup script for the Consent Management API
 This script will:
-1. Create the database if it doesn't exist
-2. Seed initial data
-3. Start the Flask server
+1. Install dependencies (skip with --skip-install)
+2. Create the database if it doesn't exist and seed initial data (skip with --skip-db)
+3. Start the Flask development server, or gunicorn with --production
+
+Usage:
+    python start_server.py
+    python start_server.py --production --skip-install --workers 4 --threads 8
 """
 
+import argparse
 import os
 import sys
 import subprocess
@@ -45,10 +50,9 @@ def create_database():
         from create_db import create_database
         create_database()
         
-        # Import and run app to create tables
-        from app import app, db
-        with app.app_context():
-            db.create_all()
+        # Create or upgrade the tables through the versioned migrations
+        from create_db import migrate_schema
+        migrate_schema()
         
         print("✓ Database and tables created")
         return True
@@ -84,8 +88,36 @@ def start_server():
     except Exception as e:
         print(f"Error starting server: {e}")
 
+def start_production_server(bind=None, workers=None, threads=None):
+    """Replace this process with gunicorn, configured by gunicorn.conf.py"""
+    # Passed through the environment so gunicorn.conf.py can size the
+    # per-worker connection pool from the thread count
+    for name, value in (('GUNICORN_BIND', bind), ('GUNICORN_WORKERS', workers), ('GUNICORN_THREADS', threads)):
+        if value is not None:
+            os.environ[name] = str(value)
+    print("Starting gunicorn...")
+    print("-" * 50)
+    sys.stdout.flush()
+    try:
+        os.execvp(sys.executable, [sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py', 'app:app'])
+    except OSError as e:
+        print(f"Error starting gunicorn: {e}")
+        sys.exit(1)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Set up and start the Consent Management API')
+    parser.add_argument('--production', action='store_true',
+                        help='run gunicorn with preloaded, multi-threaded workers instead of the dev server')
+    parser.add_argument('--workers', type=int, help='gunicorn worker processes (default: 2 x CPUs + 1, within DB_CONNECTION_BUDGET)')
+    parser.add_argument('--threads', type=int, help='threads per gunicorn worker (default: 4)')
+    parser.add_argument('--bind', help='gunicorn address (default: 0.0.0.0:5000)')
+    parser.add_argument('--skip-install', action='store_true', help="don't pip install requirements.txt")
+    parser.add_argument('--skip-db', action='store_true', help="don't create tables or seed data")
+    return parser.parse_args()
+
 def main():
     """Main startup function"""
+    args = parse_args()
     print("Consent Management API Startup")
     print("=" * 40)
     
@@ -94,19 +126,23 @@ def main():
         sys.exit(1)
     
     # Install dependencies
-    if not install_dependencies():
-        sys.exit(1)
-    
-    # Create database
-    if not create_database():
+    if not args.skip_install and not install_dependencies():
         sys.exit(1)
     
-    # Seed data
-    if not seed_data():
-        sys.exit(1)
+    if not args.skip_db:
+        # Create database
+        if not create_database():
+            sys.exit(1)
+        
+        # Seed data
+        if not seed_data():
+            sys.exit(1)
     
     # Start server
-    start_server()
+    if args.production:
+        start_production_server(args.bind, args.workers, args.threads)
+    else:
+        start_server()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Incremental consent export for the data warehouse.
+
+Pages through GET /api/consent/sync from the last saved watermark and
+appends every record to an NDJSON file (or stdout). The first run exports a
+snapshot of all consents, then follows the change feed; deletes and
+expiries arrive as records with "deleted": true. The watermark is saved to
+a small JSON state file after each page, once that page's records are
+flushed to disk. The next run picks up where this one stopped; delete the
+state file to re-export everything. A run that falls further behind than
+the history retention window should also start over.
+
+Load the output keyed on (user_id, purpose_id), applying records in file
+order: the last one wins, and a deleted one removes the consent. A crash
+between writing a page and saving the watermark re-exports that page on
+the next run, which this makes harmless.
+
+Usage:
+    python sync_consents.py --output consents.ndjson
+    python sync_consents.py --output consents.ndjson --state sync_state.json --limit 5000
+    python sync_consents.py --follow --interval 60 > consents.ndjson
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from consent_client import DEFAULT_BASE_URL, ConsentClient
+
+DEFAULT_STATE_FILE = 'sync_state.json'
+
+
+def load_watermark(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_watermark(path, watermark):
+    # Write then rename so a crash never leaves a half-written state file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(watermark, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def sync(client, output, state_path, limit):
+    """Export every page available now; returns the number of rows written"""
+    watermark = load_watermark(state_path)
+    written = 0
+    while True:
+        page = client.sync(watermark, limit=limit)
+        for consent in page['consents']:
+            output.write(json.dumps(consent) + '\n')
+        output.flush()
+        if output is not sys.stdout:
+            os.fsync(output.fileno())
+        written += len(page['consents'])
+        # Saved even for an empty page: it may move from the snapshot to the feed
+        if page['watermark'] != watermark:
+            watermark = page['watermark']
+            save_watermark(state_path, watermark)
+        if not page['has_more']:
+            return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export consents changed since the last run')
+    parser.add_argument('--base-url', default=os.getenv('CONSENT_API_URL', DEFAULT_BASE_URL))
+    parser.add_argument('--api-key', default=os.getenv('CONSENT_API_KEY'))
+    parser.add_argument('--output', help='NDJSON file to append to (default: stdout)')
+    parser.add_argument('--state', default=DEFAULT_STATE_FILE, help='watermark file (default: %(default)s)')
+    parser.add_argument('--limit', type=int, default=1000, help='rows per page (default: %(default)s)')
+    parser.add_argument('--follow', action='store_true', help='keep polling for new changes')
+    parser.add_argument('--interval', type=float, default=60, help='seconds between polls with --follow')
+    args = parser.parse_args()
+
+    output = open(args.output, 'a') if args.output else sys.stdout
+    try:
+        with ConsentClient(args.base_url, api_key=args.api_key) as client:
+            while True:
+                written = sync(client, output, args.state, args.limit)
+                print(f"✓ Exported {written} consent records", file=sys.stderr)
+                if not args.follow:
+                    break
+                time.sleep(args.interval)
+    except KeyboardInterrupt:
+        print("\nSync stopped", file=sys.stderr)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Shared fixtures.
+
+app.py reads its configuration from the environment when it is imported,
+so the environment is set up here, before any test module imports it: a
+throwaway SQLite database (edge mode, like a single-node deployment), rate
+limiting off unless a test turns it on, no response caching and consent
+tokens enabled.
+"""
+
+import os
+import shutil
+import tempfile
+
+import pytest
+
+_DATABASE_DIR = tempfile.mkdtemp(prefix='consent-tests-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_DATABASE_DIR, 'consent.db')
+os.environ['RATE_LIMIT_ENABLED'] = '0'
+os.environ['COALESCE_TTL_MS'] = '0'
+# Background jobs would race the fixtures' drop_all(); tests run them directly
+os.environ['ROLLUP_AGGREGATE_SECONDS'] = '0'
+os.environ['CHANGE_SEQUENCE_SWEEP_SECONDS'] = '0'
+os.environ['CONSENT_TOKEN_SECRET'] = 'test-secret'
+for name in ('CONSENT_INDEX_PATH', 'TRACE_EXPORTER', 'WARMUP_ON_START', 'PROFILE_SAMPLE_RATE'):
+    os.environ.pop(name, None)
+
+PURPOSES = ['Marketing', 'Analytics', 'Personalization', 'Sharing']
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(_DATABASE_DIR, ignore_errors=True)
+
+
+@pytest.fixture
+def app():
+    """The app on empty tables with the four demo purposes (ids 1-4)"""
+    import app as app_module
+    from app import Purpose, app, db
+
+    # Catalog caches outlive a test's tables
+    for cache in (app_module._catalog_version, app_module._purpose_names, app_module._purpose_catalog,
+                  app_module._webhook_endpoints):
+        cache['loaded_at'] = None
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        for name in PURPOSES:
+            db.session.add(Purpose(name=name, description=name))
+        db.session.commit()
+        yield app
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def give_consent(client):
+    """POST /api/consent and return the response JSON"""
+    def give(user_id, purpose_id, status=True, **kwargs):
+        response = client.post('/api/consent', json={
+            'user_id': user_id, 'purpose_id': purpose_id, 'status': status
+        }, **kwargs)
+        assert response.status_code == 200, response.get_data(as_text=True)
+        return response.get_json()
+    return give
@@ -0,0 +1,122 @@
+"""HyperLogLog distinct users, sampling and confidence intervals"""
+
+import random
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import text
+
+from approx_stats import (
+    ALL_PURPOSES, HLL_REGISTERS, backfill_sketches, hll_estimate, hll_register, hll_standard_error,
+    load_sketches, sample_consents, wilson_interval
+)
+
+
+def _sketch(values):
+    registers = {}
+    for value in values:
+        index, rank = hll_register(value)
+        registers[index] = max(registers.get(index, 0), rank)
+    return registers
+
+
+def test_register_is_stable_and_in_range():
+    assert hll_register('user-1') == hll_register('user-1')
+    index, rank = hll_register('user-1')
+    assert 0 <= index < HLL_REGISTERS and rank >= 1
+
+
+@pytest.mark.parametrize('count', [100, 1000, 10000, 100000])
+def test_estimate_within_three_standard_errors(count):
+    estimate = hll_estimate(_sketch(f'user-{i}' for i in range(count)))
+    assert abs(estimate - count) <= 3 * hll_standard_error() * count
+
+
+def test_estimate_ignores_repeats():
+    values = [f'user-{i % 500}' for i in range(5000)]
+    assert _sketch(values) == _sketch(set(values))
+    assert hll_estimate({}) == 0
+
+
+def test_wilson_interval():
+    assert wilson_interval(0, 0) == (0.0, 1.0)
+    low, high = wilson_interval(30, 100)
+    assert low < 0.3 < high and high - low < 0.2
+    # Never outside [0, 1], and never zero width at the edges
+    assert wilson_interval(0, 50)[0] == 0.0 and wilson_interval(0, 50)[1] > 0
+    assert wilson_interval(50, 50)[1] == 1.0 and wilson_interval(50, 50)[0] < 1
+    # More samples, narrower interval
+    assert wilson_interval(300, 1000)[1] - wilson_interval(300, 1000)[0] < high - low
+
+
+def _insert_consents(db, count, expires_at=None):
+    now = datetime.utcnow()
+    with db.engine.begin() as conn:
+        conn.execute(text(
+            "INSERT INTO consents (user_id, purpose_id, status, created_at, updated_at, expires_at) "
+            "VALUES (:user_id, :purpose_id, :status, :now, :now, :expires_at)"
+        ), [{'user_id': f'user-{i}', 'purpose_id': 1 + i % 2, 'status': i % 3 != 0,
+             'now': now, 'expires_at': expires_at} for i in range(count)])
+
+
+def test_backfill_registers_existing_consents(app):
+    from app import db
+
+    _insert_consents(db, 300)
+    assert backfill_sketches(db.engine, batch_size=64) == 300
+    with db.engine.connect() as conn:
+        sketches = load_sketches(conn)
+    assert sketches[ALL_PURPOSES] == _sketch(f'user-{i}' for i in range(300))
+    assert abs(hll_estimate(sketches[1]) - 150) <= 3 * hll_standard_error() * 150
+    # Registers only grow, so running it again changes nothing
+    backfill_sketches(db.engine)
+    with db.engine.connect() as conn:
+        assert load_sketches(conn) == sketches
+
+
+def test_writes_register_distinct_users(app, give_consent):
+    from app import db
+
+    for user_id in ('a', 'b', 'c'):
+        give_consent(user_id, 1)
+        give_consent(user_id, 1, status=False)
+    with db.engine.connect() as conn:
+        assert hll_estimate(load_sketches(conn)[1]) == 3
+
+
+def test_key_probe_sample_scales_by_hit_rate(app):
+    from app import db
+
+    _insert_consents(db, 2000)
+    with db.engine.begin() as conn:
+        conn.execute(text("DELETE FROM consents WHERE id % 2 = 0"))
+    random.seed(7)
+    with db.engine.connect() as conn:
+        rows, estimated_total, exact = sample_consents(conn, sample_rows=400)
+    assert not exact
+    assert 800 <= estimated_total <= 1200
+    assert sum(row[1] for row in rows) <= 400
+
+
+def test_small_tables_are_counted_exactly(app):
+    from app import db
+
+    _insert_consents(db, 40)
+    with db.engine.connect() as conn:
+        rows, estimated_total, exact = sample_consents(conn, sample_rows=100)
+    assert exact and estimated_total == 40
+    assert sorted(rows) == [(1, 20, 13), (2, 20, 13)]
+
+
+def test_approx_stats_endpoint(app, client):
+    from app import db
+
+    _insert_consents(db, 30)
+    _insert_consents(db, 10, expires_at=datetime.utcnow() - timedelta(days=1))
+    backfill_sketches(db.engine)
+    stats = client.get('/api/consent/stats?mode=approx').get_json()
+    assert stats['exact'] and stats['total_consents'] == 30
+    assert stats['consent_rate_ci'][0] <= stats['consent_rate'] <= stats['consent_rate_ci'][1]
+    assert [p['purpose_name'] for p in stats['by_purpose']] == ['Marketing', 'Analytics']
+    assert stats['distinct_users'] == 30
+    assert client.get('/api/consent/stats?mode=fast').status_code == 400
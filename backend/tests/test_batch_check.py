@@ -0,0 +1,86 @@
+"""POST /consent/check/batch bitmask and columnar results"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+
+def _check(client, user_ids, purpose_ids, **body):
+    response = client.post('/api/consent/check/batch', json={'user_ids': user_ids, 'purpose_ids': purpose_ids, **body})
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return response.get_json()
+
+
+def test_bits_follow_the_order_of_purpose_ids(client, give_consent):
+    give_consent('u1', 1)
+    give_consent('u1', 2, status=False)
+    give_consent('u1', 3)
+    give_consent('u2', 3, status=False)
+    result = _check(client, ['u1', 'u2', 'nobody'], [1, 2, 3])
+    assert result['granted'] == [0b101, 0, 0]
+    assert result['recorded'] == [0b111, 0b100, 0]
+    # Reordering purposes moves the bits with them
+    result = _check(client, ['u1'], [3, 1, 2, 4])
+    assert result['granted'] == [0b0011] and result['recorded'] == [0b0111]
+
+
+def test_columnar_matches_bitmask(client, give_consent):
+    give_consent('u1', 1)
+    give_consent('u2', 1, status=False)
+    give_consent('u2', 2)
+    bitmask = _check(client, ['u1', 'u2', 'u3'], [1, 2])
+    columnar = _check(client, ['u1', 'u2', 'u3'], [1, 2], format='columnar')
+    assert columnar['status'] == {'1': [True, False, None], '2': [None, True, None]}
+    for purpose_id, column in columnar['status'].items():
+        mask = 1 << bitmask['purpose_ids'].index(int(purpose_id))
+        for index, status in enumerate(column):
+            assert (status is not None) == bool(bitmask['recorded'][index] & mask)
+            assert bool(status) == bool(bitmask['granted'][index] & mask)
+
+
+def test_duplicates_are_collapsed(client, give_consent):
+    give_consent('u1', 2)
+    result = _check(client, ['u1', 'u1', 'u2'], [2, 2, 1])
+    assert result['user_ids'] == ['u1', 'u2'] and result['purpose_ids'] == [2, 1]
+    assert result['granted'] == [0b01, 0]
+
+
+def test_expired_consents_count_as_absent(app, client, give_consent):
+    from app import Consent, db
+
+    give_consent('u1', 1)
+    give_consent('u1', 2)
+    Consent.query.filter_by(user_id='u1', purpose_id=2).one().expires_at = datetime.utcnow() - timedelta(minutes=1)
+    db.session.commit()
+    assert _check(client, ['u1'], [1, 2])['recorded'] == [0b01]
+
+
+def test_users_across_query_chunks(app, client, give_consent, monkeypatch):
+    import app as app_module
+
+    monkeypatch.setattr(app_module, 'BATCH_CHECK_CHUNK', 2)
+    for index in range(5):
+        give_consent(f'u{index}', 1, status=index % 2 == 0)
+    result = _check(client, [f'u{index}' for index in range(5)], [1])
+    assert result['granted'] == [1, 0, 1, 0, 1] and result['recorded'] == [1] * 5
+
+
+def test_top_purpose_bit_stays_json_safe(client, give_consent):
+    give_consent('u1', 4)
+    purpose_ids = list(range(100, 151)) + [4]
+    assert len(purpose_ids) == 52
+    mask = _check(client, ['u1'], purpose_ids)['granted'][0]
+    assert mask == 1 << 51 and mask < 2 ** 53
+
+
+@pytest.mark.parametrize('body', [
+    {'user_ids': 'u1', 'purpose_ids': [1]},
+    {'user_ids': [1], 'purpose_ids': [1]},
+    {'user_ids': ['u1'], 'purpose_ids': [True]},
+    {'user_ids': ['u1'], 'purpose_ids': ['1']},
+    {'user_ids': [], 'purpose_ids': [1]},
+    {'user_ids': ['u1'], 'purpose_ids': list(range(53))},
+    {'user_ids': ['u1'], 'purpose_ids': [1], 'format': 'csv'},
+])
+def test_bad_requests(client, body):
+    assert client.post('/api/consent/check/batch', json=body).status_code == 400
@@ -0,0 +1,144 @@
+"""Incremental bulk body parsing and the streamed bulk endpoint"""
+
+import io
+import json
+
+import pytest
+
+import bulk_stream
+from bulk_stream import BulkPayloadError, iter_json, iter_ndjson
+
+BODY = {
+    'user_id': 'Jürgen-😀',
+    'source': {'nested': [1, 2.5, None, 'x,]}']},
+    'consents': [
+        {'purpose_id': 1, 'status': True},
+        {'purpose_id': 1234567, 'status': False, 'note': 'ünïcødé'},
+        98765,
+        {'purpose_id': 3, 'status': True},
+    ],
+    'trailer': -0.25e-3,
+}
+
+
+def _events(body, block_bytes):
+    return list(iter_json(io.BytesIO(body), block_bytes=block_bytes))
+
+
+def _expected(body):
+    events = []
+    for name, value in body.items():
+        if name == 'consents':
+            events.extend(('item', item) for item in value)
+        else:
+            events.append(('field', name, value))
+    return events
+
+
+@pytest.mark.parametrize('block_bytes', [1, 2, 3, 5, 7, 16, 64 * 1024])
+def test_json_events_do_not_depend_on_block_boundaries(block_bytes):
+    # Every block size splits tokens, numbers and multi-byte characters differently
+    for separators in ((',', ':'), (', ', ': ')):
+        body = json.dumps(BODY, ensure_ascii=False, separators=separators).encode('utf-8')
+        assert _events(body, block_bytes) == _expected(BODY)
+
+
+@pytest.mark.parametrize('block_bytes', [1, 4, 64 * 1024])
+def test_json_whitespace_between_tokens(block_bytes):
+    body = b' \r\n{ "user_id" : "u1" ,\n\t"consents" : [ {"purpose_id": 1} ,\n {"purpose_id": 2} ] } \n'
+    assert _events(body, block_bytes) == [
+        ('field', 'user_id', 'u1'), ('item', {'purpose_id': 1}), ('item', {'purpose_id': 2})
+    ]
+
+
+@pytest.mark.parametrize('body', [b'{}', b'{"consents": []}', b' { "consents" : [ ] } '])
+def test_json_empty_bodies(body):
+    assert _events(body, 1) == []
+
+
+def test_json_items_before_an_error_are_yielded():
+    events = iter_json(io.BytesIO(b'{"consents": [{"purpose_id": 1}, {"purpose_id": }]}'), block_bytes=4)
+    assert next(events) == ('item', {'purpose_id': 1})
+    with pytest.raises(BulkPayloadError, match='Malformed JSON'):
+        next(events)
+
+
+@pytest.mark.parametrize('body, message', [
+    (b'', 'end of body'),
+    (b'[]', "Expected '{'"),
+    (b'{"consents": [1 2]}', "Expected ',' or ']'"),
+    (b'{"consents": [1]', 'end of body'),
+    (b'{"consents": [1]} {}', 'after the JSON body'),
+    (b'{user_id: 1}', "Expected '\"'"),
+    (b'{"user_id": "\xff"}', 'not valid UTF-8'),
+])
+def test_json_malformed_bodies(body, message):
+    with pytest.raises(BulkPayloadError, match=message):
+        _events(body, 3)
+
+
+def test_json_item_size_limit(monkeypatch):
+    monkeypatch.setattr(bulk_stream, 'BULK_STREAM_MAX_ITEM_BYTES', 64)
+    small = {'purpose_id': 1, 'note': 'x' * 20}
+    large = {'purpose_id': 2, 'note': 'x' * 200}
+    events = iter_json(io.BytesIO(json.dumps({'consents': [small, large]}).encode()), block_bytes=8)
+    assert next(events) == ('item', small)
+    with pytest.raises(BulkPayloadError, match='exceeds 64 bytes'):
+        next(events)
+
+
+def _ndjson(body, **kwargs):
+    return list(iter_ndjson(io.BytesIO(body), **kwargs))
+
+
+def test_ndjson_lines():
+    body = b'{"purpose_id": 1}\r\n\n   \n{"purpose_id": 2}\nnot json\n{"purpose_id": 3}'
+    events = _ndjson(body)
+    assert events[:2] == [('item', {'purpose_id': 1}), ('item', {'purpose_id': 2})]
+    assert events[2][0] == 'invalid' and 'Malformed JSON' in events[2][1]
+    # The last line needs no newline
+    assert events[3] == ('item', {'purpose_id': 3})
+
+
+def test_ndjson_oversized_line_fails_alone():
+    body = b'{"a": 1}\n' + b'{"note": "' + b'x' * 100 + b'"}\n{"b": 2}\n'
+    assert _ndjson(body, max_line_bytes=32) == [
+        ('item', {'a': 1}), ('invalid', 'Line exceeds 32 bytes'), ('item', {'b': 2})
+    ]
+
+
+def test_ndjson_line_of_exactly_the_limit():
+    line = json.dumps({'note': 'x' * 20}).encode()
+    assert _ndjson(line + b'\n', max_line_bytes=len(line)) == [('item', {'note': 'x' * 20})]
+    assert _ndjson(line, max_line_bytes=len(line)) == [('item', {'note': 'x' * 20})]
+
+
+def _stream_lines(response):
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_streamed_endpoint_reports_each_item(app, client):
+    body = '\n'.join([
+        json.dumps({'user_id': 'u1', 'purpose_id': 1, 'status': True}),
+        json.dumps({'user_id': 'u1', 'purpose_id': 1, 'status': False}),
+        '{broken',
+        json.dumps({'user_id': 'u2', 'purpose_id': 99, 'status': True}),
+        json.dumps({'user_id': 'u1', 'purpose_id': 1, 'status': True}),
+    ])
+    response = client.post('/api/consent/bulk', data=body, content_type='application/x-ndjson')
+    assert response.mimetype == 'application/x-ndjson'
+    *items, summary = _stream_lines(response)
+    assert [item['index'] for item in items] == [0, 1, 2, 3, 4]
+    assert [item['ok'] for item in items] == [True, True, False, False, True]
+    # Repeated items for one consent in a chunk each report the state they wrote
+    assert [items[i]['consent']['status'] for i in (0, 1, 4)] == [True, False, True]
+    assert summary == {'done': True, 'succeeded': 3, 'failed': 2, 'chunks': 1}
+
+
+def test_streamed_json_body_applies_items_before_an_error(app, client):
+    body = b'{"user_id": "u1", "consents": [{"purpose_id": 1, "status": true}, {"purpose_id": ]}'
+    response = client.post('/api/consent/bulk', data=body, content_type='application/json',
+                           headers={'Accept': 'application/x-ndjson'})
+    *items, summary = _stream_lines(response)
+    assert [item['ok'] for item in items] == [True]
+    assert summary['done'] is False and 'Malformed JSON' in summary['error']
@@ -0,0 +1,142 @@
+"""Change feed sequencing, the cursor endpoint and the SSE stream"""
+
+from datetime import datetime
+
+from sqlalchemy import DateTime, bindparam, event, text
+
+from sequencer import SEQUENCE_CURSOR, claim_cursor, move_cursor, sequence_changes
+
+
+def _changes(client, since=0, limit=100):
+    response = client.get(f'/api/consent/changes?since={since}&limit={limit}')
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def _insert_history(db, row_id, user_id):
+    """A history row written outside the API, so nothing numbers it yet"""
+    with db.engine.begin() as conn:
+        conn.execute(text(
+            "INSERT INTO consent_history (id, user_id, purpose_id, status, event, created_at) "
+            "VALUES (:id, :user_id, 1, 1, 'create', :now)"
+        ).bindparams(bindparam('now', type_=DateTime)), {'id': row_id, 'user_id': user_id, 'now': datetime.utcnow()})
+
+
+def _unsequenced(db):
+    with db.engine.connect() as conn:
+        return conn.execute(text("SELECT COUNT(*) FROM consent_history WHERE seq IS NULL")).scalar()
+
+
+def test_changes_are_numbered_in_order(client, give_consent):
+    for user_id in ('u1', 'u2', 'u3'):
+        give_consent(user_id, 1)
+    page = _changes(client)
+    seqs = [change['seq'] for change in page['changes']]
+    assert [change['user_id'] for change in page['changes']] == ['u1', 'u2', 'u3']
+    assert seqs == sorted(seqs) and len(set(seqs)) == 3
+    assert page['next_since'] == seqs[-1]
+    assert not page['has_more']
+
+
+def test_changes_page_with_has_more(client, give_consent):
+    for user_id in ('u1', 'u2', 'u3'):
+        give_consent(user_id, 1)
+    first = _changes(client, limit=2)
+    assert first['has_more'] and len(first['changes']) == 2
+    second = _changes(client, since=first['next_since'], limit=2)
+    assert [change['user_id'] for change in second['changes']] == ['u3']
+    assert not second['has_more']
+
+
+def test_writes_number_their_changes(app, client, give_consent):
+    from app import db
+
+    give_consent('u1', 1)
+    client.post('/api/consent/bulk', json={'user_id': 'u1', 'consents': [{'purpose_id': 2, 'status': True}]})
+    client.delete('/api/consent/user/u1')
+    assert _unsequenced(db) == 0
+    assert [change['event'] for change in _changes(client)['changes']] == ['create', 'create', 'delete', 'delete']
+
+
+def test_feed_reads_never_write(app, client):
+    from app import db
+
+    _insert_history(db, 1, 'written-elsewhere')
+    writes = []
+
+    def record_write(conn, cursor, statement, *args):
+        if not statement.lstrip().upper().startswith('SELECT'):
+            writes.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record_write)
+    try:
+        assert _changes(client)['changes'] == []
+        assert client.get('/api/consent/sync').status_code == 200
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record_write)
+    assert writes == []
+    assert _unsequenced(db) == 1
+
+
+def test_sweep_numbers_rows_left_behind(app, client):
+    from app import db, sequence_changes_job
+
+    _insert_history(db, 1, 'written-elsewhere')
+    sequence_changes_job()
+    assert _unsequenced(db) == 0
+    assert [change['user_id'] for change in _changes(client)['changes']] == ['written-elsewhere']
+
+
+def test_late_commit_with_lower_id_is_not_skipped(app, client):
+    from app import db
+
+    # id 100 commits first and is read; id 50 commits afterwards, as a slow
+    # transaction that took its id earlier would
+    _insert_history(db, 100, 'early-id-later')
+    sequence_changes(db.engine)
+    since = _changes(client)['next_since']
+    _insert_history(db, 50, 'late-commit')
+    sequence_changes(db.engine)
+    page = _changes(client, since=since)
+    assert [change['user_id'] for change in page['changes']] == ['late-commit']
+    assert page['changes'][0]['seq'] > since
+
+
+def test_sequencer_creates_missing_cursor_at_zero(app):
+    from app import db
+
+    with db.engine.begin() as conn:
+        assert claim_cursor(conn, 'test-consumer') == 0
+        move_cursor(conn, 'test-consumer', 7)
+    with db.engine.begin() as conn:
+        assert claim_cursor(conn, 'test-consumer') == 7
+
+
+def test_sequencer_moves_its_cursor(app, give_consent):
+    from app import db
+
+    give_consent('u1', 1)
+    give_consent('u1', 2)
+    _insert_history(db, 10, 'u2')
+    assert sequence_changes(db.engine) == 1
+    assert sequence_changes(db.engine) == 0
+    with db.engine.connect() as conn:
+        position = conn.execute(text("SELECT position FROM change_cursors WHERE name = :name"),
+                                {'name': SEQUENCE_CURSOR}).scalar()
+        assert position == conn.execute(text("SELECT MAX(seq) FROM consent_history")).scalar() == 3
+
+
+def test_event_stream_resumes_from_last_event_id(app, client, give_consent, monkeypatch):
+    import app as app_module
+
+    monkeypatch.setattr(app_module, 'CHANGE_FEED_STREAM_SECONDS', 0.05)
+    monkeypatch.setattr(app_module, 'CHANGE_FEED_POLL_SECONDS', 0.01)
+    for user_id in ('u1', 'u2', 'u3'):
+        give_consent(user_id, 1)
+    first_seq = _changes(client)['changes'][0]['seq']
+
+    response = client.get('/api/consent/changes/stream', headers={'Last-Event-ID': str(first_seq)})
+    assert response.mimetype == 'text/event-stream'
+    events = [block for block in response.get_data(as_text=True).split('\n\n') if block.startswith('id:')]
+    assert [block.split('\n')[0] for block in events] == [f'id: {first_seq + 1}', f'id: {first_seq + 2}']
+    assert '"user_id": "u2"' in events[0]
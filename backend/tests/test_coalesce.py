@@ -0,0 +1,73 @@
+"""Request coalescing and its metrics endpoint"""
+
+import threading
+
+import pytest
+
+from coalesce import Coalescer, CoalesceTimeout
+
+
+def test_concurrent_callers_share_one_execution():
+    coalescer = Coalescer(ttl_seconds=0)
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'result'
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(coalescer.run('route', 'key', compute)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(coalescer.run('route', 'key', compute)))
+                 for _ in range(3)]
+    for follower in followers:
+        follower.start()
+    while coalescer.snapshot()['route']['collapsed'] < 3:
+        pass
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join(5)
+    assert len(calls) == 1
+    assert sorted(source for _, source in results) == ['collapsed'] * 3 + ['executed']
+    assert coalescer.snapshot()['route'] == {'requests': 4, 'executed': 1, 'collapsed': 3, 'cache_hits': 0,
+                                             'timeouts': 0}
+
+
+def test_cache_only_keeps_cacheable_results():
+    coalescer = Coalescer(ttl_seconds=60)
+    assert coalescer.run('route', 'a', lambda: 500, cacheable=lambda value: value == 200) == (500, 'executed')
+    assert coalescer.run('route', 'a', lambda: 200, cacheable=lambda value: value == 200) == (200, 'executed')
+    assert coalescer.run('route', 'a', lambda: 404, cacheable=lambda value: value == 200) == (200, 'cache')
+
+
+def test_follower_gives_up_on_a_stuck_leader():
+    coalescer = Coalescer(ttl_seconds=0, wait_seconds=0.01)
+    release = threading.Event()
+    leader = threading.Thread(target=coalescer.run, args=('route', 'key', lambda: release.wait(5)))
+    leader.start()
+    while not coalescer.inflight:
+        pass
+    with pytest.raises(CoalesceTimeout):
+        coalescer.run('route', 'key', lambda: None)
+    release.set()
+    leader.join(5)
+    assert coalescer.snapshot()['route']['timeouts'] == 1
+
+
+def test_metrics_need_the_admin_token(client, monkeypatch):
+    import app as app_module
+
+    assert client.get('/api/admin/metrics/coalescing').status_code == 404
+    monkeypatch.setattr(app_module, 'ADMIN_TOKEN', 'admin-secret')
+    assert client.get('/api/admin/metrics/coalescing').status_code == 401
+    assert client.get('/api/admin/metrics/coalescing', headers={'X-Admin-Token': 'guess'}).status_code == 401
+    client.get('/api/purposes')
+    response = client.get('/api/admin/metrics/coalescing', headers={'X-Admin-Token': 'admin-secret'})
+    assert response.status_code == 200
+    assert response.get_json()['routes']['get_purposes']['requests'] >= 1
+    # The old public path is gone
+    assert client.get('/api/metrics/coalescing').status_code == 404
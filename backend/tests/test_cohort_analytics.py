@@ -0,0 +1,102 @@
+"""Cohort analytics math against plain Python and numpy references"""
+
+from datetime import datetime
+
+import numpy as np
+import pytest
+from sqlalchemy import DateTime, bindparam, text
+
+from cohort_analytics import (
+    Snapshot, _bit_dtype, breakdown, co_consent, conditional_rates, load_snapshot, phi_correlation,
+    purpose_segments, report, synthetic_snapshot
+)
+
+
+def _matrix(snapshot, which='granted'):
+    return np.array([[int(value) >> bit & 1 for bit in range(len(snapshot.purpose_ids))]
+                     for value in getattr(snapshot, which)])
+
+
+def test_bit_dtype_fits_the_catalog():
+    assert _bit_dtype(8) == np.uint8 and _bit_dtype(9) == np.uint16 and _bit_dtype(64) == np.uint64
+    with pytest.raises(ValueError):
+        _bit_dtype(65)
+
+
+def test_co_consent_counts_pairs_across_blocks():
+    snapshot = synthetic_snapshot(5000, purposes=6, seed=1)
+    x = _matrix(snapshot)
+    expected = x.T @ x
+    assert (co_consent(snapshot) == expected).all()
+    # Block boundaries don't change the sums
+    assert (co_consent(snapshot, block_rows=777) == expected).all()
+
+
+def test_conditional_rates_and_phi():
+    snapshot = synthetic_snapshot(3000, purposes=4, seed=2)
+    x = _matrix(snapshot)
+    counts = co_consent(snapshot)
+    rates = conditional_rates(counts)
+    for i in range(4):
+        for j in range(4):
+            assert rates[i, j] == pytest.approx(x[x[:, i] == 1, j].mean())
+    assert np.allclose(phi_correlation(counts, snapshot.users), np.corrcoef(x.T))
+    # Positively correlated by construction
+    assert (phi_correlation(counts, snapshot.users)[np.triu_indices(4, 1)] > 0).all()
+
+
+def test_rates_are_null_without_opt_ins():
+    granted = np.array([0b01, 0b01, 0], dtype=np.uint8)
+    recorded = np.array([0b11, 0b01, 0b01], dtype=np.uint8)
+    snapshot = Snapshot([1, 2], ['A', 'B'], granted, recorded, np.zeros(3, dtype=np.uint16))
+    result = report(snapshot, segment='1')
+    assert result['opt_ins'] == [2, 0]
+    assert result['opt_in_rate'] == [pytest.approx(0.6667), 0.0]
+    assert result['conditional_rate'][1] == [None, None]
+    assert result['correlation'][0][1] is None
+
+
+def test_breakdown_by_answer():
+    granted = np.array([0b11, 0b01, 0b10, 0], dtype=np.uint8)
+    recorded = np.array([0b11, 0b11, 0b10, 0b01], dtype=np.uint8)
+    snapshot = Snapshot([1, 2], ['A', 'B'], granted, recorded, np.zeros(4, dtype=np.uint16))
+    segments, labels = purpose_segments(snapshot, 1)
+    assert segments.tolist() == [2, 2, 0, 1]
+    rows = {row['segment']: row for row in breakdown(snapshot, segments, labels)}
+    assert rows['granted']['users'] == 2 and rows['granted']['opt_ins'] == [2, 1]
+    assert rows['granted']['opt_in_rate'] == [1.0, 0.5]
+    assert rows['unanswered']['answered'] == [0, 1] and rows['denied']['opt_ins'] == [0, 0]
+
+
+def _insert(db, rows):
+    with db.engine.begin() as conn:
+        conn.execute(text(
+            "INSERT INTO consents (user_id, purpose_id, status, created_at, updated_at) "
+            "VALUES (:user_id, :purpose_id, :status, :created_at, :created_at)"
+        ).bindparams(bindparam('created_at', type_=DateTime)), [
+            {'user_id': user_id, 'purpose_id': purpose_id, 'status': status, 'created_at': created_at}
+            for user_id, purpose_id, status, created_at in rows
+        ])
+
+
+def test_load_snapshot_joins_users_across_chunks(app):
+    from app import db
+
+    _insert(db, [
+        ('a', 1, True, datetime(2024, 3, 5)), ('a', 2, False, datetime(2024, 1, 9)), ('a', 4, True, datetime(2024, 6, 1)),
+        ('b', 2, True, datetime(2024, 2, 1)),
+        ('c', 1, False, datetime(2024, 2, 2)), ('c', 3, True, datetime(2024, 2, 3)),
+    ])
+    whole = load_snapshot(db.engine)
+    assert whole.users == 3 and whole.purpose_ids == [1, 2, 3, 4]
+    assert whole.granted.tolist() == [0b1001, 0b0010, 0b0100]
+    assert whole.recorded.tolist() == [0b1011, 0b0010, 0b0101]
+    # The first month a user answered anything
+    assert whole.cohorts.tolist() == [(2024 - 1970) * 12, (2024 - 1970) * 12 + 1, (2024 - 1970) * 12 + 1]
+    for chunk_rows in (1, 2, 4):
+        chunked = load_snapshot(db.engine, chunk_rows=chunk_rows)
+        assert chunked.granted.tolist() == whole.granted.tolist()
+        assert chunked.recorded.tolist() == whole.recorded.tolist()
+        assert chunked.cohorts.tolist() == whole.cohorts.tolist()
+    labels = [row['segment'] for row in report(whole)['segments']]
+    assert labels == ['2024-01', '2024-02']
@@ -0,0 +1,145 @@
+"""Python SDK: check batching and the ETag cache, against the app in-process"""
+
+import asyncio
+import threading
+from urllib.parse import urlsplit
+
+import pytest
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+from consent_client import AsyncConsentClient, ConsentAPIError, ConsentClient, _TTLCache
+
+
+class FlaskAdapter(BaseAdapter):
+    """Sends the session's requests to the Flask test client; records (method, path, headers)"""
+
+    def __init__(self, app):
+        super().__init__()
+        self.client = app.test_client()
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        with self.lock:
+            self.sent.append((request.method, url.path, dict(request.headers)))
+            result = self.client.open(url.path, method=request.method, query_string=url.query,
+                                      headers=dict(request.headers), data=request.body)
+        response = requests.Response()
+        response.status_code = result.status_code
+        response.headers = CaseInsensitiveDict(result.headers)
+        response._content = result.get_data()
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+    def paths(self, method=None):
+        return [path for sent_method, path, _ in self.sent if method in (None, sent_method)]
+
+
+@pytest.fixture
+def sdk(app):
+    """A ConsentClient whose requests go to the app, and the adapter carrying them"""
+    def make(**kwargs):
+        client = ConsentClient('http://consent.test/api', **kwargs)
+        adapter = FlaskAdapter(app)
+        client.session.mount('http://', adapter)
+        return client, adapter
+    return make
+
+
+def test_concurrent_checks_share_one_batch_request(sdk, give_consent):
+    give_consent('u1', 1)
+    give_consent('u2', 2, status=False)
+    client, adapter = sdk(batch_window=0.05)
+    results = {}
+
+    def check(user_id, purpose_ids):
+        results[user_id] = client.check(user_id, purpose_ids)
+
+    threads = [threading.Thread(target=check, args=args)
+               for args in (('u1', [1, 2]), ('u2', [2]), ('u3', [1]))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert adapter.paths() == ['/api/consent/check/batch']
+    assert results == {'u1': {1: True, 2: None}, 'u2': {2: False}, 'u3': {1: None}}
+    assert client.stats['batched_checks'] == 3
+
+
+def test_check_many_splits_by_server_limits(sdk, give_consent):
+    give_consent('u0', 4)
+    client, adapter = sdk(max_batch_users=2)
+    results = client.check_many(['u0', 'u1', 'u2'], list(range(1, 61)))
+    # Two user chunks times two purpose chunks (52 + 8)
+    assert adapter.paths() == ['/api/consent/check/batch'] * 4
+    assert results['u0'][4] is True and results['u0'][60] is None
+    assert all(len(statuses) == 60 for statuses in results.values())
+
+
+def test_batch_errors_reach_every_caller(sdk):
+    client, _ = sdk(batch_window=0.01)
+    with pytest.raises(ConsentAPIError) as error:
+        client.check('u1', ['not-a-purpose'])
+    assert error.value.status_code == 400
+
+
+def test_stale_entries_are_revalidated_with_the_etag(sdk, give_consent):
+    give_consent('u1', 1)
+    client, adapter = sdk(cache_ttl=0)
+    first = client.get_consents('u1')
+    assert client.get_consents('u1') == first
+    assert client.stats['not_modified'] == 1
+    method, path, headers = adapter.sent[-1]
+    assert headers['If-None-Match'] == client.consents_cache.get('u1')[1]
+
+    # A changed resource gets a new body and ETag
+    give_consent('u1', 2)
+    assert len(client.get_consents('u1')) == 2
+    assert client.stats['not_modified'] == 1
+
+
+def test_fresh_entries_skip_the_server_and_writes_invalidate(sdk):
+    client, adapter = sdk(cache_ttl=60)
+    client.get_purposes()
+    client.get_purposes()
+    client.get_consents('u1')
+    assert client.check('u1', [1]) == {1: None}
+    assert adapter.paths('GET') == ['/api/purposes', '/api/consent']
+    assert client.stats['cache_hits'] == 2
+
+    client.update_consent('u1', 1, True)
+    assert 'Idempotency-Key' in adapter.sent[-1][2]
+    assert client.consents_cache.get('u1') is None
+    assert client.check('u1', [1]) == {1: True}
+
+
+def test_cache_is_lru_bounded():
+    cache = _TTLCache(ttl=60, max_entries=2)
+    cache.put('a', None, 1)
+    cache.put('b', None, 2)
+    cache.get('a')
+    cache.put('c', None, 3)
+    assert cache.get('b') is None and cache.get('a') == (True, None, 1)
+
+
+def test_async_checks_share_one_batch_request(app, give_consent):
+    give_consent('u1', 1)
+
+    async def run():
+        async with AsyncConsentClient('http://consent.test/api', batch_window=0.05) as client:
+            adapter = FlaskAdapter(app)
+            client.client.session.mount('http://', adapter)
+            results = await asyncio.gather(client.has_consent('u1', 1), client.has_consent('u2', 1),
+                                           client.check('u1', [1, 2]))
+            return results, adapter.paths()
+
+    results, paths = asyncio.run(run())
+    assert results == [True, False, {1: True, 2: None}]
+    assert paths == ['/api/consent/check/batch']
@@ -0,0 +1,118 @@
+"""Memory-mapped consent index, its change overlay and the check endpoints on top"""
+
+from types import SimpleNamespace
+
+import pytest
+
+import consent_index
+from consent_index import AMBIGUOUS, MISSING, NO_EXPIRY, ChangeOverlay, ConsentIndex, IndexReader, user_key
+
+
+@pytest.fixture
+def index_path(tmp_path):
+    path = str(tmp_path / 'consent_index.bin')
+    # Bit 0 is purpose 1, bit 1 purpose 2, bit 2 purpose 5
+    consent_index.write_index(path, [1, 2, 5], [user_key('u1'), user_key('u2'), user_key('u3')],
+                              granted=[0b101, 0b000, 0b001], recorded=[0b111, 0b010, 0b001],
+                              valid_until=[NO_EXPIRY, NO_EXPIRY, 1000], change_seq=7)
+    return path
+
+
+def _change(seq, user_id, purpose_id, status, event='update'):
+    return SimpleNamespace(seq=seq, user_id=user_id, purpose_id=purpose_id, status=status, event=event)
+
+
+def test_lookup_through_the_mapping(index_path):
+    with ConsentIndex(index_path) as index:
+        assert index.count == 3 and index.change_seq == 7 and index.purpose_ids == [1, 2, 5]
+        assert index.lookup('u1') == (0b101, 0b111)
+        assert index.statuses('u1', [1, 2, 5, 9]) == {1: True, 2: False, 5: True, 9: None}
+        assert index.statuses('u2', [1, 2]) == {1: None, 2: False}
+        assert index.lookup('nobody') is MISSING
+        assert index.statuses('nobody', [1]) == {1: None}
+        # Past its earliest expiry a user can only be answered by the database
+        assert index.lookup('u3', now=999) == (0b001, 0b001)
+        assert index.lookup('u3', now=1000) is AMBIGUOUS
+
+
+def test_colliding_hashes_are_ambiguous(tmp_path):
+    path = str(tmp_path / 'collide.bin')
+    summary = consent_index.write_index(path, [1], [user_key('u1'), user_key('u1'), user_key('u2')],
+                                        granted=[1, 0, 1], recorded=[1, 1, 1], valid_until=[NO_EXPIRY] * 3)
+    assert summary['users'] == 1 and summary['ambiguous'] == 1
+    with ConsentIndex(path) as index:
+        assert index.lookup('u1') is AMBIGUOUS
+        assert index.lookup('u2') == (1, 1)
+
+
+def test_interpolation_search_finds_every_key(tmp_path):
+    path = str(tmp_path / 'many.bin')
+    consent_index.build_synthetic(path, 5000, purposes=4)
+    with ConsentIndex(path) as index:
+        assert all(index.lookup(f'user-{i}') is not MISSING for i in range(0, 5000, 7))
+        assert all(index.lookup(f'nobody-{i}') is MISSING for i in range(200))
+
+
+def test_overlay_wins_over_the_snapshot(index_path):
+    feed = [_change(8, 'u1', 1, False), _change(9, 'u2', 1, True, 'create'), _change(10, 'u1', 5, False, 'delete')]
+    reader = IndexReader(index_path, lambda since, limit: ([row for row in feed if row.seq > since], False),
+                         refresh_seconds=0)
+    assert reader.statuses('u1', [1, 2, 5]) == {1: False, 2: False, 5: None}
+    assert reader.statuses('u2', [1, 2]) == {1: True, 2: False}
+    assert reader.overlay.since == 10
+
+
+def test_overlay_pages_from_the_build_sequence():
+    calls = []
+
+    def fetch(since, limit):
+        calls.append(since)
+        rows = [_change(seq, 'u1', 1, seq % 2 == 0) for seq in range(since + 1, min(since + limit, 12) + 1)]
+        return rows, since + limit < 12
+
+    overlay = ChangeOverlay(since=7)
+    overlay.refresh(fetch, max_age=60, limit=2)
+    assert calls == [7, 9, 11] and overlay.changes == {('u1', 1): True}
+    # Within max_age nothing is fetched
+    overlay.refresh(fetch, max_age=60, limit=2)
+    assert len(calls) == 3
+
+
+def test_full_overlay_falls_back_to_the_database(index_path, tmp_path):
+    feed = [_change(seq, f'user-{seq}', 1, True) for seq in range(8, 12)]
+    reader = IndexReader(index_path, lambda since, limit: ([row for row in feed if row.seq > since], False),
+                         refresh_seconds=0, reload_seconds=0, max_overlay_entries=3)
+    assert reader.statuses('u1', [1]) is None
+    assert reader.overlay.overflowed and reader.overlay.changes == {}
+
+    # A rebuilt file starts a fresh overlay
+    consent_index.write_index(index_path, [1], [user_key('u1')], granted=[0], recorded=[1],
+                              valid_until=[NO_EXPIRY], change_seq=11)
+    assert reader.statuses('u1', [1]) == {1: False}
+    assert not reader.overlay.overflowed
+
+
+@pytest.fixture
+def indexed_app(app, tmp_path, monkeypatch):
+    """The app answering checks from an index built from its own tables"""
+    import app as app_module
+
+    path = str(tmp_path / 'app_index.bin')
+    reader = IndexReader(path, app_module.fetch_changes, refresh_seconds=0, reload_seconds=0)
+    monkeypatch.setattr(app_module, 'consent_index', reader)
+    return lambda: consent_index.build_from_database(app_module.db.engine, path)
+
+
+def test_check_answers_from_a_stale_snapshot_plus_changes(indexed_app, client, give_consent):
+    give_consent('u1', 1)
+    give_consent('u1', 2, status=False)
+    assert indexed_app()['users'] == 1
+    # Written after the build: only the overlay knows
+    give_consent('u1', 2)
+    client.delete('/api/consent/user/u1')
+    give_consent('u1', 3)
+    response = client.post('/api/consent/check/batch', json={'user_ids': ['u1', 'u2'], 'purpose_ids': [1, 2, 3]})
+    assert response.get_json()['granted'] == [0b100, 0] and response.get_json()['recorded'] == [0b100, 0]
+    response = client.post('/api/consent/check', json={'user_id': 'u1', 'purpose_ids': [3]})
+    assert response.headers['X-Consent-Source'] == 'index'
+    assert response.get_json()['consent_status']['Personalization']['has_consent'] is True
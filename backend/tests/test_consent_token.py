@@ -0,0 +1,97 @@
+"""Consent token encoding limits, verification and revocation"""
+
+import pytest
+
+from consent_token import (
+    InvalidToken, RevocationList, check_consent, decode_token, encode_token, user_fingerprint
+)
+
+SECRET = 'secret'
+NOW = 1700000000
+
+
+def _roundtrip(statuses, **kwargs):
+    return decode_token(SECRET, encode_token(SECRET, 'u1', statuses, 7, issued_at=NOW, **kwargs), now=NOW)
+
+
+def test_roundtrip():
+    token = _roundtrip({1: True, 2: False, 5: True})
+    assert token.catalog_version == 7 and token.belongs_to('u1') and not token.belongs_to('u2')
+    assert [token.status(p) for p in range(0, 7)] == [None, True, False, None, None, True, None]
+
+
+def test_empty_vector():
+    token = _roundtrip({})
+    assert token.count == 0 and token.status(1) is None
+
+
+@pytest.mark.parametrize('statuses', [
+    {1: True, 255: False},              # 255 bits, the widest vector
+    {65535: True},                      # highest first purpose id
+    {65281: True, 65535: True},         # 255 bits ending at the highest id
+])
+def test_largest_encodable_vectors(statuses):
+    token = _roundtrip(statuses)
+    assert all(token.status(p) is s for p, s in statuses.items())
+
+
+@pytest.mark.parametrize('statuses', [
+    {1: True, 256: False},              # 256 bits
+    {65536: True},                      # first purpose id past 16 bits
+    {0: True, 300: True},
+])
+def test_vectors_past_the_format_limits_are_rejected(statuses):
+    with pytest.raises(ValueError, match='at most 255'):
+        encode_token(SECRET, 'u1', statuses, 7, issued_at=NOW)
+
+
+def test_catalog_version_is_truncated_to_32_bits():
+    assert _roundtrip({1: True}, lifetime=60).catalog_version == 7
+    token = encode_token(SECRET, 'u1', {1: True}, 2 ** 32 + 5, issued_at=NOW)
+    assert decode_token(SECRET, token, now=NOW).catalog_version == 5
+
+
+def test_tampered_and_foreign_tokens_are_rejected():
+    token = encode_token(SECRET, 'u1', {1: True}, 7, issued_at=NOW)
+    tampered = token[:-3] + ('A' if token[-3] != 'A' else 'B') + token[-2:]
+    for bad in (tampered, token[:20], 'not base64 !', ''):
+        with pytest.raises(InvalidToken):
+            decode_token(SECRET, bad, now=NOW)
+    with pytest.raises(InvalidToken, match='signature'):
+        decode_token('other-secret', token, now=NOW)
+
+
+def test_expiry():
+    token = encode_token(SECRET, 'u1', {1: True}, 7, issued_at=NOW, lifetime=60)
+    assert decode_token(SECRET, token, now=NOW + 59)
+    with pytest.raises(InvalidToken, match='expired'):
+        decode_token(SECRET, token, now=NOW + 60)
+
+
+def test_revocation_list():
+    revocations = RevocationList()
+    revocations.add('u1', NOW + 10)
+    revocations.add('u1', NOW + 5)  # an older revocation never moves it back
+    restored = RevocationList.from_string(revocations.to_string())
+    assert restored.entries == {user_fingerprint('u1'): NOW + 10}
+
+    before = encode_token(SECRET, 'u1', {1: True}, 7, issued_at=NOW)
+    after = encode_token(SECRET, 'u1', {1: True}, 7, issued_at=NOW + 10)
+    assert not check_consent(SECRET, before, 'u1', 1, restored, now=NOW + 11)
+    assert check_consent(SECRET, after, 'u1', 1, restored, now=NOW + 11)
+    with pytest.raises(ValueError, match='truncated'):
+        RevocationList.from_string(revocations.to_string()[:-2])
+
+
+def test_catalog_too_wide_for_a_token_does_not_fail_writes(app, client, give_consent):
+    from app import Purpose, db
+
+    db.session.add(Purpose(id=300, name='Wide', description='Wide'))
+    db.session.commit()
+    response = client.post('/api/consent', json={'user_id': 'u1', 'purpose_id': 1, 'status': True})
+    assert response.status_code == 200 and 'X-Consent-Token' in response.headers
+
+    response = client.post('/api/consent', json={'user_id': 'u1', 'purpose_id': 300, 'status': True})
+    assert response.status_code == 200
+    assert 'X-Consent-Token' not in response.headers
+    assert client.get('/api/consent/token?user_id=u1').status_code == 422
@@ -0,0 +1,76 @@
+"""Consent lifetimes and the expiry sweep"""
+
+from datetime import datetime, timedelta
+
+import expiry_sweeper
+
+
+def _set_lifetime(purpose_id, days):
+    from app import Purpose, db
+
+    db.session.get(Purpose, purpose_id).consent_lifetime_days = days
+    db.session.commit()
+
+
+def _history(user_id):
+    from app import ConsentHistory
+
+    return [(row.purpose_id, row.event, row.status)
+            for row in ConsentHistory.query.filter_by(user_id=user_id).order_by(ConsentHistory.id)]
+
+
+def test_lifetime_sets_expires_at(app, give_consent):
+    _set_lifetime(1, 30)
+    before = datetime.utcnow()
+    expires_at = datetime.fromisoformat(give_consent('u1', 1)['expires_at'])
+    assert before + timedelta(days=30) <= expires_at <= datetime.utcnow() + timedelta(days=30)
+    assert give_consent('u1', 2)['expires_at'] is None
+
+
+def test_sweep_records_an_expire_event_once(app, give_consent):
+    from app import Consent
+
+    _set_lifetime(1, 30)
+    give_consent('u1', 1)
+    give_consent('u1', 2)
+    later = datetime.utcnow() + timedelta(days=31)
+    assert expiry_sweeper.sweep(now=datetime.utcnow()) == 0
+    assert expiry_sweeper.sweep(now=later) == 1
+    assert _history('u1')[-1] == (1, 'expire', False)
+    consent = Consent.query.filter_by(user_id='u1', purpose_id=1).one()
+    assert consent.expired_at == later and consent.status is True
+    # Swept rows drop out of the pending query
+    assert expiry_sweeper.sweep(now=later) == 0
+    assert expiry_sweeper.expired_query(later).count() == 0
+
+
+def test_sweep_works_through_batches(app, give_consent):
+    _set_lifetime(1, 1)
+    for index in range(5):
+        give_consent(f'u{index}', 1)
+    assert expiry_sweeper.sweep(batch_size=2, now=datetime.utcnow() + timedelta(days=2)) == 5
+    assert all(_history(f'u{index}')[-1][1] == 'expire' for index in range(5))
+
+
+def test_expired_consents_read_as_absent(app, client, give_consent):
+    from app import Consent, db
+
+    give_consent('u1', 1)
+    Consent.query.filter_by(user_id='u1').one().expires_at = datetime.utcnow() - timedelta(minutes=1)
+    db.session.commit()
+    # Absent before the sweep has run
+    assert client.get('/api/consent?user_id=u1').get_json() == []
+    check = client.post('/api/consent/check', json={'user_id': 'u1', 'purpose_ids': [1]}).get_json()
+    assert check['consent_status']['Marketing']['has_consent'] is False
+
+
+def test_a_new_write_clears_the_expiry(app, client, give_consent):
+    from app import Consent
+
+    _set_lifetime(1, 30)
+    give_consent('u1', 1)
+    expiry_sweeper.sweep(now=datetime.utcnow() + timedelta(days=31))
+    give_consent('u1', 1)
+    consent = Consent.query.filter_by(user_id='u1').one()
+    assert consent.expired_at is None and consent.expires_at > datetime.utcnow()
+    assert [event for _, event, _ in _history('u1')] == ['create', 'expire', 'update']
@@ -0,0 +1,67 @@
+"""Parquet export round trip"""
+
+from datetime import datetime
+
+import pytest
+from sqlalchemy import DateTime, bindparam, text
+
+pq = pytest.importorskip('pyarrow.parquet')
+
+import export_parquet
+
+
+def _insert(db, rows):
+    with db.engine.begin() as conn:
+        conn.execute(text(
+            "INSERT INTO consents (user_id, purpose_id, status, ip_address, created_at, updated_at) "
+            "VALUES (:user_id, :purpose_id, :status, '10.0.0.1', :created_at, :updated_at)"
+        ).bindparams(bindparam('created_at', type_=DateTime), bindparam('updated_at', type_=DateTime)), [
+            {'user_id': user_id, 'purpose_id': purpose_id, 'status': status,
+             'created_at': datetime(2024, 1, 1), 'updated_at': updated_at}
+            for user_id, purpose_id, status, updated_at in rows
+        ])
+
+
+def test_round_trip_with_partitions_and_null_updated_at(app, tmp_path):
+    from app import db
+
+    rows = [
+        ('u1', 1, True, datetime(2024, 1, 31, 23, 59)),
+        ('u2', 1, False, datetime(2024, 2, 1)),
+        ('u3', 1, True, None),
+        ('u1', 2, True, datetime(2024, 2, 15, 12, 30, 0, 250)),
+    ]
+    _insert(db, rows)
+    summary = export_parquet.export(str(db.engine.url), str(tmp_path), chunk_rows=2)
+    assert summary['rows'] == 4 and summary['files'] == 4
+    assert (tmp_path / 'purpose_id=1' / f'month={export_parquet.NULL_PARTITION}' / 'part-0.parquet').exists()
+
+    table = pq.read_table(str(tmp_path)).to_pylist()
+    exported = {(row['user_id'], row['purpose_id']): row for row in table}
+    assert len(exported) == 4
+    assert exported[('u3', 1)]['updated_at'] is None and exported[('u3', 1)]['month'] is None
+    assert exported[('u1', 1)]['month'] == '2024-01' and exported[('u2', 1)]['month'] == '2024-02'
+    for user_id, purpose_id, status, updated_at in rows:
+        row = exported[(user_id, purpose_id)]
+        assert row['status'] is status and row['updated_at'] == updated_at
+        assert row['purpose_name'] == ['Marketing', 'Analytics'][purpose_id - 1]
+
+
+def test_null_runs_sort_either_end():
+    class Row:
+        def __init__(self, updated_at):
+            self.updated_at = updated_at
+
+    march, april = datetime(2024, 3, 9), datetime(2024, 4, 2)
+    nulls_first = [Row(None), Row(None), Row(march), Row(april)]
+    assert export_parquet._month_run(nulls_first, 0) == (export_parquet.NULL_PARTITION, 2)
+    assert export_parquet._month_run(nulls_first, 2) == ('2024-03', 3)
+    nulls_last = [Row(march), Row(april), Row(None)]
+    assert export_parquet._month_run(nulls_last, 0) == ('2024-03', 1)
+    assert export_parquet._month_run(nulls_last, 1) == ('2024-04', 2)
+    assert export_parquet._month_run(nulls_last, 2) == (export_parquet.NULL_PARTITION, 3)
+
+
+def test_database_url_comes_from_the_environment(monkeypatch):
+    monkeypatch.setenv('DATABASE_URL', 'postgresql://user@db/consents')
+    assert export_parquet.database_url() == 'postgresql+pg8000://user@db/consents'
@@ -0,0 +1,70 @@
+"""Synthetic data generator on top of existing rows"""
+
+import pytest
+from sqlalchemy import event, text
+
+pytest.importorskip('numpy')
+
+import generate_data
+
+
+@pytest.fixture
+def statements(app):
+    from app import db
+
+    seen = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        seen.append(statement.strip())
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    yield seen
+    event.remove(db.engine, 'before_cursor_execute', record)
+
+
+def _generate(db, **kwargs):
+    return generate_data.generate(db.engine, 40, workers=1, chunk_users=20, years=1, **kwargs)
+
+
+def _day_events(conn):
+    return conn.execute(text("SELECT SUM(opt_ins + opt_outs) FROM consent_rollups WHERE granularity = 'day'")).scalar()
+
+
+def test_aggregates_merge_into_existing_rows(app, statements):
+    from app import db
+
+    first = _generate(db, reset=True)
+    with db.engine.begin() as conn:
+        assert _day_events(conn) == first['history']
+        # Aggregates left over from consents that are gone
+        conn.execute(text("DELETE FROM consent_history"))
+        conn.execute(text("DELETE FROM consents"))
+        conn.execute(text("UPDATE hll_registers SET rank = 63 WHERE purpose_id = 1"))
+        seeded = conn.execute(text("SELECT COUNT(*) FROM hll_registers WHERE purpose_id = 1")).scalar()
+    statements.clear()
+
+    second = _generate(db, seed=7)
+    assert not any(statement.startswith('DROP INDEX') for statement in statements)
+    with db.engine.connect() as conn:
+        assert _day_events(conn) == first['history'] + second['history']
+        # Registers only ever grow
+        assert conn.execute(text(
+            "SELECT COUNT(*) FROM hll_registers WHERE purpose_id = 1 AND rank = 63"
+        )).scalar() == seeded
+
+
+def test_indexes_are_dropped_only_when_asked(app, statements):
+    from app import db
+
+    _generate(db, drop_indexes=True)
+    dropped = [statement for statement in statements if statement.startswith('DROP INDEX')]
+    assert dropped
+    with db.engine.connect() as conn:
+        names = {row[0] for row in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'"))}
+    assert {index.name for index in db.metadata.tables['consents'].indexes} <= names
+
+    with pytest.raises(ValueError):
+        _generate(db)
+    statements.clear()
+    assert _generate(db, reset=True)['consents'] > 0
+    assert any(statement.startswith('DROP INDEX') for statement in statements)
@@ -0,0 +1,47 @@
+"""Gunicorn worker count against the database connection budget"""
+
+import os
+import runpy
+
+import pytest
+
+CONF = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'gunicorn.conf.py')
+
+
+@pytest.fixture
+def load_conf(monkeypatch):
+    def load(cpus=16, **env):
+        # The config sets pool defaults in os.environ; give it a copy to write to
+        environ = {name: value for name, value in os.environ.items()
+                   if not name.startswith(('GUNICORN_', 'DB_POOL_SIZE', 'DB_MAX_OVERFLOW', 'DB_CONNECTION_BUDGET'))}
+        environ.update({name: str(value) for name, value in env.items()})
+        monkeypatch.setattr(os, 'environ', environ)
+        monkeypatch.setattr('multiprocessing.cpu_count', lambda: cpus)
+        return runpy.run_path(CONF)
+    return load
+
+
+def test_default_workers_fit_the_budget(load_conf):
+    conf = load_conf(cpus=16)
+    assert conf['connections_per_worker'] == 8
+    assert conf['workers'] == 11 and conf['workers'] * 8 <= 90
+    # Small machines keep 2 x CPUs + 1
+    assert load_conf(cpus=2)['workers'] == 5
+
+
+def test_pool_settings_change_the_cap(load_conf):
+    conf = load_conf(cpus=16, GUNICORN_THREADS=8, DB_CONNECTION_BUDGET=400)
+    assert conf['connections_per_worker'] == 16 and conf['workers'] == 25
+    conf = load_conf(cpus=16, DB_POOL_SIZE=2, DB_MAX_OVERFLOW=0, DB_CONNECTION_BUDGET=20)
+    assert conf['workers'] == 10
+
+
+def test_explicit_workers_are_lowered_with_a_warning(load_conf, capsys):
+    assert load_conf(GUNICORN_WORKERS=4)['workers'] == 4
+    assert load_conf(GUNICORN_WORKERS=40)['workers'] == 11
+    assert 'exceeds DB_CONNECTION_BUDGET=90' in capsys.readouterr().err
+
+
+def test_at_least_one_worker(load_conf, capsys):
+    assert load_conf(GUNICORN_THREADS=64)['workers'] == 1
+    assert "One worker's pool (128 connections)" in capsys.readouterr().err
@@ -0,0 +1,87 @@
+"""Idempotency-Key replay for consent writes"""
+
+import json
+
+import pytest
+
+
+def _post(client, body, key, path='/api/consent', **kwargs):
+    return client.post(path, json=body, headers={'Idempotency-Key': key, **kwargs.pop('headers', {})}, **kwargs)
+
+
+def _history_count(user_id):
+    from app import ConsentHistory
+
+    return ConsentHistory.query.filter_by(user_id=user_id).count()
+
+
+def test_repeated_key_replays_the_stored_response(app, client):
+    body = {'user_id': 'u1', 'purpose_id': 1, 'status': True}
+    first = _post(client, body, 'key-1')
+    second = _post(client, body, 'key-1')
+    assert first.status_code == second.status_code == 200
+    assert second.get_data() == first.get_data()
+    assert second.headers['Idempotent-Replayed'] == 'true'
+    assert 'Idempotent-Replayed' not in first.headers
+    # The replay carries the headers the view set
+    assert first.headers['X-Consent-Token']
+    assert second.headers['X-Consent-Token'] == first.headers['X-Consent-Token']
+    assert _history_count('u1') == 1
+
+
+def test_writes_without_a_key_are_applied_each_time(app, client, give_consent):
+    give_consent('u1', 1)
+    give_consent('u1', 1)
+    assert _history_count('u1') == 2
+
+
+def test_same_key_is_independent_per_route(app, client):
+    _post(client, {'user_id': 'u1', 'purpose_id': 1, 'status': True}, 'shared')
+    response = _post(client, {'user_id': 'u1', 'consents': [{'purpose_id': 2, 'status': True}]},
+                     'shared', path='/api/consent/bulk')
+    assert response.status_code == 200
+    assert 'Idempotent-Replayed' not in response.headers
+
+
+@pytest.mark.parametrize('change', [
+    {'json': {'user_id': 'u1', 'purpose_id': 1, 'status': False}},
+    {'headers': {'Accept': 'application/msgpack'}},
+])
+def test_reused_key_with_a_different_request_is_rejected(app, client, change):
+    body = {'user_id': 'u1', 'purpose_id': 1, 'status': True}
+    assert _post(client, body, 'key-1').status_code == 200
+    response = _post(client, change.get('json', body), 'key-1', headers=change.get('headers', {}))
+    assert response.status_code == 422
+    assert _history_count('u1') == 1
+
+
+def test_overlong_key_is_rejected(app, client):
+    response = _post(client, {'user_id': 'u1', 'purpose_id': 1, 'status': True}, 'k' * 256)
+    assert response.status_code == 400
+    assert _history_count('u1') == 0
+
+
+def test_client_errors_are_replayed(app, client):
+    body = {'user_id': 'u1', 'purpose_id': 99, 'status': True}
+    assert _post(client, body, 'key-1').status_code == 400
+    # 4xx responses are stored like successes; only 5xx ones release the key
+    response = _post(client, body, 'key-1')
+    assert response.status_code == 400
+    assert response.headers['Idempotent-Replayed'] == 'true'
+
+
+def test_bulk_replay(app, client):
+    body = {'user_id': 'u1', 'consents': [{'purpose_id': 1, 'status': True}, {'purpose_id': 2, 'status': False}]}
+    first = _post(client, body, 'bulk-1', path='/api/consent/bulk')
+    second = _post(client, body, 'bulk-1', path='/api/consent/bulk')
+    assert second.headers['Idempotent-Replayed'] == 'true'
+    assert second.get_json() == first.get_json()
+    assert _history_count('u1') == 2
+
+
+def test_streamed_bulk_rejects_idempotency_key(app, client):
+    body = '\n'.join(json.dumps({'user_id': 'u1', 'purpose_id': p, 'status': True}) for p in (1, 2))
+    response = client.post('/api/consent/bulk', data=body, content_type='application/x-ndjson',
+                           headers={'Idempotency-Key': 'stream-1'})
+    assert response.status_code == 400
+    assert _history_count('u1') == 0
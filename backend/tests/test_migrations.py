@@ -0,0 +1,23 @@
+"""Old migrations still run on databases that never applied them"""
+
+from sqlalchemy import inspect
+
+import migrations
+
+
+def _indexes(db):
+    return {index['name'] for index in inspect(db.engine).get_indexes('consents')}
+
+
+def test_retired_indexes_are_built_then_dropped(app):
+    from app import db
+
+    migrations.consent_read_indexes(db)
+    assert {'ix_consents_expires_at', 'ix_consents_updated_id'} <= _indexes(db)
+    # Idempotent, like every step
+    migrations.consent_read_indexes(db)
+
+    migrations.consent_expired_at(db)
+    migrations.drop_sync_watermark_index(db)
+    assert not {'ix_consents_expires_at', 'ix_consents_updated_id'} & _indexes(db)
+    assert 'ix_consents_expiry_pending' in _indexes(db)
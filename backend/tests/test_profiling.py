@@ -0,0 +1,156 @@
+"""Request profiling, collapsed-stack output and the replay CLI"""
+
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+
+import pytest
+
+import profile_request
+from profiling import RequestProfiler, StackSampler, collapsed, prune, route_slug
+
+ROUTE = 'POST /api/consent/check'
+
+
+def test_collapsed_stacks_are_rooted_trimmed_and_merged():
+    stacks = {
+        ('run (serving.py:1)', 'wsgi_app (app.py:2)', 'view (app.py:3)'): 2,
+        ('other_server (x.py:1)', 'wsgi_app (app.py:2)', 'view (app.py:3)'): 3,
+        ('main (cli.py:1)', 'odd;name (cli.py:2)'): 1,
+    }
+    assert collapsed(stacks, root=ROUTE) == [
+        f'{ROUTE};main (cli.py:1);odd;name (cli.py:2) 1',
+        f'{ROUTE};wsgi_app (app.py:2);view (app.py:3) 5',
+    ]
+    assert collapsed({('a (x.py:1)',): 1}, root='GET /a;b') == ['GET /a:b;a (x.py:1) 1']
+    assert route_slug(ROUTE) == 'POST_api_consent_check' and route_slug('/') == 'root'
+
+
+def _busy(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        sum(range(100))
+
+
+def test_sampler_sees_the_profiled_thread():
+    switch_interval = sys.getswitchinterval()
+    sampler = StackSampler(threading.get_ident(), interval=0.001).start()
+    assert sys.getswitchinterval() <= 0.001
+    _busy(0.1)
+    stacks = sampler.stop()
+    assert sys.getswitchinterval() == switch_interval
+    assert sum(stacks.values()) > 0
+    assert any(any(frame.startswith('_busy (test_profiling.py:') for frame in stack) for stack in stacks)
+
+
+def test_profiles_are_written_per_route_and_pruned(tmp_path):
+    profiler = RequestProfiler(str(tmp_path), interval=0.001, max_files=2)
+    paths = []
+    for _ in range(3):
+        profile = profiler.start(ROUTE)
+        _busy(0.02)
+        paths.append(profiler.stop(profile))
+    directory = tmp_path / 'POST_api_consent_check'
+    assert sorted(os.listdir(directory)) == [os.path.basename(path) for path in paths[1:]]
+    lines = (directory / os.path.basename(paths[-1])).read_text().splitlines()
+    assert lines and all(line.startswith(f'{ROUTE};') for line in lines)
+    assert all(line.rsplit(' ', 1)[1].isdigit() for line in lines)
+
+
+def test_prune_ignores_other_files(tmp_path):
+    for name in ('1.folded', '2.prof', '3.folded', 'notes.txt'):
+        (tmp_path / name).write_text('')
+    prune(str(tmp_path), 1)
+    assert sorted(os.listdir(tmp_path)) == ['3.folded', 'notes.txt']
+
+
+def test_cprofile_mode_writes_pstats(tmp_path):
+    profiler = RequestProfiler(str(tmp_path), mode='cprofile')
+    profile = profiler.start(ROUTE)
+    _busy(0.01)
+    path = profiler.stop(profile)
+    assert path.endswith('.prof')
+    functions = {name for _, _, name in pstats.Stats(path).stats}
+    assert '_busy' in functions
+    with pytest.raises(ValueError):
+        RequestProfiler(str(tmp_path), mode='perf')
+
+
+def test_concurrency_slots(tmp_path):
+    profiler = RequestProfiler(str(tmp_path), interval=0.001, max_concurrent=1)
+    first = profiler.start(ROUTE)
+    assert profiler.start(ROUTE) is None
+    profiler.stop(first)
+    profiler.stop(profiler.start(ROUTE))
+
+
+def test_unwritable_profile_is_logged_and_frees_its_slot(tmp_path, caplog):
+    blocker = tmp_path / 'not-a-directory'
+    blocker.write_text('')
+    profiler = RequestProfiler(str(blocker), interval=0.001, max_concurrent=1)
+    with caplog.at_level(logging.WARNING, logger='profiling'):
+        assert profiler.stop(profiler.start(ROUTE)) is None
+    assert 'Could not write profile' in caplog.text
+    assert profiler.start(ROUTE) is not None
+
+
+@pytest.fixture
+def profiled_app(app, tmp_path, monkeypatch):
+    import app as app_module
+
+    monkeypatch.setattr(app_module, 'ADMIN_TOKEN', 'admin-secret')
+    monkeypatch.setattr(app_module, 'request_profiler', RequestProfiler(str(tmp_path), interval=0.001))
+    return app_module
+
+
+def _check(client, **kwargs):
+    return client.post('/api/consent/check', json={'user_id': 'u1', 'purpose_ids': [1]}, **kwargs)
+
+
+def test_admins_can_profile_a_request(profiled_app, client, tmp_path):
+    response = _check(client, headers={'X-Profile': '1', 'X-Admin-Token': 'admin-secret'})
+    assert response.status_code == 200
+    path = response.headers['X-Profile-File']
+    assert path.startswith(str(tmp_path / 'POST_api_consent_check')) and os.path.exists(path)
+
+    response = client.post('/api/consent/check?profile=1', json={'user_id': 'u1', 'purpose_ids': [1]},
+                           headers={'X-Admin-Token': 'admin-secret'})
+    assert 'X-Profile-File' in response.headers
+
+
+def test_profile_flag_without_admin_token_is_ignored(profiled_app, client, tmp_path):
+    for headers in ({'X-Profile': '1'}, {'X-Profile': '1', 'X-Admin-Token': 'wrong'}):
+        assert 'X-Profile-File' not in _check(client, headers=headers).headers
+    assert not os.listdir(tmp_path)
+
+
+def test_sampled_requests_are_profiled_silently(profiled_app, client, tmp_path, monkeypatch):
+    monkeypatch.setattr(profiled_app, 'PROFILE_SAMPLE_RATE', 1.0)
+    response = _check(client)
+    assert 'X-Profile-File' not in response.headers
+    assert len(os.listdir(tmp_path / 'POST_api_consent_check')) == 1
+
+
+def test_replay_cli_writes_a_profile(app, tmp_path, monkeypatch, capsys):
+    output = tmp_path / 'check.prof'
+    monkeypatch.setattr(sys, 'argv', [
+        'profile_request.py', 'post', '/api/consent/check', '--json', '{"user_id": "u1", "purpose_ids": [1, 2]}',
+        '--repeat', '3', '--mode', 'cprofile', '--output', str(output)
+    ])
+    profile_request.main()
+    printed = capsys.readouterr().out
+    assert f'{ROUTE}: HTTP 200' in printed and f'Wrote {output}' in printed
+    functions = {name for _, _, name in pstats.Stats(str(output)).stats}
+    assert 'check_consent_status' in functions
+
+    folded = tmp_path / 'check.folded'
+    monkeypatch.setattr(sys, 'argv', [
+        'profile_request.py', 'GET', '/api/purposes', '--repeat', '20', '--interval-ms', '0.5',
+        '--output', str(folded)
+    ])
+    profile_request.main()
+    assert 'samples over 20 requests' in capsys.readouterr().out
+    assert all(line.startswith('GET /api/purposes;') for line in folded.read_text().splitlines())
@@ -0,0 +1,84 @@
+"""Rate limit client identity and admission"""
+
+import pytest
+from flask import Flask, request
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+
+from ratelimit import LocalBackend, RateLimiter, api_key_digest, client_identity, load_api_keys
+
+
+def _request(headers=None, remote_addr='203.0.113.7'):
+    return Request(EnvironBuilder(headers=headers, environ_base={'REMOTE_ADDR': remote_addr}).get_environ())
+
+
+def test_listed_api_key_is_the_identity():
+    keys = frozenset({api_key_digest('partner-key')})
+    identity = client_identity(_request({'X-API-Key': 'partner-key'}), keys)
+    assert identity == 'key:' + api_key_digest('partner-key')[:32]
+    # The key itself never ends up in bucket names
+    assert 'partner-key' not in identity
+
+
+@pytest.mark.parametrize('headers', [None, {'X-API-Key': ''}, {'X-API-Key': 'made-up'}])
+def test_unlisted_or_missing_keys_fall_back_to_the_address(headers):
+    keys = frozenset({api_key_digest('partner-key')})
+    assert client_identity(_request(headers), keys) == 'ip:203.0.113.7'
+
+
+def test_made_up_keys_share_one_bucket():
+    identities = {client_identity(_request({'X-API-Key': f'key-{i}'})) for i in range(10)}
+    assert identities == {'ip:203.0.113.7'}
+
+
+def test_load_api_keys(monkeypatch):
+    monkeypatch.setenv('RATE_LIMIT_API_KEYS', ' one, ,two ,')
+    assert load_api_keys() == {api_key_digest('one'), api_key_digest('two')}
+    monkeypatch.delenv('RATE_LIMIT_API_KEYS')
+    assert load_api_keys() == frozenset()
+
+
+@pytest.mark.parametrize('hops, expected', [(0, 'ip:10.0.0.2'), (1, 'ip:198.51.100.9'), (2, 'ip:192.0.2.1')])
+def test_forwarded_address_only_from_trusted_hops(hops, expected):
+    proxied = Flask(__name__)
+    proxied.add_url_rule('/', 'identity', lambda: client_identity(request))
+    if hops:
+        proxied.wsgi_app = ProxyFix(proxied.wsgi_app, x_for=hops)
+    response = proxied.test_client().get('/', headers={'X-Forwarded-For': '192.0.2.1, 198.51.100.9'},
+                                         environ_base={'REMOTE_ADDR': '10.0.0.2'})
+    assert response.get_data(as_text=True) == expected
+
+
+def test_token_bucket_burst_and_refill():
+    backend = LocalBackend()
+    assert [backend.take('k', 1.0, 2, now=100.0)[0] for _ in range(3)] == [True, True, False]
+    allowed, retry_after = backend.take('k', 1.0, 2, now=100.0)
+    assert not allowed and 0 < retry_after <= 1.0
+    assert backend.take('k', 1.0, 2, now=101.0)[0]
+
+
+@pytest.fixture
+def strict_limits(app, monkeypatch):
+    """Rate limiting on, with a budget of one GET /api/purposes per client"""
+    import app as app_module
+
+    monkeypatch.setattr(app_module, 'RATE_LIMIT_ENABLED', True)
+    monkeypatch.setattr(app_module, 'RATE_LIMIT_API_KEYS', frozenset({api_key_digest('partner-key')}))
+    monkeypatch.setattr(app_module, 'rate_limiter', RateLimiter(LocalBackend(), {'get_purposes': (0.001, 1)}))
+
+
+def test_requests_over_budget_get_429(client, strict_limits):
+    assert client.get('/api/purposes').status_code == 200
+    response = client.get('/api/purposes', headers={'X-API-Key': 'made-up'})
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+    # A listed key has a bucket of its own
+    assert client.get('/api/purposes', headers={'X-API-Key': 'partner-key'}).status_code == 200
+
+
+def test_preflights_are_not_counted(client, strict_limits):
+    preflight = {'Origin': 'https://example.com', 'Access-Control-Request-Method': 'GET'}
+    for _ in range(3):
+        assert client.options('/api/purposes', headers=preflight).status_code == 200
+    assert client.get('/api/purposes').status_code == 200
@@ -0,0 +1,148 @@
+"""Monthly history partitions and the retention job"""
+
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytest
+from sqlalchemy import text
+
+import partitions
+import retention
+from partitions import add_months, history_window_start, partition_month, partition_name
+
+
+class RecordingConnection:
+    """Stands in for a PostgreSQL connection; records the DDL it is given"""
+
+    def __init__(self, existing=()):
+        self.existing = set(existing)
+        self.statements = []
+
+    def exec_driver_sql(self, sql, params=None):
+        if sql.startswith('SELECT 1 FROM pg_class'):
+            return _Result([(1,)] if params[0] in self.existing else [])
+        self.statements.append(' '.join(sql.split()))
+        return _Result([])
+
+
+class _Result:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def first(self):
+        return self.rows[0] if self.rows else None
+
+
+class RecordingEngine:
+    def __init__(self, conn):
+        self.conn = conn
+
+    @contextmanager
+    def begin(self):
+        yield self.conn
+
+
+def test_month_arithmetic():
+    assert add_months(datetime(2025, 11, 1), 3) == datetime(2026, 2, 1)
+    assert add_months(datetime(2025, 1, 1), -1) == datetime(2024, 12, 1)
+    assert add_months(datetime(2025, 1, 1), -24) == datetime(2023, 1, 1)
+    assert history_window_start(datetime(2025, 3, 17, 8, 30), months=2) == datetime(2025, 1, 1)
+
+
+def test_partition_names_round_trip():
+    assert partition_name(datetime(2025, 3, 17)) == 'consent_history_p202503'
+    assert partition_month('consent_history_p202503') == datetime(2025, 3, 1)
+    # Tables that don't follow the convention are never touched
+    for name in ('consent_history_old', 'consent_history_p2025', 'other_p202503'):
+        assert partition_month(name) is None
+
+
+def test_ensure_partitions_creates_missing_months_only():
+    conn = RecordingConnection(existing={'consent_history_p202503'})
+    created = partitions.ensure_partitions(conn, months_ahead=1, months_back=1, now=datetime(2025, 3, 17))
+    assert created == ['consent_history_p202502', 'consent_history_p202504']
+    assert conn.statements[0] == (
+        "CREATE TABLE consent_history_p202502 PARTITION OF consent_history "
+        "FOR VALUES FROM ('2025-02-01 00:00:00') TO ('2025-03-01 00:00:00')"
+    )
+
+
+def _partitions(monkeypatch, months):
+    listed = [(partition_name(month), month) for month in months]
+    monkeypatch.setattr(retention, 'list_partitions', lambda conn: listed)
+    monkeypatch.setattr(retention, 'ensure_partitions', lambda conn, months_ahead: [])
+
+
+def test_only_partitions_wholly_before_the_cutoff_expire(monkeypatch):
+    _partitions(monkeypatch, [datetime(2025, 1, 1), datetime(2025, 2, 1), datetime(2025, 3, 1)])
+    assert retention.expired_partitions(None, datetime(2025, 3, 1)) == [
+        'consent_history_p202501', 'consent_history_p202502'
+    ]
+    # A cutoff inside February keeps February
+    assert retention.expired_partitions(None, datetime(2025, 2, 15)) == ['consent_history_p202501']
+
+
+@pytest.mark.parametrize('mode, statements', [
+    ('detach', ['ALTER TABLE consent_history DETACH PARTITION consent_history_p202501']),
+    ('drop', ['ALTER TABLE consent_history DETACH PARTITION consent_history_p202501',
+              'DROP TABLE consent_history_p202501']),
+])
+def test_retire_partitions(monkeypatch, mode, statements):
+    _partitions(monkeypatch, [datetime(2025, 1, 1), datetime(2025, 2, 1)])
+    conn = RecordingConnection()
+    assert retention.retire_partitions(RecordingEngine(conn), datetime(2025, 2, 1), mode) == 1
+    assert conn.statements == statements
+
+
+def test_retire_partitions_dry_run_changes_nothing(monkeypatch):
+    _partitions(monkeypatch, [datetime(2025, 1, 1), datetime(2025, 2, 1)])
+    conn = RecordingConnection()
+    assert retention.retire_partitions(RecordingEngine(conn), datetime(2025, 3, 1), 'drop', dry_run=True) == 2
+    assert conn.statements == []
+
+
+def _insert_history(db, created_at, count):
+    with db.engine.begin() as conn:
+        for _ in range(count):
+            conn.execute(text(
+                "INSERT INTO consent_history (user_id, purpose_id, status, event, created_at) "
+                "VALUES ('u1', 1, 1, 'create', :created_at)"
+            ), {'created_at': created_at})
+
+
+def _history_dates(db):
+    with db.engine.connect() as conn:
+        return [row[0] for row in conn.execute(text("SELECT created_at FROM consent_history"))]
+
+
+def test_single_table_deletes_old_rows_in_batches(app):
+    from app import db
+
+    _insert_history(db, datetime(2020, 1, 1), 5)
+    _insert_history(db, datetime.utcnow(), 2)
+    cutoff = history_window_start()
+    assert retention.delete_expired_rows(db.engine, cutoff, dry_run=True) == 0
+    assert retention.delete_expired_rows(db.engine, cutoff, batch_size=2) == 5
+    assert len(_history_dates(db)) == 2
+
+
+def test_apply_retention_on_sqlite(app):
+    from app import db
+
+    _insert_history(db, datetime(2020, 1, 1), 3)
+    summary = retention.apply_retention(db.engine, months=1)
+    assert summary['partitioned'] is False and summary['rows_deleted'] == 3
+    with pytest.raises(ValueError):
+        retention.apply_retention(db.engine, mode='archive')
+
+
+def test_history_endpoint_is_bounded_to_the_window(app, client, give_consent):
+    from app import db
+
+    give_consent('u1', 1)
+    _insert_history(db, datetime(2020, 1, 1), 1)
+    history = client.get('/api/consent/user/u1/history').get_json()['consent_history']
+    assert sum(len(entries) for entries in history.values()) == 1
+    history = client.get('/api/consent/user/u1/history?from=2019-12-01T00:00:00Z').get_json()['consent_history']
+    assert sum(len(entries) for entries in history.values()) == 2
+    assert client.get('/api/consent/user/u1/history?from=yesterday').status_code == 400
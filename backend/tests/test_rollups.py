@@ -0,0 +1,154 @@
+"""Trend rollups: aggregation, chunked backfill and the read-only trends endpoint"""
+
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import DateTime, bindparam, event, text
+
+import partitions
+import rollups
+from rollups import ROLLUP_CURSOR, bucket_start
+from scheduler import PeriodicJob
+from sequencer import sequence_changes
+
+NOW = datetime(2025, 3, 17, 12, 30)
+
+
+def _insert_history(db, rows):
+    """rows: [(created_at, purpose_id, status)]"""
+    with db.engine.begin() as conn:
+        conn.execute(text(
+            "INSERT INTO consent_history (user_id, purpose_id, status, event, created_at) "
+            "VALUES ('u1', :purpose_id, :status, 'update', :created_at)"
+        ).bindparams(bindparam('created_at', type_=DateTime)), [{'created_at': created_at, 'purpose_id': purpose_id, 'status': status}
+            for created_at, purpose_id, status in rows])
+
+
+def _buckets(db, granularity):
+    with db.engine.connect() as conn:
+        return {(row[0], row[1]): (row[2], row[3]) for row in conn.execute(text(
+            "SELECT purpose_id, bucket_start, opt_ins, opt_outs FROM consent_rollups "
+            "WHERE granularity = :granularity"
+        ), {'granularity': granularity})}
+
+
+def _aggregate(db):
+    from app import upsert_rollup
+
+    return rollups.aggregate(db.engine, upsert_rollup)
+
+
+def test_bucket_start():
+    assert bucket_start(NOW, 'hour') == datetime(2025, 3, 17, 12)
+    assert bucket_start(NOW, 'day') == datetime(2025, 3, 17)
+    with pytest.raises(ValueError):
+        bucket_start(NOW, 'week')
+
+
+def test_aggregate_folds_each_change_in_once(app):
+    from app import db
+
+    _insert_history(db, [(NOW, 1, True), (NOW + timedelta(minutes=5), 1, False),
+                         (NOW + timedelta(hours=1), 2, True)])
+    assert _aggregate(db) == 3
+    assert _aggregate(db) == 0
+    assert _buckets(db, 'day') == {(1, '2025-03-17 00:00:00.000000'): (1, 1),
+                                   (2, '2025-03-17 00:00:00.000000'): (1, 0)}
+    assert len(_buckets(db, 'hour')) == 2
+
+
+def test_timeseries_endpoint_only_reads(app, client, give_consent):
+    from app import db
+
+    give_consent('u1', 1)
+    give_consent('u2', 1, status=False)
+    writes = []
+    listener = lambda conn, cursor, statement, *args: writes.append(statement) \
+        if not statement.lstrip().upper().startswith('SELECT') else None
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    try:
+        series = client.get('/api/consent/stats/timeseries?granularity=hour').get_json()['series']
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+    assert series == [] and writes == []
+
+    _aggregate(db)
+    series = client.get('/api/consent/stats/timeseries?granularity=hour').get_json()['series']
+    assert [(s['purpose_name'], s['buckets'][0]['opt_ins'], s['buckets'][0]['opt_outs']) for s in series] == [
+        ('Marketing', 1, 1)
+    ]
+
+
+def test_timeseries_validation(client):
+    assert client.get('/api/consent/stats/timeseries?granularity=week').status_code == 400
+    assert client.get('/api/consent/stats/timeseries?from=last-week').status_code == 400
+    assert client.get('/api/consent/stats/timeseries?granularity=hour&from=2000-01-01T00:00:00').status_code == 400
+
+
+def test_backfill_commits_a_day_at_a_time(app, monkeypatch):
+    from app import db, upsert_rollup
+
+    monkeypatch.setattr(partitions, 'RETENTION_MONTHS', 1)
+    _insert_history(db, [(datetime(2025, 3, day, 9), 1, day % 2 == 0) for day in range(1, 18)])
+    _aggregate(db)
+    expected = _buckets(db, 'day')
+    with db.engine.begin() as conn:
+        conn.execute(text("UPDATE consent_rollups SET opt_ins = 99"))
+    # Not aggregated yet: the backfill leaves it to the cursor
+    _insert_history(db, [(datetime(2025, 3, 17, 10), 1, True)])
+    sequence_changes(db.engine)
+
+    commits = []
+
+    def count_commit(conn):
+        commits.append(1)
+
+    event.listen(db.engine, 'commit', count_commit)
+    try:
+        replayed = rollups.backfill(db.engine, upsert_rollup, now=NOW)
+    finally:
+        event.remove(db.engine, 'commit', count_commit)
+    assert replayed == 17
+    assert _buckets(db, 'day') == expected
+    # The window starts 2025-02-01: one transaction per day up to today
+    assert len(commits) == 45
+
+    assert _aggregate(db) == 1
+    assert _buckets(db, 'day')[(1, '2025-03-17 00:00:00.000000')] == (1, 1)
+
+
+def test_backfill_keeps_buckets_before_the_window(app, monkeypatch):
+    from app import db, upsert_rollup
+
+    monkeypatch.setattr(partitions, 'RETENTION_MONTHS', 1)
+    _insert_history(db, [(datetime(2024, 6, 1, 9), 1, True), (datetime(2025, 3, 2, 9), 1, True)])
+    _aggregate(db)
+    rollups.backfill(db.engine, upsert_rollup, now=NOW)
+    assert set(_buckets(db, 'day')) == {(1, '2024-06-01 00:00:00.000000'), (1, '2025-03-02 00:00:00.000000')}
+
+
+def test_periodic_job_runs_on_notify_and_survives_errors():
+    ran = threading.Event()
+    calls = []
+
+    def job():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError('first run fails')
+        ran.set()
+
+    periodic = PeriodicJob('test', job, interval=60)
+    assert periodic.start() and not periodic.start()
+    try:
+        periodic.notify()
+        periodic.notify()
+        for _ in range(2):
+            periodic.notify()
+            if ran.wait(0.5):
+                break
+        assert ran.is_set()
+        assert periodic.errors == 1 and periodic.runs >= 1
+    finally:
+        periodic.stop()
+    assert not PeriodicJob('off', job, interval=0).start()
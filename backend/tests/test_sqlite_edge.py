@@ -0,0 +1,141 @@
+"""SQLite edge mode: the FIFO writer queue and tuned connections"""
+
+import sqlite3
+import threading
+import time
+
+import pytest
+from sqlalchemy.pool import QueuePool
+
+import sqlite_edge
+from sqlite_edge import TunedConnection, WriterQueue, engine_options, settings, writer_queue
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.001)
+
+
+def test_writer_queue_is_fifo():
+    queue = WriterQueue()
+    queue.acquire(1)
+    order = []
+
+    def writer(name):
+        queue.acquire(5)
+        order.append(name)
+        queue.release()
+
+    threads = []
+    for name in range(5):
+        thread = threading.Thread(target=writer, args=(name,))
+        thread.start()
+        threads.append(thread)
+        # Queue them one at a time so arrival order is known
+        _wait_for(lambda: len(queue._waiters) == name + 1)
+    queue.release()
+    for thread in threads:
+        thread.join()
+    assert order == [0, 1, 2, 3, 4]
+    assert queue.stats['waited'] == 5 and queue.stats['max_queue'] == 5
+    assert not queue._held
+
+
+def test_writer_queue_times_out():
+    queue = WriterQueue()
+    queue.acquire(1)
+    with pytest.raises(sqlite3.OperationalError, match='writer queue'):
+        queue.acquire(0.01)
+    assert queue.stats['timeouts'] == 1 and not queue._waiters
+    queue.release()
+    # The slot is free again
+    queue.acquire(0.01)
+    queue.release()
+
+
+def _connect(path):
+    return sqlite3.connect(path, factory=TunedConnection, isolation_level='IMMEDIATE',
+                           timeout=5, check_same_thread=False)
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / 'edge.db')
+    conn = _connect(path)
+    conn.execute('CREATE TABLE items (id INTEGER PRIMARY KEY, thread INTEGER, n INTEGER)')
+    conn.commit()
+    conn.close()
+    return path
+
+
+def test_connections_are_tuned_on_connect(database):
+    conn = _connect(database)
+    try:
+        values = settings(conn)
+    finally:
+        conn.close()
+    assert values['journal_mode'] == 'wal'
+    assert values['busy_timeout'] == sqlite_edge.SQLITE_BUSY_TIMEOUT_MS
+    assert values['cache_size'] == -sqlite_edge.SQLITE_CACHE_KB
+
+
+def test_concurrent_writers_queue_instead_of_failing(database):
+    errors = []
+
+    def writer(thread):
+        conn = _connect(database)
+        cursor = conn.cursor()
+        try:
+            for n in range(25):
+                cursor.execute('INSERT INTO items (thread, n) VALUES (?, ?)', (thread, n))
+                cursor.execute('UPDATE items SET n = n + 1 WHERE thread = ? AND n = ?', (thread, n))
+                conn.commit()
+        except sqlite3.Error as e:
+            errors.append(e)
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=writer, args=(thread,)) for thread in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    conn = _connect(database)
+    try:
+        assert conn.execute('SELECT COUNT(*) FROM items').fetchone()[0] == 200
+    finally:
+        conn.close()
+    assert not writer_queue._held
+
+
+def test_writer_slot_is_released_on_rollback_and_close(database):
+    # Statements are queued through cursors, the way SQLAlchemy issues them
+    conn = _connect(database)
+    conn.cursor().execute('INSERT INTO items (thread, n) VALUES (0, 0)')
+    assert conn.holds_writer and writer_queue._held
+    conn.rollback()
+    assert not conn.holds_writer and not writer_queue._held
+
+    conn.cursor().execute('INSERT INTO items (thread, n) VALUES (0, 0)')
+    conn.close()
+    assert not writer_queue._held
+
+
+def test_reads_do_not_take_the_writer_slot(database):
+    conn = _connect(database)
+    try:
+        conn.cursor().execute('SELECT COUNT(*) FROM items').fetchone()
+        assert not conn.holds_writer and not writer_queue._held
+    finally:
+        conn.close()
+
+
+def test_engine_options_pool_like_other_backends():
+    options = engine_options(5, 10)
+    assert options['poolclass'] is QueuePool
+    assert (options['pool_size'], options['max_overflow']) == (5, 10)
+    assert options['connect_args']['check_same_thread'] is False
+    assert options['connect_args']['factory'] is TunedConnection
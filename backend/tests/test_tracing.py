@@ -0,0 +1,170 @@
+"""Request, SQL and serialization spans, trace context propagation and sampling"""
+
+import json
+
+import pytest
+
+import tracing
+from tracing import InMemoryExporter, TracedJSONProvider, Tracer
+
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+PARENT_ID = '00f067aa0ba902b7'
+
+_instrumented = set()
+
+
+@pytest.fixture
+def traced(app, monkeypatch):
+    """Returns a function that turns tracing on with the given Tracer options and returns its exporter"""
+    import app as app_module
+    from app import db
+
+    # Listeners can't be removed again; outside a traced request they return right away
+    if id(db.engine) not in _instrumented:
+        tracing.instrument_engine(db.engine)
+        _instrumented.add(id(db.engine))
+    monkeypatch.setattr(app, 'json', TracedJSONProvider(app))
+
+    def enable(**options):
+        exporter = InMemoryExporter()
+        monkeypatch.setattr(app_module, 'tracer', Tracer(exporter, **options))
+        return exporter
+    return enable
+
+
+def _attributes(span):
+    return {item['key']: next(iter(item['value'].values())) for item in span['attributes']}
+
+
+def _check(client, **kwargs):
+    return client.post('/api/consent/check', json={'user_id': 'u1', 'purpose_ids': [1, 2]}, **kwargs)
+
+
+def test_spans_per_request_sql_call_and_serialization(traced, client, give_consent):
+    give_consent('u1', 1)
+    exporter = traced(sample_rate=1.0)
+    response = _check(client)
+    assert response.status_code == 200
+
+    spans = list(exporter.spans)
+    server = [span for span in spans if span['kind'] == tracing.SPAN_KIND_SERVER]
+    assert len(server) == 1
+    server = server[0]
+    assert server['name'] == 'POST /api/consent/check' and 'parentSpanId' not in server
+    assert server['status']['code'] == tracing.STATUS_OK
+    assert _attributes(server)['http.status_code'] == '200'
+    assert response.headers['X-Trace-Id'] == server['traceId']
+
+    sql = [span for span in spans if span['kind'] == tracing.SPAN_KIND_CLIENT]
+    assert sql and all(span['parentSpanId'] == server['spanId'] for span in sql)
+    assert all(span['traceId'] == server['traceId'] for span in sql)
+    assert any(span['name'] == 'SELECT consents' for span in sql)
+    for span in sql:
+        attributes = _attributes(span)
+        assert attributes['db.system'] == 'sqlite'
+        assert "'u1'" not in attributes['db.statement'] and len(attributes['db.statement.fingerprint']) == 16
+
+    serialize = [span for span in spans if span['name'] == 'serialize json']
+    assert len(serialize) == 1 and serialize[0]['parentSpanId'] == server['spanId']
+    assert int(_attributes(serialize[0])['serialize.bytes']) == len(response.get_data().rstrip())
+
+    # Each request is its own trace
+    exporter.clear()
+    second = _check(client)
+    assert {span['traceId'] for span in exporter.spans} == {second.headers['X-Trace-Id']}
+    assert second.headers['X-Trace-Id'] != server['traceId']
+
+
+def test_incoming_traceparent_is_joined_and_passed_on(traced, client):
+    exporter = traced(sample_rate=0.0)
+    response = _check(client, headers={'traceparent': f'00-{TRACE_ID}-{PARENT_ID}-01'})
+    server = next(span for span in exporter.spans if span['kind'] == tracing.SPAN_KIND_SERVER)
+    assert server['traceId'] == TRACE_ID and server['parentSpanId'] == PARENT_ID
+    # The caller gets the context to parent its next calls on this request
+    assert response.headers['traceparent'] == f"00-{TRACE_ID}-{server['spanId']}-01"
+    assert response.headers['X-Trace-Id'] == TRACE_ID
+
+
+def test_unsampled_caller_is_not_traced(traced, client):
+    exporter = traced(sample_rate=1.0)
+    response = _check(client, headers={'traceparent': f'00-{TRACE_ID}-{PARENT_ID}-00'})
+    assert not exporter.spans
+    assert 'traceparent' not in response.headers and 'X-Trace-Id' not in response.headers
+
+
+def test_xray_header_is_joined(traced, client):
+    exporter = traced(sample_rate=0.0)
+    _check(client, headers={'X-Amzn-Trace-Id': 'Root=1-5759e988-bd862e3fe1be46a994272793;'
+                                               'Parent=53995c3f42cd8ad8;Sampled=1'})
+    server = next(span for span in exporter.spans if span['kind'] == tracing.SPAN_KIND_SERVER)
+    assert server['traceId'] == '5759e988bd862e3fe1be46a994272793'
+    assert server['parentSpanId'] == '53995c3f42cd8ad8'
+
+
+def test_invalid_traceparent_starts_a_new_trace():
+    assert tracing.extract_context({'traceparent': f'00-{"0" * 32}-{PARENT_ID}-01'}, environ={}) is None
+    assert tracing.extract_context({'traceparent': f'ff-{TRACE_ID}-{PARENT_ID}-01'}, environ={}) is None
+    assert tracing.extract_context({'traceparent': f'00-{TRACE_ID.upper()}-{PARENT_ID}-03'}, environ={}) == (
+        TRACE_ID, PARENT_ID, True)
+    # The Lambda environment is the last fallback
+    assert tracing.extract_context({}, environ={'_X_AMZN_TRACE_ID': 'Root=1-5759e988-bd862e3fe1be46a994272793'}) == (
+        '5759e988bd862e3fe1be46a994272793', None, None)
+
+
+def test_ratio_sampling_is_decided_by_the_trace_id(traced, client):
+    tracer = Tracer(InMemoryExporter(), sample_rate=0.5)
+    assert tracer._ratio_sampled('0' * 16 + '7fffffffffffffff')
+    assert not tracer._ratio_sampled('f' * 16 + '8000000000000000')
+
+    exporter = traced(sample_rate=0.0)
+    _check(client)
+    assert not exporter.spans
+    exporter = traced(sample_rate=1.0)
+    _check(client)
+    assert exporter.spans
+
+
+def test_tail_sampling_keeps_slow_and_failed_requests(traced, client):
+    exporter = traced(sampler='tail', sample_rate=0.0, slow_ms=60000)
+    response = _check(client)
+    # Recorded and passed on, but not exported
+    assert not exporter.spans and response.headers['traceparent'].endswith('-00')
+
+    exporter = traced(sampler='tail', sample_rate=0.0, slow_ms=0)
+    _check(client)
+    assert any(span['kind'] == tracing.SPAN_KIND_SERVER for span in exporter.spans)
+
+    exporter = InMemoryExporter()
+    tracer = Tracer(exporter, sampler='tail', sample_rate=0.0, slow_ms=60000)
+    tracer.end_request(tracer.start_request('GET /', {}, {}), RuntimeError('boom'))
+    assert exporter.spans[0]['status'] == {'code': tracing.STATUS_ERROR, 'message': 'RuntimeError: boom'}
+
+
+def test_span_cap_counts_dropped_spans(traced, client, give_consent):
+    give_consent('u1', 1)
+    exporter = traced(sample_rate=1.0, max_spans=2)
+    _check(client)
+    server = next(span for span in exporter.spans if span['kind'] == tracing.SPAN_KIND_SERVER)
+    assert int(_attributes(server)['trace.dropped_spans']) > 0
+    assert len(exporter.spans) == 3
+
+
+def test_fingerprint_collapses_literals_and_lists():
+    normalized, digest, name = tracing.fingerprint(
+        "SELECT id FROM consents\n WHERE user_id = 'o''brien' AND purpose_id IN (?, ?, ?) LIMIT 10")
+    assert normalized == "SELECT id FROM consents WHERE user_id = ? AND purpose_id IN (?...) LIMIT ?"
+    assert name == 'SELECT consents'
+    assert tracing.fingerprint("SELECT id FROM consents WHERE user_id = 'x' AND purpose_id IN (?, ?) LIMIT 5")[1] == digest
+
+
+def test_file_exporter_writes_otlp_lines(tmp_path):
+    path = tmp_path / 'traces.jsonl'
+    exporter = tracing.make_exporter('file', str(path))
+    tracer = Tracer(exporter, sample_rate=1.0)
+    tracer.end_request(tracer.start_request('GET /', {}, {'http.method': 'GET'}))
+    line = json.loads(path.read_text())
+    spans = line['resourceSpans'][0]['scopeSpans'][0]['spans']
+    assert spans[0]['name'] == 'GET /' and spans[0]['attributes'] == [
+        {'key': 'http.method', 'value': {'stringValue': 'GET'}}]
+    with pytest.raises(ValueError):
+        tracing.make_exporter('zipkin', None)
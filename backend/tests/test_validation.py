@@ -0,0 +1,89 @@
+"""Malformed consent write and check bodies get 400, in JSON and MessagePack"""
+
+import msgpack
+import pytest
+
+from wire_format import MSGPACK_MIMETYPE
+
+
+def _post(client, path, body, encoding):
+    if encoding == 'msgpack':
+        return client.post(path, data=msgpack.packb(body, use_bin_type=True), content_type=MSGPACK_MIMETYPE)
+    return client.post(path, json=body)
+
+
+@pytest.fixture(params=['json', 'msgpack'])
+def post(request, client):
+    return lambda path, body: _post(client, path, body, request.param)
+
+
+@pytest.mark.parametrize('body', [
+    {'consents': [1]},
+    {'consents': 5},
+    {'consents': 'abc'},
+    {'consents': [{'purpose_id': 1, 'status': True}, None]},
+    {'consents': [{'purpose_id': 1, 'status': 'yes'}]},
+    {'consents': [{'purpose_id': 1, 'status': 1}]},
+    {'consents': [{'purpose_id': '1', 'status': True}]},
+    {'consents': [{'purpose_id': True, 'status': True}]},
+    {'consents': [{'purpose_id': 1, 'status': True}], 'user_id': 7},
+])
+def test_bad_bulk_bodies(app, post, body):
+    from app import Consent
+
+    body = {'user_id': 'u1', **body}
+    response = post('/api/consent/bulk', body)
+    assert response.status_code == 400, response.get_data(as_text=True)
+    assert 'error' in response.get_json()
+    # Nothing from a rejected request is written
+    assert Consent.query.count() == 0
+
+
+def test_bulk_error_names_the_item(post):
+    response = post('/api/consent/bulk', {'user_id': 'u1', 'consents': [
+        {'purpose_id': 1, 'status': True}, {'purpose_id': 2, 'status': 'no'}
+    ]})
+    assert response.get_json()['error'] == 'consents[1]: status must be true or false'
+
+
+def test_bulk_still_skips_incomplete_items(post):
+    response = post('/api/consent/bulk', {'user_id': 'u1', 'consents': [
+        {'purpose_id': 1, 'status': True}, {'purpose_id': 2}, {'purpose_id': 99, 'status': False}
+    ]})
+    assert response.status_code == 200
+
+
+@pytest.mark.parametrize('body', [
+    {'user_id': 'u1', 'purpose_id': 1, 'status': 'false'},
+    {'user_id': 'u1', 'purpose_id': 1, 'status': 0},
+    {'user_id': 'u1', 'purpose_id': 1, 'status': [True]},
+    {'user_id': 'u1', 'purpose_id': '1', 'status': True},
+    {'user_id': 'u1', 'purpose_id': 1.5, 'status': True},
+    {'user_id': 42, 'purpose_id': 1, 'status': True},
+    {'user_id': 'u' * 37, 'purpose_id': 1, 'status': True},
+])
+def test_bad_update_bodies(app, post, body):
+    from app import Consent
+
+    response = post('/api/consent', body)
+    assert response.status_code == 400, response.get_data(as_text=True)
+    assert Consent.query.count() == 0
+
+
+@pytest.mark.parametrize('body', [
+    {'user_id': 'u1', 'purpose_ids': [{'a': 1}]},
+    {'user_id': 'u1', 'purpose_ids': ['1']},
+    {'user_id': 'u1', 'purpose_ids': [True]},
+    {'user_id': 'u1', 'purpose_ids': 5},
+    {'user_id': 'u1', 'purpose_ids': {'1': True}},
+    {'user_id': ['u1'], 'purpose_ids': [1]},
+])
+def test_bad_check_bodies(post, body):
+    response = post('/api/consent/check', body)
+    assert response.status_code == 400, response.get_data(as_text=True)
+
+
+def test_well_formed_bodies_still_work(post):
+    assert post('/api/consent', {'user_id': 'u1', 'purpose_id': 1, 'status': False}).status_code == 200
+    assert post('/api/consent/bulk', {'user_id': 'u1', 'consents': [{'purpose_id': 2, 'status': True}]}).status_code == 200
+    assert post('/api/consent/check', {'user_id': 'u1', 'purpose_ids': [1, 2]}).status_code == 200
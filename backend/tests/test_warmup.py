@@ -0,0 +1,57 @@
+"""Startup priming and the keep-warm Lambda entry point"""
+
+import threading
+import time
+
+import warmup
+
+
+def test_prime_runs_every_step(app):
+    import app as app_module
+
+    report = warmup.prime(app)
+    assert report['ok'] and set(report['steps']) == {'connect', 'catalog', 'statements', 'index'}
+    assert all(isinstance(ms, float) for ms in report['steps'].values())
+    # The catalog is cached for the first request
+    assert app_module._purpose_catalog['loaded_at'] is not None
+
+
+def test_failures_are_reported_not_raised(app, monkeypatch):
+    def broken(app):
+        raise RuntimeError('database unreachable')
+
+    monkeypatch.setattr(warmup, 'STEPS', (('connect', broken), ('catalog', warmup._catalog)))
+    report = warmup.prime(app)
+    assert not report['ok']
+    assert report['steps']['connect'] == 'error: database unreachable'
+    assert isinstance(report['steps']['catalog'], float)
+
+
+def test_steps_after_the_budget_are_skipped(app, monkeypatch):
+    monkeypatch.setattr(warmup, 'STEPS', (('slow', lambda app: time.sleep(0.05)), ('catalog', warmup._catalog)))
+    report = warmup.prime(app, budget_seconds=0.01)
+    assert report['timed_out'] and not report['ok']
+    assert report['total_ms'] < 50
+    # Let the abandoned step finish before the fixture drops the tables
+    time.sleep(0.1)
+
+
+def test_budget_skips_later_steps_without_timing_out(app, monkeypatch):
+    monkeypatch.setattr(warmup, 'STEPS', (('slow', lambda app: time.sleep(0.02)), ('catalog', warmup._catalog)))
+    report = {'ok': True, 'steps': {}}
+    warmup._run_steps(app, 0.01, report)
+    assert report['steps']['catalog'] == 'skipped'
+
+
+def test_keep_warm_event_primes_without_flask(app, monkeypatch):
+    primed = []
+    monkeypatch.setattr(warmup, 'prime', lambda app: primed.append(app) or {'ok': True, 'steps': {}})
+    assert warmup.handler({'warmup': True}, None) == {'ok': True, 'steps': {}}
+    assert len(primed) == 1
+
+
+def test_prime_does_not_block_on_the_caller_thread(app, monkeypatch):
+    seen = []
+    monkeypatch.setattr(warmup, 'STEPS', (('where', lambda app: seen.append(threading.current_thread())),))
+    warmup.prime(app)
+    assert seen and seen[0] is not threading.current_thread() and seen[0].daemon
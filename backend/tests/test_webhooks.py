@@ -0,0 +1,177 @@
+"""Webhook dispatcher against the local stub receiver"""
+
+import io
+import json
+import threading
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import webhook_worker
+from webhook_stub import make_handler
+from webhook_worker import Dispatcher, claim_due, plan_lanes, run_once, verify_signature
+
+SECRET = 's3cret'
+
+
+@pytest.fixture
+def stub():
+    """webhook_stub's handler on a free port; records the events of each accepted batch"""
+    received = []
+
+    class RecordingHandler(make_handler(SECRET, fail_rate=0.0)):
+        def send_response(self, code, message=None):
+            if code == 204:
+                received.append(self.received_body)
+            super().send_response(code, message)
+
+        def do_POST(self):
+            self.received_body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.rfile = io.BytesIO(self.received_body)
+            super().do_POST()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RecordingHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f'http://127.0.0.1:{server.server_address[1]}/hook'
+    server.batches = lambda: [[event['user_id'] for event in json.loads(body)['events']] for body in received]
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def dispatcher():
+    dispatcher = Dispatcher(threads=4)
+    yield dispatcher
+    dispatcher.close()
+
+
+def _endpoint(url, secret=SECRET, max_concurrency=2, batch_size=2):
+    from app import WebhookEndpoint, db
+
+    endpoint = WebhookEndpoint(url=url, secret=secret, max_concurrency=max_concurrency, batch_size=batch_size)
+    db.session.add(endpoint)
+    db.session.commit()
+    return endpoint.id
+
+
+def _outbox():
+    from app import WebhookOutbox
+
+    return WebhookOutbox.query.order_by(WebhookOutbox.id).all()
+
+
+def test_batches_are_signed_and_delivered(app, stub, dispatcher, give_consent):
+    _endpoint(stub.url)
+    for index in range(5):
+        give_consent(f'u{index}', 1)
+    summary = run_once(dispatcher)
+    assert summary == {'claimed': 5, 'delivered': 5, 'failed': 0}
+    assert sorted(stub.batches()) == [['u0', 'u1'], ['u2', 'u3'], ['u4']]
+    assert _outbox() == []
+
+
+def test_signature_covers_timestamp_and_body():
+    body = b'{"events": []}'
+    header = webhook_worker.sign_payload(SECRET, body, timestamp=1000)
+    assert verify_signature(SECRET, header, body, now=1000)
+    assert not verify_signature('other', header, body, now=1000)
+    assert not verify_signature(SECRET, header, body + b' ', now=1000)
+    assert not verify_signature(SECRET, header, body, now=1000 + webhook_worker.SIGNATURE_TOLERANCE_SECONDS + 1)
+    assert not verify_signature(SECRET, None, body)
+
+
+def test_rejected_batches_back_off_then_dead_letter(app, stub, dispatcher, give_consent, monkeypatch):
+    from app import WebhookOutbox, db
+
+    # The stub answers 401 to batches signed with the wrong secret
+    _endpoint(stub.url, secret='wrong')
+    give_consent('u1', 1)
+    before = datetime.utcnow()
+    assert run_once(dispatcher)['failed'] == 1
+    row = _outbox()[0]
+    assert row.attempts == 1 and row.last_error.startswith('HTTP 401')
+    assert before <= row.next_attempt_at <= datetime.utcnow() + timedelta(
+        seconds=webhook_worker.BACKOFF_BASE_SECONDS * 2)
+    assert stub.batches() == []
+
+    # Not due yet, so the next round leaves it alone
+    assert run_once(dispatcher)['claimed'] == 0
+
+    monkeypatch.setattr(webhook_worker, 'MAX_ATTEMPTS', 2)
+    WebhookOutbox.query.update({'next_attempt_at': datetime.utcnow()})
+    db.session.commit()
+    assert run_once(dispatcher)['failed'] == 1
+    row = _outbox()[0]
+    assert row.attempts == 2 and row.next_attempt_at is None
+
+
+def test_backoff_grows_and_is_capped(monkeypatch):
+    monkeypatch.setattr(webhook_worker.random, 'uniform', lambda low, high: high)
+    assert webhook_worker.backoff_seconds(1) == webhook_worker.BACKOFF_BASE_SECONDS * 2
+    assert webhook_worker.backoff_seconds(3) == webhook_worker.BACKOFF_BASE_SECONDS * 8
+    assert webhook_worker.backoff_seconds(30) == webhook_worker.BACKOFF_MAX_SECONDS
+
+
+class _Endpoint:
+    def __init__(self, max_concurrency=2, batch_size=2):
+        self.max_concurrency = max_concurrency
+        self.batch_size = batch_size
+
+
+def test_lanes_fit_within_the_lease(monkeypatch):
+    monkeypatch.setattr(webhook_worker, 'LEASE_SECONDS', 30)
+    monkeypatch.setattr(webhook_worker, 'REQUEST_TIMEOUT', 10)
+    assert webhook_worker.lease_waves() == 2
+    rows = [(row_id, 1 if row_id <= 20 else 2, 0, '{}') for row_id in range(1, 31)] + [(99, 7, 0, '{}')]
+    lanes, orphaned = plan_lanes(rows, {1: _Endpoint(), 2: _Endpoint()}, threads=3)
+    # Endpoint 1 takes two lanes of two batches; the last thread goes to endpoint 2
+    assert [len(batches) for _, batches in lanes] == [2, 2, 2]
+    assert sum(len(batch) for _, batches in lanes[:2] for batch in batches) == 8
+    assert [row[0] for batch in lanes[2][1] for row in batch] == [21, 22, 23, 24]
+    assert [row[0] for row in orphaned] == [99]
+
+    # No threads left for an endpoint, nothing of it is planned
+    lanes, _ = plan_lanes(rows, {1: _Endpoint(max_concurrency=5), 2: _Endpoint()}, threads=3)
+    assert len(lanes) == 3
+    assert max(row[0] for _, batches in lanes for batch in batches for row in batch) <= 20
+
+
+def test_only_what_fits_is_leased(app, stub, dispatcher, give_consent, monkeypatch):
+    from app import WebhookEndpoint, WebhookOutbox, db
+
+    monkeypatch.setattr(webhook_worker, 'LEASE_SECONDS', 20)
+    monkeypatch.setattr(webhook_worker, 'REQUEST_TIMEOUT', 10)
+    _endpoint(stub.url, max_concurrency=1, batch_size=2)
+    for index in range(5):
+        give_consent(f'u{index}', 1)
+
+    # One lane of one batch; a second worker claiming meanwhile gets the rest
+    endpoints = {e.id: e for e in WebhookEndpoint.query.filter_by(active=True)}
+    first, _ = claim_due(db, WebhookOutbox, endpoints, threads=1)
+    second, _ = claim_due(db, WebhookOutbox, endpoints, threads=1)
+    first_ids = {row[0] for _, batches in first for batch in batches for row in batch}
+    second_ids = {row[0] for _, batches in second for batch in batches for row in batch}
+    assert len(first_ids) == len(second_ids) == 2 and not first_ids & second_ids
+
+    WebhookOutbox.query.update({'next_attempt_at': datetime.utcnow()})
+    db.session.commit()
+    rounds = 0
+    while run_once(dispatcher)['claimed']:
+        rounds += 1
+    assert rounds == 3
+    users = [user_id for batch in stub.batches() for user_id in batch]
+    assert sorted(users) == ['u0', 'u1', 'u2', 'u3', 'u4']
+
+
+def test_inactive_endpoint_events_are_dropped(app, dispatcher, give_consent):
+    from app import WebhookEndpoint, db
+
+    endpoint_id = _endpoint('http://127.0.0.1:9/hook')
+    give_consent('u1', 1)
+    db.session.get(WebhookEndpoint, endpoint_id).active = False
+    db.session.commit()
+    assert run_once(dispatcher) == {'claimed': 1, 'delivered': 0, 'failed': 0}
+    assert _outbox() == []
@@ -0,0 +1,326 @@
+"""
+Request tracing with OpenTelemetry-compatible spans.
+
+Each traced request gets a server span named after its route. Child spans
+cover every SQL statement and response serialization:
+
+    POST /api/consent/check                  server span, http.* attributes
+      SELECT consents                        one per statement; db.statement holds
+                                             the statement fingerprint
+      serialize json
+
+The trace context comes from the incoming headers. W3C `traceparent` comes
+first; `X-Amzn-Trace-Id` (API Gateway / X-Ray) is used otherwise; on Lambda
+the `_X_AMZN_TRACE_ID` environment variable is the last fallback. A
+request therefore joins the trace its caller started, and its sampled flag
+is honoured. Traced responses carry a `traceparent` for the server span,
+so the caller can parent whatever it does next on this request.
+
+Sampling keeps overhead low. Requests that aren't sampled record nothing,
+and the SQL and serialization hooks return right away.
+    ratio   parent-based: follow the caller's sampled flag, otherwise keep
+            `sample_rate` of traces, decided from the trace id so every
+            service makes the same choice
+    tail    record every request, but export only sampled traces, errors
+            (5xx or an exception) and requests slower than `slow_ms`
+
+Spans are exported in the OTLP/JSON encoding, one ExportTraceServiceRequest
+per trace:
+    FileExporter      appends lines to a file. An OpenTelemetry Collector can
+                      ship it with the `otlpjsonfile` receiver, or it can be
+                      read directly
+    InMemoryExporter  keeps finished spans in a list, for tests and local
+                      debugging
+No OpenTelemetry packages are needed.
+"""
+
+import contextlib
+import contextvars
+import functools
+import hashlib
+import json
+import os
+import re
+import secrets
+import socket
+import threading
+import time
+from collections import deque
+
+from flask.json.provider import DefaultJSONProvider
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+_current = contextvars.ContextVar('current_span', default=None)
+
+_TRACEPARENT = re.compile(r'^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})')
+_XRAY_ROOT = re.compile(r'Root=1-([0-9a-f]{8})-([0-9a-f]{24})')
+_XRAY_PARENT = re.compile(r'Parent=([0-9a-f]{16})')
+_XRAY_SAMPLED = re.compile(r'Sampled=([01])')
+
+
+class Span:
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'kind', 'start_ns', 'end_ns', 'attributes', 'status')
+
+    def __init__(self, trace, name, kind, parent_id, attributes=None):
+        self.trace = trace
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes or {}
+        self.status = None
+
+    def end(self):
+        self.end_ns = time.time_ns()
+        self.trace.finish(self)
+
+    def set_error(self, message):
+        self.status = (STATUS_ERROR, message)
+
+    def to_otlp(self):
+        span = {
+            'traceId': self.trace.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns),
+            'attributes': _otlp_attributes(self.attributes),
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        if self.status is not None:
+            span['status'] = {'code': self.status[0], 'message': self.status[1]}
+        return span
+
+
+class _Trace:
+    """The spans one request recorded in this process"""
+    __slots__ = ('tracer', 'trace_id', 'sampled', 'spans', 'dropped')
+
+    def __init__(self, tracer, trace_id, sampled):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.spans = []
+        self.dropped = 0
+
+    def finish(self, span):
+        # The server span ends last and carries the dropped count, so it is always kept
+        if len(self.spans) < self.tracer.max_spans or span.kind == SPAN_KIND_SERVER:
+            self.spans.append(span)
+        else:
+            self.dropped += 1
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def _otlp_attributes(attributes):
+    return [{'key': key, 'value': _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+def extract_context(headers, environ=os.environ):
+    """(trace_id, parent_span_id, sampled or None) from incoming headers, or None"""
+    match = _TRACEPARENT.match(headers.get('traceparent', '').strip().lower())
+    if match and match.group(1) != 'ff' and set(match.group(2)) != {'0'} and set(match.group(3)) != {'0'}:
+        return match.group(2), match.group(3), bool(int(match.group(4), 16) & 1)
+    amzn = headers.get('X-Amzn-Trace-Id') or environ.get('_X_AMZN_TRACE_ID', '')
+    root = _XRAY_ROOT.search(amzn)
+    if root:
+        parent = _XRAY_PARENT.search(amzn)
+        sampled = _XRAY_SAMPLED.search(amzn)
+        return (root.group(1) + root.group(2), parent.group(1) if parent else None,
+                sampled.group(1) == '1' if sampled else None)
+    return None
+
+
+def traceparent(span):
+    """W3C traceparent header value naming `span` as the parent"""
+    return f"00-{span.trace.trace_id}-{span.span_id}-{'01' if span.trace.sampled else '00'}"
+
+
+class InMemoryExporter:
+    """Keeps the most recent finished spans (OTLP span dicts)"""
+
+    def __init__(self, max_spans=10000):
+        self.spans = deque(maxlen=max_spans)
+
+    def export(self, resource, spans):
+        self.spans.extend(spans)
+
+    def clear(self):
+        self.spans.clear()
+
+
+class FileExporter:
+    """Appends one OTLP/JSON ExportTraceServiceRequest line per trace"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, resource, spans):
+        line = json.dumps({'resourceSpans': [{
+            'resource': {'attributes': resource},
+            'scopeSpans': [{'scope': {'name': 'consent-api.tracing'}, 'spans': spans}]
+        }]}, separators=(',', ':'))
+        with self.lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+
+def make_exporter(name, path):
+    if name == 'file':
+        return FileExporter(path)
+    if name == 'memory':
+        return InMemoryExporter()
+    raise ValueError(f"Unknown trace exporter {name!r}; expected 'file' or 'memory'")
+
+
+class Tracer:
+    def __init__(self, exporter, service_name='consent-api', sampler='ratio', sample_rate=0.01,
+                 slow_ms=500, max_spans=256):
+        if sampler not in ('ratio', 'tail'):
+            raise ValueError(f"Unknown sampler {sampler!r}; expected 'ratio' or 'tail'")
+        self.exporter = exporter
+        self.sampler = sampler
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.max_spans = max_spans
+        resource = {'service.name': service_name, 'service.instance.id': f'{socket.gethostname()}:{os.getpid()}'}
+        if os.getenv('AWS_LAMBDA_FUNCTION_NAME'):
+            resource['faas.name'] = os.getenv('AWS_LAMBDA_FUNCTION_NAME')
+        self.resource = _otlp_attributes(resource)
+
+    def _ratio_sampled(self, trace_id):
+        # Lower 64 bits of the trace id, like OpenTelemetry's TraceIdRatioBased
+        return int(trace_id[16:], 16) < self.sample_rate * 2 ** 64
+
+    def start_request(self, name, headers, attributes):
+        """Open the server span for a request; returns (span, context token) or None"""
+        parent = extract_context(headers)
+        trace_id, parent_id, sampled = parent if parent else (secrets.token_hex(16), None, None)
+        if sampled is None:
+            sampled = self._ratio_sampled(trace_id)
+        if not sampled and self.sampler == 'ratio':
+            return None
+        span = Span(_Trace(self, trace_id, sampled), name, SPAN_KIND_SERVER, parent_id, attributes)
+        return span, _current.set(span)
+
+    def end_request(self, started, error=None):
+        span, token = started
+        _current.reset(token)
+        if error is not None:
+            span.set_error(f'{type(error).__name__}: {error}')
+        elif span.status is None:
+            span.status = (STATUS_OK, '')
+        trace = span.trace
+        if trace.dropped:
+            span.attributes['trace.dropped_spans'] = trace.dropped
+        span.end()
+        duration_ms = (span.end_ns - span.start_ns) / 1e6
+        if trace.sampled or span.status[0] == STATUS_ERROR or duration_ms >= self.slow_ms:
+            self.exporter.export(self.resource, [s.to_otlp() for s in trace.spans])
+
+
+def current_span():
+    return _current.get()
+
+
+@contextlib.contextmanager
+def span(name, kind=SPAN_KIND_INTERNAL, **attributes):
+    """Child span of the current one; does nothing outside a traced request"""
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(parent.trace, name, kind, parent.span_id, attributes)
+    token = _current.set(child)
+    try:
+        yield child
+    except Exception as e:
+        child.set_error(f'{type(e).__name__}: {e}')
+        raise
+    finally:
+        _current.reset(token)
+        child.end()
+
+
+_FINGERPRINT_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_FINGERPRINT_LISTS = re.compile(r"\(\s*(?:\?|%s|:\w+|\$\d+)(?:\s*,\s*(?:\?|%s|:\w+|\$\d+))+\s*\)")
+_FINGERPRINT_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|JOIN)\s+"?(\w+)', re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint(statement):
+    """(normalized statement, short hash, span name) with literals and IN lists collapsed"""
+    normalized = ' '.join(statement.split())
+    normalized = _FINGERPRINT_LITERALS.sub('?', normalized)
+    normalized = _FINGERPRINT_LISTS.sub('(?...)', normalized)
+    operation = normalized.split(' ', 1)[0].upper()
+    table = _FINGERPRINT_TABLE.search(normalized)
+    name = f'{operation} {table.group(1)}' if table else operation
+    return normalized[:2000], hashlib.blake2b(normalized.encode('utf-8'), digest_size=8).hexdigest(), name
+
+
+def instrument_engine(engine):
+    """Record a client span per SQL statement run inside a traced request"""
+    from sqlalchemy import event
+
+    system = engine.dialect.name
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        parent = _current.get()
+        if parent is None:
+            return
+        normalized, digest, name = fingerprint(statement)
+        conn.info.setdefault('trace_spans', []).append(Span(parent.trace, name, SPAN_KIND_CLIENT, parent.span_id, {
+            'db.system': system,
+            'db.statement': normalized,
+            'db.statement.fingerprint': digest,
+            'db.operation': name.split(' ', 1)[0],
+            'db.executemany': executemany or None,
+        }))
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        spans = conn.info.get('trace_spans')
+        if spans:
+            child = spans.pop()
+            if cursor.rowcount is not None and cursor.rowcount >= 0:
+                child.attributes['db.rows_affected'] = cursor.rowcount
+            child.end()
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        spans = context.connection.info.get('trace_spans') if context.connection is not None else None
+        if spans:
+            child = spans.pop()
+            child.set_error(f'{type(context.original_exception).__name__}: {context.original_exception}')
+            child.end()
+
+
+class TracedJSONProvider(DefaultJSONProvider):
+    """Flask's JSON provider with a span around each serialization"""
+
+    def dumps(self, obj, **kwargs):
+        with span('serialize json') as current:
+            body = super().dumps(obj, **kwargs)
+            if current is not None:
+                current.attributes['serialize.bytes'] = len(body)
+            return body
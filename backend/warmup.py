@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Startup priming for API workers and Lambda containers.
+
+The first request a fresh process serves otherwise pays for creating the
+engine, connecting to the database, loading the purpose catalog and
+compiling the SQL of the hot read paths. prime() does that work up front
+and reports how long each step took:
+
+    connect     check out a pooled connection (runs SELECT 1)
+    catalog     load the purpose catalog and cache its serialized JSON
+    statements  run the consent check, batch check and consent list queries
+                once for a user that can't exist, which fills SQLAlchemy's
+                compiled statement cache
+    index       open the consent index and its change overlay, if configured
+
+Priming is optional and bounded in time. It runs in a daemon thread that
+is waited on for at most WARMUP_BUDGET_SECONDS. A step that would start
+after the budget is used up is skipped. Failures are reported, never
+raised, so a slow or unreachable database cannot stop a worker from
+starting.
+
+Triggers:
+- WARMUP_ON_START=1 primes when app.py is imported, i.e. during Lambda init
+  or gunicorn worker boot
+- handler() is the Lambda entry point for the `api` function. A scheduled
+  event with {"warmup": true} re-primes the container and returns the
+  report without going through Flask, so keep-warm pings never show up as
+  API traffic. Every other event is served by serverless-wsgi.
+
+Usage:
+    python warmup.py          # prime once against DATABASE_URL and print the timings
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+
+WARMUP_BUDGET_SECONDS = float(os.getenv('WARMUP_BUDGET_SECONDS', '5'))
+# Matches nothing; only used to execute statements for their compilation
+WARMUP_USER_ID = '__warmup__'
+
+
+def _module(app):
+    # The module that defined the app, which is __main__ under `python app.py`
+    return sys.modules[app.import_name]
+
+
+def _connect(app):
+    from sqlalchemy import text
+
+    _module(app).db.session.execute(text('SELECT 1'))
+
+
+def _catalog(app):
+    module = _module(app)
+    module.purpose_catalog()
+    module.purpose_names()
+    module.catalog_version()
+
+
+def _statements(app):
+    module = _module(app)
+    db, Consent = module.db, module.Consent
+    purpose_ids = list(module.purpose_names()) or [0]
+    Consent.query.filter(
+        Consent.user_id == WARMUP_USER_ID,
+        Consent.purpose_id.in_(purpose_ids),
+        Consent.unexpired()
+    ).all()
+    db.session.query(Consent.user_id, Consent.purpose_id, Consent.status).filter(
+        Consent.user_id.in_([WARMUP_USER_ID]),
+        Consent.purpose_id.in_(purpose_ids),
+        Consent.unexpired()
+    ).all()
+    Consent.query.filter(Consent.user_id == WARMUP_USER_ID, Consent.unexpired()).all()
+
+
+def _index(app):
+    module = _module(app)
+    if module.consent_index is not None:
+        module.consent_index.statuses(WARMUP_USER_ID, list(module.purpose_names()))
+
+
+STEPS = (('connect', _connect), ('catalog', _catalog), ('statements', _statements), ('index', _index))
+
+
+def _run_steps(app, budget_seconds, report):
+    started = time.perf_counter()
+    with app.app_context():
+        for name, step in STEPS:
+            if time.perf_counter() - started >= budget_seconds:
+                report['steps'][name] = 'skipped'
+                continue
+            step_started = time.perf_counter()
+            try:
+                step(app)
+                report['steps'][name] = round((time.perf_counter() - step_started) * 1000, 1)
+            except Exception as e:
+                report['steps'][name] = f'error: {e}'
+                report['ok'] = False
+
+
+def prime(app, budget_seconds=WARMUP_BUDGET_SECONDS):
+    """Warm connections, the catalog and hot statements; returns a timing report in ms"""
+    report = {'ok': True, 'steps': {}}
+    started = time.perf_counter()
+    worker = threading.Thread(target=_run_steps, args=(app, budget_seconds, report), daemon=True)
+    worker.start()
+    worker.join(budget_seconds)
+    if worker.is_alive():
+        # The step in progress carries on in the background; startup doesn't wait for it
+        report = {'ok': False, 'timed_out': True, 'steps': dict(report['steps'])}
+    report['total_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    return report
+
+
+def handler(event, context):
+    """Lambda entry point: keep-warm pings prime, everything else is an API request"""
+    from app import app
+
+    if isinstance(event, dict) and event.get('warmup'):
+        return prime(app)
+
+    import serverless_wsgi
+
+    return serverless_wsgi.handle_request(app, event, context)
+
+
+def main():
+    from app import app
+
+    print(json.dumps(prime(app), indent=2))
+
+
+if __name__ == '__main__':
+    main()
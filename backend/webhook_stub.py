@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Local HTTP stub for testing webhook delivery.
+
+Receives batches from webhook_worker.py, checks their signatures and prints
+the events. --fail-rate makes a share of requests return 500 so retries and
+backoff can be observed.
+
+Usage:
+    python webhook_stub.py --secret s3cret
+    python webhook_worker.py add-endpoint http://localhost:8090/hook --secret s3cret
+    python webhook_worker.py run
+"""
+
+import argparse
+import json
+import random
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from webhook_worker import SIGNATURE_HEADER, verify_signature
+
+
+def make_handler(secret, fail_rate):
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if not verify_signature(secret, self.headers.get(SIGNATURE_HEADER), body):
+                print("✗ Rejected batch with invalid signature")
+                self.send_response(401)
+                self.end_headers()
+                return
+            if random.random() < fail_rate:
+                print("✗ Simulated failure")
+                self.send_response(500)
+                self.end_headers()
+                return
+            events = json.loads(body)['events']
+            for event in events:
+                print(f"✓ {event['type']} user={event['user_id']} purpose={event['purpose_id']} "
+                      f"status={event['status']}")
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    return WebhookHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local webhook receiver')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--secret', required=True, help='endpoint signing secret')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='share of requests answered with 500')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(args.secret, args.fail_rate))
+    print(f"Webhook stub listening on http://127.0.0.1:{args.port}/hook")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nWebhook stub stopped")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+Webhook dispatcher for consent changes.
+
+Consent writes add one row per active endpoint to webhook_outbox in the same
+transaction as the change itself (see enqueue_webhooks in app.py). This worker
+drains the outbox:
+
+1. Claims due rows and leases them (FOR UPDATE SKIP LOCKED on PostgreSQL, so
+   several workers can run side by side).
+2. Groups them per endpoint into batches of up to `batch_size` events, and
+   the batches into lanes: up to `max_concurrency` per endpoint and one per
+   thread, each sent one batch after another.
+3. POSTs each batch as {"events": [...]} signed with HMAC-SHA256.
+4. Deletes delivered rows; failed rows are retried with exponential backoff
+   and jitter, and become dead letters after WEBHOOK_MAX_ATTEMPTS.
+
+A lease that ran out while its batch was still queued would let another
+worker send the same events, so a round only leases what its lanes can send
+in time: each lane gets at most lease_waves() batches, each of which may
+take up to WEBHOOK_REQUEST_TIMEOUT. Rows past that stay due for the next
+round.
+
+Receivers check the `X-Consent-Signature: t=<unix time>,v1=<hex digest>`
+header with verify_signature(); the digest covers "<t>.<raw body>".
+
+Usage:
+    python webhook_worker.py run                 # poll forever
+    python webhook_worker.py run --once
+    python webhook_worker.py add-endpoint http://localhost:8090/hook --secret s3cret
+    python webhook_worker.py list-endpoints
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import random
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import requests
+from dotenv import load_dotenv
+
+load_dotenv()
+
+WORKER_THREADS = int(os.getenv('WEBHOOK_WORKER_THREADS', '8'))
+CLAIM_LIMIT = int(os.getenv('WEBHOOK_CLAIM_LIMIT', '1000'))
+LEASE_SECONDS = int(os.getenv('WEBHOOK_LEASE_SECONDS', '60'))
+MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', '10'))
+BACKOFF_BASE_SECONDS = float(os.getenv('WEBHOOK_BACKOFF_BASE_SECONDS', '2'))
+BACKOFF_MAX_SECONDS = float(os.getenv('WEBHOOK_BACKOFF_MAX_SECONDS', '900'))
+REQUEST_TIMEOUT = float(os.getenv('WEBHOOK_REQUEST_TIMEOUT', '10'))
+POLL_SECONDS = float(os.getenv('WEBHOOK_POLL_SECONDS', '1'))
+SIGNATURE_TOLERANCE_SECONDS = 300
+
+SIGNATURE_HEADER = 'X-Consent-Signature'
+
+
+def sign_payload(secret, body, timestamp=None):
+    """Signature header value for a raw request body"""
+    timestamp = int(timestamp if timestamp is not None else time.time())
+    digest = hmac.new(secret.encode('utf-8'), f"{timestamp}.".encode('utf-8') + body, hashlib.sha256)
+    return f"t={timestamp},v1={digest.hexdigest()}"
+
+
+def verify_signature(secret, header, body, tolerance=SIGNATURE_TOLERANCE_SECONDS, now=None):
+    """Check a signature header against the raw body; rejects stale timestamps"""
+    try:
+        parts = dict(item.split('=', 1) for item in header.split(','))
+        timestamp = int(parts['t'])
+    except (AttributeError, KeyError, ValueError):
+        return False
+    if abs((now or time.time()) - timestamp) > tolerance:
+        return False
+    expected = sign_payload(secret, body, timestamp).split('v1=', 1)[1]
+    return hmac.compare_digest(expected, parts.get('v1', ''))
+
+
+def backoff_seconds(attempts):
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempts)))
+
+
+def lease_waves():
+    """Batches one lane may send in a row and still finish inside the lease.
+
+    One request timeout of the lease is kept back for recording the results.
+    """
+    return max(1, int(LEASE_SECONDS // REQUEST_TIMEOUT) - 1)
+
+
+class Dispatcher:
+    """Delivers lanes of batches from a thread pool"""
+
+    def __init__(self, threads=WORKER_THREADS):
+        self.threads = threads
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=threads, pool_maxsize=threads)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def deliver(self, url, secret, payloads):
+        """POST one batch; returns None on success or an error message"""
+        body = json.dumps({'events': [json.loads(p) for p in payloads]}).encode('utf-8')
+        headers = {'Content-Type': 'application/json', SIGNATURE_HEADER: sign_payload(secret, body)}
+        try:
+            response = self.session.post(url, data=body, headers=headers, timeout=REQUEST_TIMEOUT)
+        except requests.RequestException as e:
+            return str(e)
+        if 200 <= response.status_code < 300:
+            return None
+        return f"HTTP {response.status_code}: {response.text[:200]}"
+
+    def deliver_lane(self, url, secret, batches):
+        """POST batches one after another; returns one deliver() result per batch"""
+        return [self.deliver(url, secret, [row[3] for row in batch]) for batch in batches]
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+
+def plan_lanes(rows, endpoints, threads=WORKER_THREADS):
+    """Split due rows into lanes that can all be sent within one lease.
+
+    A lane is a list of batches for one endpoint that a single thread sends
+    in order. Each endpoint gets up to `max_concurrency` lanes and the round
+    at most `threads`, so no batch waits for a free thread while its lease
+    runs down; each lane holds at most lease_waves() batches. Rows are taken
+    in id order, and those that don't fit are left out.
+
+    Returns ([(endpoint, [batch, ...]), ...], rows of inactive or deleted
+    endpoints).
+    """
+    pending = {}
+    for row in rows:
+        pending.setdefault(row[1], []).append(row)
+    waves = lease_waves()
+    lanes, orphaned, free = [], [], threads
+    for endpoint_id, endpoint_rows in pending.items():
+        endpoint = endpoints.get(endpoint_id)
+        if endpoint is None:
+            orphaned.extend(endpoint_rows)
+            continue
+        size = max(1, endpoint.batch_size)
+        batches = [endpoint_rows[start:start + size] for start in range(0, len(endpoint_rows), size)]
+        count = min(free, max(1, endpoint.max_concurrency), len(batches))
+        if not count:
+            continue
+        free -= count
+        batches = batches[:count * waves]
+        lanes.extend((endpoint, batches[lane::count]) for lane in range(count))
+    return lanes, orphaned
+
+
+def claim_due(db, WebhookOutbox, endpoints, threads=WORKER_THREADS, limit=CLAIM_LIMIT):
+    """Lease due outbox rows so other workers skip them until the lease ends.
+
+    Only rows plan_lanes() fits into this round are leased; the rest stay
+    due. Rows hold plain (id, endpoint_id, attempts, payload) tuples so
+    nothing has to be reloaded after the claiming transaction commits.
+    """
+    now = datetime.utcnow()
+    rows = WebhookOutbox.query.filter(
+        WebhookOutbox.next_attempt_at <= now
+    ).order_by(WebhookOutbox.id).limit(limit).with_for_update(skip_locked=True).all()
+    lanes, orphaned = plan_lanes(
+        [(row.id, row.endpoint_id, row.attempts, row.payload) for row in rows], endpoints, threads
+    )
+    leased = {row[0] for row in orphaned}
+    leased.update(row[0] for _, batches in lanes for batch in batches for row in batch)
+    for row in rows:
+        if row.id in leased:
+            row.next_attempt_at = now + timedelta(seconds=LEASE_SECONDS)
+    db.session.commit()
+    return lanes, orphaned
+
+
+def run_once(dispatcher):
+    """Claim and deliver one round of due events; returns a summary dict"""
+    from app import db, WebhookEndpoint, WebhookOutbox
+
+    endpoints = {e.id: e for e in WebhookEndpoint.query.filter_by(active=True)}
+    lanes, orphaned = claim_due(db, WebhookOutbox, endpoints, dispatcher.threads)
+    if not lanes and not orphaned:
+        return {'claimed': 0, 'delivered': 0, 'failed': 0}
+
+    futures = [
+        (batches, dispatcher.executor.submit(dispatcher.deliver_lane, endpoint.url, endpoint.secret, batches))
+        for endpoint, batches in lanes
+    ]
+
+    # Events for inactive or deleted endpoints are dropped along with delivered ones
+    done = [row[0] for row in orphaned]
+    claimed = len(orphaned)
+    delivered = failed = 0
+    now = datetime.utcnow()
+    for batches, future in futures:
+        for batch, error in zip(batches, future.result()):
+            claimed += len(batch)
+            if error is None:
+                done.extend(row[0] for row in batch)
+                delivered += len(batch)
+                continue
+            for row_id, _, attempts, _ in batch:
+                attempts += 1
+                WebhookOutbox.query.filter_by(id=row_id).update({
+                    'attempts': attempts,
+                    'last_error': error,
+                    'next_attempt_at': None if attempts >= MAX_ATTEMPTS else
+                    now + timedelta(seconds=backoff_seconds(attempts))
+                }, synchronize_session=False)
+            failed += len(batch)
+    if done:
+        WebhookOutbox.query.filter(WebhookOutbox.id.in_(done)).delete(synchronize_session=False)
+    db.session.commit()
+    return {'claimed': claimed, 'delivered': delivered, 'failed': failed}
+
+
+def run_forever(poll_seconds=POLL_SECONDS):
+    from app import app
+
+    dispatcher = Dispatcher()
+    print("Webhook worker started, press Ctrl+C to stop")
+    try:
+        with app.app_context():
+            while True:
+                summary = run_once(dispatcher)
+                if summary['claimed']:
+                    print(f"Delivered {summary['delivered']}, failed {summary['failed']} "
+                          f"of {summary['claimed']} events")
+                else:
+                    time.sleep(poll_seconds)
+    except KeyboardInterrupt:
+        print("\nWebhook worker stopped")
+    finally:
+        dispatcher.close()
+
+
+def handler(event, context):
+    """Lambda entry point: drain the outbox until it's empty or time runs short.
+
+    A round is only started with time left for all of its lanes, so the
+    function is never stopped between sending a batch and recording it.
+    """
+    from app import app
+
+    dispatcher = Dispatcher()
+    totals = {'claimed': 0, 'delivered': 0, 'failed': 0}
+    try:
+        with app.app_context():
+            while context is None or context.get_remaining_time_in_millis() > (lease_waves() + 1) * REQUEST_TIMEOUT * 1000:
+                summary = run_once(dispatcher)
+                for key in totals:
+                    totals[key] += summary[key]
+                if not summary['claimed']:
+                    break
+    finally:
+        dispatcher.close()
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Consent change webhook dispatcher')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help='deliver queued events')
+    run.add_argument('--once', action='store_true', help='deliver one round and exit')
+    add = commands.add_parser('add-endpoint', help='register a webhook endpoint')
+    add.add_argument('url')
+    add.add_argument('--secret', help='signing secret (generated if omitted)')
+    add.add_argument('--max-concurrency', type=int, default=2)
+    add.add_argument('--batch-size', type=int, default=100)
+    commands.add_parser('list-endpoints', help='list webhook endpoints')
+    args = parser.parse_args()
+
+    if args.command == 'run' and not args.once:
+        run_forever()
+        return
+
+    from app import app, db, WebhookEndpoint
+
+    with app.app_context():
+        if args.command == 'run':
+            dispatcher = Dispatcher()
+            try:
+                print(run_once(dispatcher))
+            finally:
+                dispatcher.close()
+        elif args.command == 'add-endpoint':
+            endpoint = WebhookEndpoint(
+                url=args.url,
+                secret=args.secret or secrets.token_hex(32),
+                max_concurrency=args.max_concurrency,
+                batch_size=args.batch_size
+            )
+            db.session.add(endpoint)
+            db.session.commit()
+            print(f"✓ Endpoint {endpoint.id} registered for {endpoint.url}")
+            print(f"  Signing secret: {endpoint.secret}")
+        else:
+            for endpoint in WebhookEndpoint.query.order_by(WebhookEndpoint.id):
+                print(json.dumps(endpoint.to_dict()))
+
+
+if __name__ == '__main__':
+    main()
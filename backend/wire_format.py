@@ -0,0 +1,80 @@
+"""
+JSON / MessagePack content negotiation.
+
+JSON stays the default. Service-to-service callers can send request bodies
+as `application/msgpack` (Content-Type) and ask for MessagePack responses
+(Accept: application/msgpack). This requires the optional `msgpack` package.
+Without it, MessagePack is never selected and MessagePack request bodies are
+rejected with 415.
+
+MessagePack responses use a compact shape rather than the JSON one:
+timestamps are integer unix seconds (UTC), and row sets are columns
+({"purpose_id": [...], "status": [...]}) instead of a list of objects
+repeating every key and purpose name.
+"""
+
+import calendar
+
+from flask import Response
+from werkzeug.exceptions import BadRequest
+
+from tracing import span
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPE = 'application/msgpack'
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+def msgpack_available():
+    return msgpack is not None
+
+
+def wants_msgpack(request):
+    """True if the client prefers MessagePack; JSON wins ties and missing Accept headers"""
+    if msgpack is None:
+        return False
+    return request.accept_mimetypes.best_match([JSON_MIMETYPE, MSGPACK_MIMETYPE]) == MSGPACK_MIMETYPE
+
+
+def wants_ndjson(request):
+    """True if the client asked for a newline-delimited JSON (streamed) response"""
+    return request.accept_mimetypes.best_match([JSON_MIMETYPE, NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+
+def sent_msgpack(request):
+    return request.mimetype == MSGPACK_MIMETYPE
+
+
+def request_payload(request):
+    """Decoded request body, by Content-Type; BadRequest unless it is a well-formed object"""
+    if sent_msgpack(request):
+        try:
+            payload = msgpack.unpackb(request.get_data(), raw=False, strict_map_key=False)
+        except (msgpack.UnpackException, ValueError, TypeError):
+            raise BadRequest('Malformed MessagePack body')
+    else:
+        payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        raise BadRequest('Request body must be a JSON or MessagePack object')
+    return payload
+
+
+def unix_seconds(value):
+    """Naive UTC datetime to integer unix seconds"""
+    return calendar.timegm(value.utctimetuple()) if value is not None else None
+
+
+def columns(rows, fields):
+    """Column-oriented {name: [getter(row), ...]} for a {name: getter} mapping"""
+    return {name: [getter(row) for row in rows] for name, getter in fields.items()}
+
+
+def msgpack_response(payload, status=200):
+    with span('serialize msgpack'):
+        body = msgpack.packb(payload, use_bin_type=True)
+    return Response(body, status=status, mimetype=MSGPACK_MIMETYPE)